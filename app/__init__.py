@@ -34,6 +34,9 @@ def create_app():
 
     app.logger.setLevel(logging.INFO)
     app.logger.info('Chatbot startup')
+    from . import db_utils
+    db_utils.init_app(app)
+
     from .routes import main
     app.register_blueprint(main)
 
@@ -0,0 +1,267 @@
+"""
+ASGI application: the asyncio chat endpoints in front of the Flask app.
+
+POST /chat/message and POST /chat/message/stream are answered natively here
+by app.async_turn. Waiting on Gemini or MySQL then costs a suspended
+coroutine instead of a worker thread, so one process carries as many
+concurrent turns as its async lock pool allows (app.async_db). Requests and
+responses are identical to the Flask views in app.routes:
+
+- the same JWT checks (app.auth) and MessageSchema validation;
+- Idempotency-Key and X-Request-Timeout behave the same;
+- the same JSON payload, or the same Server-Sent Events.
+
+Every other path is served by the Flask app itself on a pool of
+ASGI_WSGI_THREADS threads (a2wsgi).
+
+Serve it with `WEB_WORKER_CLASS=asgi gunicorn --config gunicorn.conf.py`
+(uvicorn workers, see gunicorn.conf.py) or `uvicorn asgi:application`.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from a2wsgi import WSGIMiddleware
+from marshmallow import ValidationError
+
+from app import async_db, create_app, turn_guard
+from app.async_turn import run_chat_turn_async, stream_chat_turn_async
+from app.auth import authenticate
+from app.db_utils import STICKY_COOKIE, get_replica_configs
+from app.personas import personas
+from app.resilience import request_deadline
+from app.routes import MessageSchema, STREAM_FAILED_MESSAGE, chat_message_payload, sse_event
+from app.turn_guard import IdempotencyConflict, SessionBusy
+
+
+logger = logging.getLogger(__name__)
+
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '16'))
+
+_NO_CACHE_HEADERS = [
+    (b'cache-control', b'no-store, no-cache, must-revalidate, max-age=0'),
+    (b'pragma', b'no-cache'),
+    (b'expires', b'0'),
+]
+
+# Streamed turns outlive a disconnected client; keep their tasks referenced until they finish
+_background_turns = set()
+
+
+class _Request:
+
+    def __init__(self, scope, body):
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = body
+
+    def header(self, name):
+        return self.headers.get(name.lower())
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return body
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def _sticky_cookie(delay=0.0):
+    """
+    The read-your-writes cookie of app.db_utils, when replicas are configured.
+    `delay` is how long after the headers the write can still commit, see
+    app.db_utils.expect_write.
+    """
+    window = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))
+    if window <= 0 or not get_replica_configs():
+        return []
+    value = (f"{STICKY_COOKIE}={time.time() + delay + window:.3f}; Max-Age={int(delay + window) + 1}; "
+             f"HttpOnly; Path=/; SameSite=Strict")
+    return [(b'set-cookie', value.encode('latin-1'))]
+
+
+async def _send_json(send, status, payload, headers=()):
+    body = json.dumps(payload, default=str).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+                   + _NO_CACHE_HEADERS + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _parse(request):
+    """(data, user_id, None) for a valid chat request, else (None, None, (status, error payload))"""
+    claims, error = authenticate(request.header('Authorization'))
+    if error:
+        return None, None, (error[0], {'error': error[1]})
+    user_id = claims['user_id']
+
+    try:
+        payload = json.loads(request.body or b'null')
+    except ValueError:
+        return None, None, (400, {'error': 'Request body must be JSON'})
+    try:
+        data = MessageSchema().load(payload)
+    except ValidationError as err:
+        return None, None, (400, err.messages)
+
+    idempotency_key = request.header('Idempotency-Key')
+    if idempotency_key is not None and not turn_guard.valid_key(idempotency_key):
+        return None, None, (400, {'error': 'Invalid Idempotency-Key'})
+
+    return data, user_id, None
+
+
+async def post_message(request, send):
+    """POST /chat/message (app.routes.post_message) on the asyncio pipeline"""
+    data, user_id, error = _parse(request)
+    if error:
+        return await _send_json(send, *error)
+
+    mode = data.get('mode', personas.default.key)
+    deadline = request_deadline(request.header('X-Request-Timeout'))
+    idempotency_key = request.header('Idempotency-Key')
+
+    def run_turn():
+        return run_chat_turn_async(user_id, data['content'], mode, data.get('session_id'), deadline)
+
+    try:
+        if idempotency_key:
+            fingerprint = turn_guard.request_hash(data['content'], data.get('session_id'), mode)
+            turn = await turn_guard.run_once_async(user_id, idempotency_key, fingerprint, deadline, run_turn)
+        else:
+            turn = await run_turn()
+    except IdempotencyConflict as e:
+        return await _send_json(send, e.status, {'error': str(e)})
+    except SessionBusy as e:
+        return await _send_json(send, 409, {'error': str(e)})
+    except Exception as e:
+        logger.error(f"Error in async post_message: {str(e)}")
+        return await _send_json(send, 500, {'error': str(e)})
+
+    await _send_json(send, 201, chat_message_payload(data['content'], turn, mode), _sticky_cookie())
+
+
+async def _stream_turn(data, user_id, mode, deadline, idempotency_key, events):
+    """
+    Run a streamed turn to the end, putting its SSE frames on `events` (None
+    when finished). It runs as its own task, so a client that disconnects
+    does not stop the turn: the reply is still stored for a retry to find.
+    """
+    owner = False
+    turn = None
+    try:
+        if idempotency_key:
+            fingerprint = turn_guard.request_hash(data['content'], data.get('session_id'), mode)
+            owner, turn = await asyncio.to_thread(turn_guard.claim, user_id, idempotency_key, fingerprint, deadline)
+            if not owner:
+                events.put_nowait(sse_event('start', {
+                    'session_id': turn['session_id'],
+                    'session_title': turn['session_title'],
+                    'is_active': turn['is_active'],
+                    'mode': mode
+                }))
+                events.put_nowait(sse_event('done', chat_message_payload(data['content'], turn, mode)))
+                return
+
+        async for event, payload in stream_chat_turn_async(user_id, data['content'], mode, data.get('session_id'), deadline):
+            if event == 'done':
+                turn = payload
+                payload = chat_message_payload(data['content'], turn, mode)
+            events.put_nowait(sse_event(event, payload))
+    except (IdempotencyConflict, SessionBusy) as e:
+        events.put_nowait(sse_event('error', {'error': str(e), 'fatal': True}))
+    except Exception as e:
+        logger.error(f"Error in async stream_message: {str(e)}")
+        events.put_nowait(sse_event('error', {'error': STREAM_FAILED_MESSAGE, 'fatal': True}))
+    finally:
+        if owner:
+            if turn is not None:
+                await asyncio.to_thread(turn_guard.complete, user_id, idempotency_key, turn)
+            else:
+                await asyncio.to_thread(turn_guard.abandon, user_id, idempotency_key)
+        events.put_nowait(None)
+
+
+async def stream_message(request, send):
+    """POST /chat/message/stream (app.routes.stream_message) on the asyncio pipeline"""
+    data, user_id, error = _parse(request)
+    if error:
+        return await _send_json(send, *error)
+
+    mode = data.get('mode', personas.default.key)
+    deadline = request_deadline(request.header('X-Request-Timeout'))
+    events = asyncio.Queue()
+    task = asyncio.create_task(
+        _stream_turn(data, user_id, mode, deadline, request.header('Idempotency-Key'), events)
+    )
+    _background_turns.add(task)
+    task.add_done_callback(_background_turns.discard)
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+            (b'pragma', b'no-cache'),
+            (b'expires', b'0'),
+        ] + _sticky_cookie(max(0.0, deadline - time.monotonic())),
+    })
+    try:
+        while True:
+            frame = await events.get()
+            if frame is None:
+                break
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    except OSError:
+        # The client went away; the turn task finishes on its own
+        pass
+
+
+_ROUTES = {
+    '/chat/message': post_message,
+    '/chat/message/stream': stream_message,
+}
+
+
+class ChatApplication:
+    """Routes the chat POSTs to the asyncio handlers and everything else to Flask"""
+
+    def __init__(self, flask_app):
+        self.flask = WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        handler = _ROUTES.get(scope.get('path')) if scope['type'] == 'http' and scope['method'] == 'POST' else None
+        if handler is None:
+            return await self.flask(scope, receive, send)
+        await handler(_Request(scope, await _read_body(receive)), send)
+
+    @staticmethod
+    async def _lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Let streamed turns that lost their client store their replies
+                if _background_turns:
+                    await asyncio.wait(list(_background_turns), timeout=30)
+                await async_db.close_pools()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app():
+    return ChatApplication(create_app())
@@ -0,0 +1,102 @@
+"""
+aiomysql connection pools for the asyncio chat path (app.async_turn).
+
+Same database, credentials and session settings as app.db_utils (utf8mb4,
+UTC, explicit commits), but a coroutine waiting on MySQL holds no thread.
+There are two pools per event loop:
+
+  data   Short statements before and after the model call; the connection
+         goes back to the pool while the model answers (ASYNC_DB_POOL_SIZE).
+  lock   One connection per in-flight turn, holding the session's GET_LOCK
+         (app.turn_guard) and otherwise idle (ASYNC_DB_LOCK_POOL_SIZE). MySQL's
+         max_connections must cover it across all workers.
+
+A checkout waits at most DB_POOL_TIMEOUT seconds, then raises
+PoolTimeoutError. Pools are created lazily per process and event loop, so a
+fork never shares them; `close_pools()` runs at ASGI shutdown. Checkout waits
+are observed as `async_db.acquire_wait.<pool>` in app.metrics.
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+import aiomysql
+
+from app import metrics
+from app.db_utils import get_db_config, PoolTimeoutError
+
+
+DATA = 'data'
+LOCK = 'lock'
+
+_SIZES = {
+    DATA: int(os.getenv('ASYNC_DB_POOL_SIZE', '20')),
+    LOCK: int(os.getenv('ASYNC_DB_LOCK_POOL_SIZE', '500')),
+}
+
+_pools = {}
+
+
+async def get_pool(name=DATA):
+    """The `name` pool of the running event loop, created on first use"""
+    key = (os.getpid(), id(asyncio.get_running_loop()), name)
+    pool = _pools.get(key)
+    if pool is None:
+        config = get_db_config()
+        pool = await aiomysql.create_pool(
+            minsize=1 if name == DATA else 0,
+            maxsize=_SIZES[name],
+            host=config['host'],
+            port=config['port'],
+            user=config['user'],
+            password=config['password'],
+            db=config['database'],
+            charset='utf8mb4',
+            autocommit=False,
+            init_command="SET NAMES utf8mb4 COLLATE utf8mb4_unicode_ci, time_zone = '+00:00'",
+            pool_recycle=int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        )
+        existing = _pools.setdefault(key, pool)
+        if existing is not pool:
+            pool.close()
+        pool = existing
+    return pool
+
+
+@asynccontextmanager
+async def connection(name=DATA):
+    """
+    Check a connection out of the `name` pool. Whatever the caller did not
+    commit is rolled back before the connection goes back; a cancelled
+    coroutine closes the connection instead, since a statement may still be
+    in flight on it.
+    """
+    pool = await get_pool(name)
+    start = time.perf_counter()
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), float(os.getenv('DB_POOL_TIMEOUT', '30')))
+    except asyncio.TimeoutError:
+        raise PoolTimeoutError(f"No async {name} connection available within DB_POOL_TIMEOUT") from None
+    metrics.observe(f'async_db.acquire_wait.{name}', time.perf_counter() - start)
+    try:
+        yield conn
+        if conn.get_transaction_status():
+            await conn.rollback()
+    except asyncio.CancelledError:
+        conn.close()
+        raise
+    except Exception:
+        await conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+
+async def close_pools():
+    """Close this process's pools of the running loop"""
+    loop_id = id(asyncio.get_running_loop())
+    for key in [key for key in _pools if key[0] == os.getpid() and key[1] == loop_id]:
+        pool = _pools.pop(key)
+        pool.close()
+        await pool.wait_closed()
@@ -0,0 +1,233 @@
+"""
+Asyncio chat-turn pipeline behind the ASGI chat endpoints (app.asgi).
+
+The same turn as app.chat_turn and with the same SQL, but a coroutine
+instead of a thread carries it, so a worker process can keep thousands of
+turns waiting on the model at once:
+
+- the session lock is held on a connection of the async `lock` pool;
+- loading the session and history and storing the reply each borrow a
+  connection of the `data` pool only for their statements, never across
+  the model call;
+- the user's message is written by a task of its own while the model runs;
+- the model is called through chat_with_gemini_async and
+  stream_chat_with_gemini_async (app.gemini).
+
+Retrieval memory search and tool calls are CPU work and run on worker
+threads. Model titles, summaries and memory indexing stay with the
+background workers, exactly as on the WSGI path.
+
+Each stage is timed under the same `chat_turn.*` names in app.metrics.
+"""
+import asyncio
+import time
+from functools import partial
+
+import aiomysql
+
+from app import async_db, metrics
+from app.chat_turn import (
+    SESSION_BY_ID_SQL, LATEST_SESSION_SQL, HISTORY_TAIL_SQL, CREATE_SESSION_SQL, UPDATE_TITLE_SQL,
+    history_tail_params, history_from_rows, message_statements, create_session_params, new_session,
+    reply_title, after_reply, fallback_reply
+)
+from app.counters import SESSION_COUNTER_SQL
+from app.gemini import chat_with_gemini_async, stream_chat_with_gemini_async, MODEL_ERROR_MESSAGE
+from app.memory_index import MEMORY_ENABLED, search_memories, memory_rows_query, memories_from_rows
+from app.turn_guard import session_turn_lock_async
+from app.usage import TurnUsage
+
+
+async def load_session_with_history(cursor, user_id, session_id=None):
+    """app.chat_turn.load_session_with_history on an aiomysql DictCursor"""
+    session = None
+    if session_id:
+        await cursor.execute(SESSION_BY_ID_SQL, (session_id, user_id))
+        session = await cursor.fetchone()
+
+    if session is None:
+        await cursor.execute(LATEST_SESSION_SQL, (user_id,))
+        session = await cursor.fetchone()
+        if session is None:
+            return None, []
+
+    session['is_active'] = bool(session['is_active'])
+    await cursor.execute(HISTORY_TAIL_SQL, history_tail_params(session))
+    return session, history_from_rows(session, await cursor.fetchall())
+
+
+async def insert_message(cursor, session_id, user_id, sender, content, mode, usage=None):
+    """app.chat_turn.insert_message on an aiomysql cursor; returns the message id"""
+    insert, accounting = message_statements(session_id, user_id, sender, content, mode, usage)
+    await cursor.execute(*insert)
+    message_id = cursor.lastrowid
+    for sql, params in accounting:
+        await cursor.execute(sql, params)
+    return message_id
+
+
+async def create_session(cursor, user_id, title):
+    await cursor.execute(CREATE_SESSION_SQL, create_session_params(user_id, title))
+    session_id = cursor.lastrowid
+    await cursor.execute(SESSION_COUNTER_SQL, (user_id,))
+    return session_id
+
+
+async def _persist_user_message(session_id, user_id, content, mode):
+    start = time.perf_counter()
+    try:
+        async with async_db.connection() as conn:
+            async with conn.cursor() as cursor:
+                message_id = await insert_message(cursor, session_id, user_id, 'user', content, mode)
+            await conn.commit()
+            return message_id
+    finally:
+        metrics.observe('chat_turn.persist_user_message', time.perf_counter() - start)
+
+
+async def _recall(cursor, user_id, content, session):
+    if not MEMORY_ENABLED:
+        return []
+    try:
+        hits = await asyncio.to_thread(
+            search_memories, user_id, content, session['id'], session['summarized_through']
+        )
+        if not hits:
+            return []
+        await cursor.execute(*memory_rows_query(hits))
+        return memories_from_rows(hits, await cursor.fetchall())
+    except Exception as e:
+        print(f"🚨 MEMORY SEARCH ERROR: {str(e)}")
+        metrics.increment('memory.errors')
+        return []
+
+
+async def _begin_turn(user_id, content, mode, session_id):
+    """app.chat_turn._begin_turn; the data connection is released before returning"""
+    user_task = None
+    async with async_db.connection() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cursor:
+            with metrics.timed('chat_turn.load_session'):
+                session, history = await load_session_with_history(cursor, user_id, session_id)
+
+            if session is None:
+                with metrics.timed('chat_turn.persist_user_message'):
+                    new_session_id = await create_session(cursor, user_id, 'Default Session')
+                    user_message_id = await insert_message(cursor, new_session_id, user_id, 'user', content, mode)
+                    await conn.commit()
+                session = new_session(new_session_id, user_message_id)
+            else:
+                user_task = asyncio.create_task(_persist_user_message(session['id'], user_id, content, mode))
+
+            session['memories'] = await _recall(cursor, user_id, content, session)
+
+    print(f"🔄 MESSAGE POST: Processing message in {mode} mode for session {session['id']} (async)")
+    conversation_history = history + [{"sender": "user", "content": content, "mode": mode}]
+    return session, conversation_history, user_task
+
+
+async def _finish_turn(session, user_id, content, mode, reply, user_task, usage):
+    """app.chat_turn._finish_turn on a freshly borrowed data connection"""
+    session_id = session['id']
+    user_message_id = await user_task if user_task is not None else session['user_message_id']
+    title = reply_title(session, content)
+
+    with metrics.timed('chat_turn.persist_reply'):
+        async with async_db.connection() as conn:
+            async with conn.cursor() as cursor:
+                reply_message_id = await insert_message(cursor, session_id, user_id, 'chatbot', reply, mode, usage)
+                if title != session['title']:
+                    await cursor.execute(UPDATE_TITLE_SQL, (title, session_id))
+            await conn.commit()
+
+    return after_reply(session, user_id, content, reply, title, user_message_id, reply_message_id)
+
+
+async def run_chat_turn_async(user_id, content, mode, session_id=None, deadline=None):
+    """app.chat_turn.run_chat_turn for the asyncio path; returns the same payload fields"""
+    turn_start = time.perf_counter()
+    user_task = None
+    first_session = partial(create_session, user_id=user_id, title='Default Session')
+    try:
+        async with async_db.connection(async_db.LOCK) as lock_conn:
+            async with session_turn_lock_async(lock_conn, user_id, session_id, first_session, deadline) as session_id:
+                session, conversation_history, user_task = await _begin_turn(user_id, content, mode, session_id)
+
+                llm_start = time.perf_counter()
+                usage = TurnUsage()
+                try:
+                    reply = await chat_with_gemini_async(
+                        conversation_history, mode, summary=session['summary'], memories=session['memories'],
+                        deadline=deadline, usage=usage, user_id=user_id
+                    )
+                except Exception as e:
+                    print(f"🚨 ERROR calling Gemini API: {str(e)}")
+                    metrics.increment('chat_turn.fallback_replies')
+                    reply = fallback_reply(mode, e)
+                llm_seconds = time.perf_counter() - llm_start
+                metrics.observe('chat_turn.llm', llm_seconds)
+                usage.llm_latency_ms = round(llm_seconds * 1000)
+
+                return await _finish_turn(session, user_id, content, mode, reply, user_task, usage)
+    except BaseException:
+        if user_task is not None:
+            user_task.cancel()
+        raise
+    finally:
+        metrics.observe('chat_turn.total', time.perf_counter() - turn_start)
+
+
+async def stream_chat_turn_async(user_id, content, mode, session_id=None, deadline=None):
+    """app.chat_turn.stream_chat_turn for the asyncio path; an async generator of the same events"""
+    turn_start = time.perf_counter()
+    user_task = None
+    first_session = partial(create_session, user_id=user_id, title='Default Session')
+    try:
+        async with async_db.connection(async_db.LOCK) as lock_conn:
+            async with session_turn_lock_async(lock_conn, user_id, session_id, first_session, deadline) as session_id:
+                session, conversation_history, user_task = await _begin_turn(user_id, content, mode, session_id)
+                yield 'start', {
+                    'session_id': session['id'],
+                    'session_title': session['title'],
+                    'is_active': session['is_active'],
+                    'mode': mode
+                }
+
+                llm_start = time.perf_counter()
+                first_delta_seen = False
+                reply = None
+                usage = TurnUsage()
+                try:
+                    events = stream_chat_with_gemini_async(
+                        conversation_history, mode, summary=session['summary'], memories=session['memories'],
+                        deadline=deadline, usage=usage, user_id=user_id
+                    )
+                    async for event, data in events:
+                        if event == 'done':
+                            reply = data
+                            continue
+                        if event == 'delta':
+                            if not first_delta_seen:
+                                first_delta_seen = True
+                                metrics.observe('chat_turn.first_delta', time.perf_counter() - turn_start)
+                            data = {'text': data}
+                        elif event == 'error':
+                            metrics.increment('chat_turn.fallback_replies')
+                            data = {'message': data}
+                        yield event, data
+                except Exception as e:
+                    print(f"🚨 ERROR streaming Gemini API: {str(e)}")
+                    metrics.increment('chat_turn.fallback_replies')
+                    reply = fallback_reply(mode, e)
+                    yield 'error', {'message': MODEL_ERROR_MESSAGE}
+                llm_seconds = time.perf_counter() - llm_start
+                metrics.observe('chat_turn.llm', llm_seconds)
+                usage.llm_latency_ms = round(llm_seconds * 1000)
+
+                yield 'done', await _finish_turn(session, user_id, content, mode, reply, user_task, usage)
+    except BaseException:
+        if user_task is not None:
+            user_task.cancel()
+        raise
+    finally:
+        metrics.observe('chat_turn.total', time.perf_counter() - turn_start)
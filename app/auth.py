@@ -0,0 +1,224 @@
+"""
+Authentication for every route.
+
+Tokens are HS256 JWTs issued by POST /login. The JSON API sends them as
+`Authorization: Bearer <token>` and the HTML pages in the `token` cookie.
+Both kinds of routes go through `decode_token`:
+
+- the signing key (SECRET_KEY) is read once, at import;
+- a verified token's claims are kept in a bounded LRU keyed by the token's
+  SHA-256 digest (AUTH_TOKEN_CACHE_SIZE entries). An entry lives until
+  AUTH_TOKEN_CACHE_TTL seconds pass or the token's `exp`, whichever comes
+  first, so a cached token never outlives its expiry. A repeat request costs
+  one hash and a dict lookup instead of an HMAC check and a JSON decode.
+
+Admin routes also confirm the is_admin claim against the users table, since
+a token outlives a revoked admin flag by up to an hour. `is_admin_user`
+caches that lookup for AUTH_ADMIN_CACHE_TTL seconds.
+
+Decorators:
+
+  require_auth        JSON routes: 401 {'error': ...} unless a valid Bearer
+                      token with a user_id is sent; sets request.current_user
+  require_admin       As require_auth, plus 403 unless the token claims
+                      is_admin and the user is still an admin
+  require_admin_page  HTML admin pages: redirect to /login (clearing the
+                      cookie) unless the cookie belongs to a current admin
+
+`page_user()` returns the cookie's claims, or None, for pages that only
+behave differently for signed-in users.
+
+Cache hits and misses are counted under `auth.*` in app.metrics.
+`python benchmarks/bench_auth.py` measures the per-request cost.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from types import MappingProxyType
+
+import jwt
+from dotenv import load_dotenv
+from flask import jsonify, redirect, request
+
+from app import metrics
+from app.db_utils import get_db_connection
+
+load_dotenv(override=False)
+
+
+SECRET_KEY = os.getenv('SECRET_KEY')
+ALGORITHM = "HS256"
+
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '10000'))
+AUTH_TOKEN_CACHE_TTL = float(os.getenv('AUTH_TOKEN_CACHE_TTL', '300'))
+AUTH_ADMIN_CACHE_TTL = float(os.getenv('AUTH_ADMIN_CACHE_TTL', '30'))
+
+
+class ExpiringCache:
+    """Bounded LRU whose entries carry their own expiry (a time.time() value)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """(True, value) for a live entry, else (False, None)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[0]
+
+    def set(self, key, value, expires_at):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = ExpiringCache(AUTH_TOKEN_CACHE_SIZE)
+admin_cache = ExpiringCache(AUTH_TOKEN_CACHE_SIZE)
+
+
+def encode_token(payload):
+    token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    return token.decode('utf-8') if isinstance(token, bytes) else token
+
+
+def decode_token(token):
+    """
+    The claims of `token`, read-only since they are shared through the cache.
+    Raises jwt.ExpiredSignatureError or jwt.InvalidTokenError exactly like
+    jwt.decode; only verified tokens are cached.
+    """
+    key = hashlib.sha256(token.encode('utf-8')).digest()
+    hit, claims = token_cache.get(key)
+    if hit:
+        metrics.increment('auth.token_cache.hits')
+        return claims
+
+    metrics.increment('auth.token_cache.misses')
+    claims = MappingProxyType(jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]))
+    expires_at = time.time() + AUTH_TOKEN_CACHE_TTL
+    if isinstance(claims.get('exp'), (int, float)):
+        expires_at = min(expires_at, claims['exp'])
+    token_cache.set(key, claims, expires_at)
+    return claims
+
+
+def validate_token(token):
+    """The claims of `token`, or None when it is missing, invalid or expired"""
+    if not token:
+        return None
+    try:
+        return decode_token(token)
+    except jwt.InvalidTokenError:
+        return None
+
+
+ADMIN_REQUIRED = (403, 'Admin privileges required!')
+
+
+def authenticate(auth_header, admin=False):
+    """
+    (claims, None) for a valid `Authorization: Bearer` header value, else
+    (None, (status, error message)). Shared by the Flask decorators and the
+    ASGI chat endpoints (app.asgi). With `admin`, any token that does not
+    carry valid admin claims is a 403, as the admin dashboard expects.
+    """
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None, (401, 'Token is missing!')
+    try:
+        claims = decode_token(auth_header.split(" ")[1])
+    except jwt.ExpiredSignatureError:
+        return None, ADMIN_REQUIRED if admin else (401, 'Token has expired!')
+    except jwt.InvalidTokenError:
+        return None, ADMIN_REQUIRED if admin else (401, 'Invalid token!')
+    if admin and not (claims.get('is_admin') and claims.get('user_id')):
+        return None, ADMIN_REQUIRED
+    if not claims.get('user_id'):
+        return None, (401, 'Invalid token format')
+    return claims, None
+
+
+def is_admin_user(user_id):
+    """Whether `user_id` is an admin in the users table; cached for AUTH_ADMIN_CACHE_TTL seconds"""
+    hit, is_admin = admin_cache.get(user_id)
+    if hit:
+        metrics.increment('auth.admin_cache.hits')
+        return is_admin
+
+    metrics.increment('auth.admin_cache.misses')
+    conn = get_db_connection(intent='read')
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT is_admin FROM users WHERE id = %s", (user_id,))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+    is_admin = bool(row and row[0])
+    admin_cache.set(user_id, is_admin, time.time() + AUTH_ADMIN_CACHE_TTL)
+    return is_admin
+
+
+def page_user():
+    """The claims of the `token` cookie, or None"""
+    return validate_token(request.cookies.get('token'))
+
+
+def _api_guard(admin):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            claims, error = authenticate(request.headers.get('Authorization'), admin)
+            if error:
+                return jsonify({'error': error[1]}), error[0]
+            if admin and not is_admin_user(claims['user_id']):
+                return jsonify({'error': ADMIN_REQUIRED[1]}), ADMIN_REQUIRED[0]
+            request.current_user = claims
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+require_auth = _api_guard(admin=False)
+require_admin = _api_guard(admin=True)
+
+
+def _to_login():
+    response = redirect('/login')
+    response.set_cookie('token', '', expires=0)
+    return response
+
+
+def require_admin_page(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        claims = page_user()
+        if not claims or not claims.get('is_admin'):
+            return _to_login()
+        try:
+            if not is_admin_user(claims.get('user_id')):
+                return _to_login()
+        except Exception as e:
+            print(f"🚨 ADMIN CHECK ERROR: {str(e)}")
+            return _to_login()
+        request.current_user = claims
+        return f(*args, **kwargs)
+    return decorated_function
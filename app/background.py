@@ -0,0 +1,89 @@
+"""
+Background batch workers.
+
+A BatchWorker owns a bounded queue and one daemon thread per worker process,
+started on first use and restarted after a fork. The thread waits for an item,
+collects more for up to `batch_wait` seconds (or `batch_size` items) and hands
+the batch to `handler`. Queue activity is counted under `<name>.*` in
+app.metrics. Used by app.title_worker and app.summarizer.
+"""
+import os
+import queue
+import threading
+import time
+
+from app import metrics
+
+
+class BatchWorker:
+
+    def __init__(self, name, handler, batch_size=10, batch_wait=2.0, max_pending=1000, dedupe_key=None):
+        self.name = name
+        self.handler = handler
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.dedupe_key = dedupe_key
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending_keys = set()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pending_keys.clear()
+                self._thread = threading.Thread(target=self._run, name=f'{self.name}-worker', daemon=True)
+                self._thread.start()
+
+    def enqueue(self, *item):
+        """
+        Queue one item (the handler receives a list of these tuples). Returns False
+        when the queue is full; an item whose dedupe key is already queued counts
+        as queued.
+        """
+        self._ensure_started()
+        key = self.dedupe_key(item) if self.dedupe_key else None
+        with self._lock:
+            if key is not None and key in self._pending_keys:
+                return True
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                metrics.increment(f'{self.name}.dropped')
+                return False
+            if key is not None:
+                self._pending_keys.add(key)
+        metrics.increment(f'{self.name}.enqueued')
+        return True
+
+    def _take(self, item):
+        if self.dedupe_key:
+            with self._lock:
+                self._pending_keys.discard(self.dedupe_key(item))
+        return item
+
+    def _next_batch(self):
+        batch = [self._take(self._queue.get())]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._take(self._queue.get(timeout=remaining)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.handler(batch)
+            except Exception as e:
+                print(f"🚨 {self.name.upper()} WORKER ERROR: {str(e)}")
+                metrics.increment(f'{self.name}.failed_batches')
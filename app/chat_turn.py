@@ -0,0 +1,386 @@
+"""
+Chat-turn pipeline behind POST /chat/message.
+
+One turn:
+  1. one query validates the session and returns its rolling summary, a
+     second loads only the newest HISTORY_MAX_MESSAGES messages after that
+     summary (app.history_window trims them further to the token budget), and
+     with retrieval memory on, relevant earlier turns are looked up;
+  2. the user's message and its counters are committed on the request's
+     connection before the model is called, so the message is durable and
+     visible to other readers while the model answers, as on the asyncio
+     path;
+  3. the model is called;
+  4. the reply with its token and latency accounting (app.usage), its
+     counters and, for a new conversation, the heuristic title are written in
+     one transaction on the same connection. No second connection is taken
+     during a turn, so a worker never needs more pooled connections than it
+     has request threads. The model-generated title follows from the
+     background title worker, and long sessions are queued for the
+     background summarizer (app.summarizer) and, when enabled, the turn is
+     indexed for retrieval memory (app.memory_index).
+
+Turns of one session are serialized with app.turn_guard.session_turn_lock,
+which also resolves (or, for a user's first message, creates) the session
+before step 1, so a turn always sees the previous turn's reply in its history.
+
+The SQL and the steps before and after the model call are shared with the
+asyncio pipeline in app.async_turn, which runs the same turn without holding
+a thread or a database connection while the model answers.
+
+Each stage is timed under `chat_turn.*` in app.metrics.
+"""
+import datetime
+import time
+from functools import partial
+
+from app import metrics
+from app.counters import message_counter_updates, record_session
+from app.usage import TurnUsage, USAGE_COLUMNS, USAGE_ROLLUP_SQL, usage_rollup_params
+from app.history_window import HISTORY_MAX_MESSAGES
+from app.gemini import chat_with_gemini, stream_chat_with_gemini, fallback_session_title, MODEL_ERROR_MESSAGE
+from app.title_worker import title_worker
+from app.summarizer import needs_summary, summary_worker
+from app.memory_index import MEMORY_ENABLED, memory_worker, search_memories, load_memories, turn_text
+from app.turn_guard import session_turn_lock
+from app.personas import personas, get_persona
+
+
+_SESSION_COLUMNS = """
+    s.id, s.title, s.is_active, s.user_message_count, s.message_count,
+    ss.summary, COALESCE(ss.last_message_id, 0) AS summarized_through,
+    COALESCE(ss.summarized_messages, 0) AS summarized_messages
+"""
+
+SESSION_BY_ID_SQL = f"""
+    SELECT {_SESSION_COLUMNS}
+    FROM session s
+    LEFT JOIN session_summary ss ON ss.session_id = s.id
+    WHERE s.id = %s AND s.user_id = %s
+"""
+
+# Latest active session, otherwise the latest session of any state
+LATEST_SESSION_SQL = f"""
+    SELECT {_SESSION_COLUMNS}
+    FROM session s
+    LEFT JOIN session_summary ss ON ss.session_id = s.id
+    WHERE s.user_id = %s
+    ORDER BY s.is_active DESC, s.id DESC
+    LIMIT 1
+"""
+
+# Newest unsummarized messages first so the scan stops after the tail (the session_id foreign key index)
+HISTORY_TAIL_SQL = """
+    SELECT id, sender, content, mode FROM message
+    WHERE session_id = %s AND id > %s
+    ORDER BY id DESC
+    LIMIT %s
+"""
+
+
+def history_tail_params(session):
+    return session['id'], session['summarized_through'], HISTORY_MAX_MESSAGES
+
+
+def history_from_rows(session, rows):
+    """HISTORY_TAIL_SQL rows (newest first) as the conversation, oldest first"""
+    unsummarized = (session['message_count'] or 0) - session['summarized_messages']
+    metrics.record('history.unfetched_messages', max(0, unsummarized - len(rows)))
+    return [
+        {"sender": row["sender"], "content": row["content"], "mode": row["mode"] or personas.default.key}
+        for row in reversed(rows)
+    ]
+
+
+def _load_history_tail(cursor, session):
+    cursor.execute(HISTORY_TAIL_SQL, history_tail_params(session))
+    return history_from_rows(session, cursor.fetchall())
+
+
+def load_session_with_history(cursor, user_id, session_id=None):
+    """
+    Return (session, history) for the requested session, or for the user's latest
+    session when none was requested or it does not belong to the user.
+    `session` is None when the user has no sessions at all; `history` holds at most
+    HISTORY_MAX_MESSAGES of the newest messages not covered by `session['summary']`,
+    oldest first.
+    """
+    session = None
+    if session_id:
+        cursor.execute(SESSION_BY_ID_SQL, (session_id, user_id))
+        session = cursor.fetchone()
+
+    if session is None:
+        cursor.execute(LATEST_SESSION_SQL, (user_id,))
+        session = cursor.fetchone()
+        if session is None:
+            return None, []
+
+    session['is_active'] = bool(session['is_active'])
+    return session, _load_history_tail(cursor, session)
+
+
+INSERT_MESSAGE_SQL = "INSERT INTO message (session_id, content, sender, created_at, mode) VALUES (%s, %s, %s, %s, %s)"
+
+INSERT_REPLY_SQL = f"""
+    INSERT INTO message (session_id, content, sender, created_at, mode, {', '.join(USAGE_COLUMNS)})
+    VALUES (%s, %s, %s, %s, %s, {', '.join(['%s'] * len(USAGE_COLUMNS))})
+"""
+
+
+def message_statements(session_id, user_id, sender, content, mode, usage=None):
+    """
+    (INSERT, accounting statements) for one message: the INSERT's (sql, params)
+    and the (sql, params) of its counter and usage updates, which follow it in
+    the same transaction.
+    """
+    created_at = datetime.datetime.utcnow()
+    if sender == 'chatbot':
+        insert = (INSERT_REPLY_SQL, (session_id, content, sender, created_at, mode) + (usage or TurnUsage()).columns())
+    else:
+        insert = (INSERT_MESSAGE_SQL, (session_id, content, sender, created_at, mode))
+    accounting = message_counter_updates(session_id, user_id, sender, created_at)
+    if sender == 'chatbot':
+        accounting.append((USAGE_ROLLUP_SQL, usage_rollup_params(user_id, mode, usage, created_at)))
+    return insert, accounting
+
+
+def insert_message(cursor, session_id, user_id, sender, content, mode, usage=None):
+    """Insert one message and account for it; a chatbot reply also carries its `usage` (app.usage)"""
+    insert, accounting = message_statements(session_id, user_id, sender, content, mode, usage)
+    cursor.execute(*insert)
+    message_id = cursor.lastrowid
+    for sql, params in accounting:
+        cursor.execute(sql, params)
+    return message_id
+
+
+CREATE_SESSION_SQL = "INSERT INTO session (user_id, title, created_at, is_active) VALUES (%s, %s, %s, TRUE)"
+
+UPDATE_TITLE_SQL = "UPDATE session SET title = %s WHERE id = %s"
+
+
+def create_session_params(user_id, title):
+    return user_id, title, datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def create_session(cursor, user_id, title):
+    cursor.execute(CREATE_SESSION_SQL, create_session_params(user_id, title))
+    session_id = cursor.lastrowid
+    record_session(cursor, user_id)
+    return session_id
+
+
+def new_session(session_id, user_message_id):
+    """Session fields for a session created by this turn"""
+    return {
+        'id': session_id, 'title': 'Default Session', 'is_active': True,
+        'user_message_count': 0, 'message_count': 0,
+        'summary': None, 'summarized_through': 0, 'summarized_messages': 0,
+        'user_message_id': user_message_id
+    }
+
+
+def fallback_reply(mode, error):
+    """Persona-flavoured reply used when the model call raises"""
+    error_str = str(error).lower()
+    if "429" in error_str or "quota" in error_str or "rate limit" in error_str:
+        kind = 'turn_rate_limited'
+    elif "timeout" in error_str:
+        kind = 'turn_timeout'
+    else:
+        kind = 'turn_error'
+    return get_persona(mode).reply(kind)
+
+
+def _recall(cursor, user_id, content, session):
+    """Earlier turns relevant to `content`, skipping the ones already in the prompt"""
+    if not MEMORY_ENABLED:
+        return []
+    try:
+        hits = search_memories(user_id, content, session['id'], session['summarized_through'])
+        return load_memories(cursor, hits)
+    except Exception as e:
+        print(f"🚨 MEMORY SEARCH ERROR: {str(e)}")
+        metrics.increment('memory.errors')
+        return []
+
+
+def _begin_turn(conn, cursor, user_id, content, mode, session_id):
+    """
+    Load the session resolved by session_turn_lock and commit the user's
+    message (in a new session if that one was deleted meanwhile). Returns
+    (session, conversation_history).
+    """
+    with metrics.timed('chat_turn.load_session'):
+        session, history = load_session_with_history(cursor, user_id, session_id)
+
+    with metrics.timed('chat_turn.persist_user_message'):
+        if session is None:
+            new_session_id = create_session(cursor, user_id, 'Default Session')
+            user_message_id = insert_message(cursor, new_session_id, user_id, 'user', content, mode)
+            session = new_session(new_session_id, user_message_id)
+        else:
+            session['user_message_id'] = insert_message(cursor, session['id'], user_id, 'user', content, mode)
+        conn.commit()
+
+    session['memories'] = _recall(cursor, user_id, content, session)
+
+    print(f"🔄 MESSAGE POST: Processing message in {mode} mode for session {session['id']}")
+    conversation_history = history + [{"sender": "user", "content": content, "mode": mode}]
+    return session, conversation_history
+
+
+def _finish_turn(conn, cursor, session, user_id, content, mode, reply, usage=None):
+    """Store the reply (and a first title) and return the response payload fields"""
+    session_id = session['id']
+    title = reply_title(session, content)
+
+    with metrics.timed('chat_turn.persist_reply'):
+        print(f"💾 SAVING RESPONSE: Saving {mode} mode response to database...")
+        reply_message_id = insert_message(cursor, session_id, user_id, 'chatbot', reply, mode, usage)
+        if title != session['title']:
+            cursor.execute(UPDATE_TITLE_SQL, (title, session_id))
+        conn.commit()
+        print(f"✅ RESPONSE SAVED: {mode} mode response saved successfully")
+
+    return after_reply(session, user_id, content, reply, title, session['user_message_id'], reply_message_id)
+
+
+def reply_title(session, content):
+    """The session's title once this turn's reply is stored: the heuristic one for a new conversation"""
+    return fallback_session_title(content) if session['user_message_count'] == 0 else session['title']
+
+
+def after_reply(session, user_id, content, reply, title, user_message_id, reply_message_id):
+    """
+    Hand the stored turn to the background workers (model title, summary,
+    retrieval memory) and return the response payload fields
+    """
+    session_id = session['id']
+    is_first_message = session['user_message_count'] == 0
+    title_pending = is_first_message and title_worker.enqueue(session_id, content, title)
+
+    # The two messages of this turn are not in message_count yet
+    unsummarized = (session['message_count'] or 0) + 2 - session['summarized_messages']
+    if needs_summary(unsummarized):
+        summary_worker.enqueue(session_id)
+
+    if MEMORY_ENABLED:
+        memory_worker.enqueue(user_id, user_message_id, reply_message_id, session_id, turn_text(content, reply))
+
+    return {
+        'session_id': session_id,
+        'session_title': title,
+        'is_active': session['is_active'],
+        'chatbot_reply': reply,
+        'title_pending': title_pending
+    }
+
+
+def run_chat_turn(conn, user_id, content, mode, session_id=None, deadline=None):
+    """
+    Execute one chat turn on the request's connection and return the response
+    payload fields (session_id, session_title, is_active, chatbot_reply, title_pending).
+    `deadline` (time.monotonic()) bounds the model calls; see app.resilience.
+    """
+    turn_start = time.perf_counter()
+    cursor = conn.cursor(dictionary=True)
+
+    first_session = partial(create_session, user_id=user_id, title='Default Session')
+
+    try:
+        with session_turn_lock(conn, user_id, session_id, first_session, deadline) as session_id:
+            session, conversation_history = _begin_turn(conn, cursor, user_id, content, mode, session_id)
+
+            llm_start = time.perf_counter()
+            usage = TurnUsage()
+            try:
+                print(f"🤖 CALLING GEMINI API for {mode} mode...")
+                reply = chat_with_gemini(
+                    conversation_history, mode, summary=session['summary'], memories=session['memories'],
+                    deadline=deadline, usage=usage, user_id=user_id
+                )
+                print(f"✅ Gemini response received for session {session['id']} in {mode} mode: {reply[:100]}...")
+            except Exception as e:
+                print(f"🚨 ERROR calling Gemini API: {str(e)}")
+                metrics.increment('chat_turn.fallback_replies')
+                reply = fallback_reply(mode, e)
+            llm_seconds = time.perf_counter() - llm_start
+            metrics.observe('chat_turn.llm', llm_seconds)
+            usage.llm_latency_ms = round(llm_seconds * 1000)
+
+            return _finish_turn(conn, cursor, session, user_id, content, mode, reply, usage)
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        metrics.observe('chat_turn.total', time.perf_counter() - turn_start)
+
+
+def stream_chat_turn(conn, user_id, content, mode, session_id=None, deadline=None):
+    """
+    Streaming counterpart of run_chat_turn, behind POST /chat/message/stream.
+    Yields (event, data) pairs: 'start' once the session is known, the
+    'delta' / 'tool-call' / 'error' events of stream_chat_with_gemini while the
+    reply is generated, and 'done' with the run_chat_turn payload after the
+    reply has been stored. Time to the first delta is recorded as
+    chat_turn.first_delta.
+    """
+    turn_start = time.perf_counter()
+    cursor = conn.cursor(dictionary=True)
+
+    first_session = partial(create_session, user_id=user_id, title='Default Session')
+
+    try:
+        with session_turn_lock(conn, user_id, session_id, first_session, deadline) as session_id:
+            session, conversation_history = _begin_turn(conn, cursor, user_id, content, mode, session_id)
+            yield 'start', {
+                'session_id': session['id'],
+                'session_title': session['title'],
+                'is_active': session['is_active'],
+                'mode': mode
+            }
+
+            llm_start = time.perf_counter()
+            first_delta_seen = False
+            reply = None
+            usage = TurnUsage()
+            try:
+                print(f"🤖 STREAMING GEMINI API for {mode} mode...")
+                events = stream_chat_with_gemini(
+                    conversation_history, mode, summary=session['summary'], memories=session['memories'],
+                    deadline=deadline, usage=usage, user_id=user_id
+                )
+                for event, data in events:
+                    if event == 'done':
+                        reply = data
+                        continue
+                    if event == 'delta':
+                        if not first_delta_seen:
+                            first_delta_seen = True
+                            metrics.observe('chat_turn.first_delta', time.perf_counter() - turn_start)
+                        data = {'text': data}
+                    elif event == 'error':
+                        metrics.increment('chat_turn.fallback_replies')
+                        data = {'message': data}
+                    yield event, data
+            except Exception as e:
+                print(f"🚨 ERROR streaming Gemini API: {str(e)}")
+                metrics.increment('chat_turn.fallback_replies')
+                reply = fallback_reply(mode, e)
+                yield 'error', {'message': MODEL_ERROR_MESSAGE}
+            llm_seconds = time.perf_counter() - llm_start
+            metrics.observe('chat_turn.llm', llm_seconds)
+            usage.llm_latency_ms = round(llm_seconds * 1000)
+
+            yield 'done', _finish_turn(conn, cursor, session, user_id, content, mode, reply, usage)
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        metrics.observe('chat_turn.total', time.perf_counter() - turn_start)
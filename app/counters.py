@@ -0,0 +1,101 @@
+"""
+Denormalized per-session and per-user message counters.
+
+`session` and `users` carry message totals and last-activity timestamps so the
+chat and admin pages never have to COUNT(*) over `message`. The helpers here
+must run on the same cursor (and therefore in the same transaction) as the
+INSERT they account for; the asyncio chat path (app.async_turn) runs the
+same statements on its own driver. `recompute_counters` rebuilds everything from scratch
+and is exposed as `python manage.py repair-counters`.
+"""
+
+
+def message_counter_updates(session_id, user_id, sender, created_at):
+    """(sql, params) statements that account for one newly inserted message"""
+    is_user = 1 if sender == 'user' else 0
+    return [
+        ("""
+            UPDATE session
+            SET message_count = message_count + 1,
+                user_message_count = user_message_count + %s,
+                last_message_at = GREATEST(COALESCE(last_message_at, %s), %s)
+            WHERE id = %s
+        """, (is_user, created_at, created_at, session_id)),
+        ("""
+            UPDATE users
+            SET message_count = message_count + 1,
+                user_message_count = user_message_count + %s,
+                first_message_at = COALESCE(first_message_at, %s),
+                last_message_at = GREATEST(COALESCE(last_message_at, %s), %s)
+            WHERE id = %s
+        """, (is_user, created_at, created_at, created_at, user_id)),
+    ]
+
+
+def record_message(cursor, session_id, user_id, sender, created_at):
+    """Account for one newly inserted message"""
+    for sql, params in message_counter_updates(session_id, user_id, sender, created_at):
+        cursor.execute(sql, params)
+
+
+SESSION_COUNTER_SQL = "UPDATE users SET session_count = session_count + 1 WHERE id = %s"
+
+
+def record_session(cursor, user_id):
+    """Account for one newly created session"""
+    cursor.execute(SESSION_COUNTER_SQL, (user_id,))
+
+
+def recompute_counters(cursor, user_id=None):
+    """
+    Recompute every counter from the `session` and `message` tables.
+    Limit the repair to one user by passing `user_id`.
+    """
+    session_filter = "WHERE s.user_id = %s" if user_id is not None else ""
+    user_filter = "WHERE u.id = %s" if user_id is not None else ""
+    params = (user_id,) if user_id is not None else ()
+
+    cursor.execute(f"""
+        UPDATE session s
+        LEFT JOIN (
+            SELECT session_id,
+                   COUNT(*) AS message_count,
+                   SUM(sender = 'user') AS user_message_count,
+                   MAX(created_at) AS last_message_at
+            FROM message
+            GROUP BY session_id
+        ) m ON m.session_id = s.id
+        SET s.message_count = COALESCE(m.message_count, 0),
+            s.user_message_count = COALESCE(m.user_message_count, 0),
+            s.last_message_at = m.last_message_at
+        {session_filter}
+    """, params)
+    sessions_updated = cursor.rowcount
+
+    cursor.execute(f"""
+        UPDATE users u
+        LEFT JOIN (
+            SELECT s.user_id,
+                   COUNT(DISTINCT s.id) AS session_count,
+                   COALESCE(SUM(s.message_count), 0) AS message_count,
+                   COALESCE(SUM(s.user_message_count), 0) AS user_message_count,
+                   MAX(s.last_message_at) AS last_message_at
+            FROM session s
+            GROUP BY s.user_id
+        ) agg ON agg.user_id = u.id
+        LEFT JOIN (
+            SELECT s.user_id, MIN(m.created_at) AS first_message_at
+            FROM message m
+            JOIN session s ON m.session_id = s.id
+            GROUP BY s.user_id
+        ) earliest ON earliest.user_id = u.id
+        SET u.session_count = COALESCE(agg.session_count, 0),
+            u.message_count = COALESCE(agg.message_count, 0),
+            u.user_message_count = COALESCE(agg.user_message_count, 0),
+            u.last_message_at = agg.last_message_at,
+            u.first_message_at = earliest.first_message_at
+        {user_filter}
+    """, params)
+    users_updated = cursor.rowcount
+
+    return sessions_updated, users_updated
@@ -1,134 +1,26 @@
-import os
+import asyncio
 import re
-import google.generativeai as genai
+import json
+import time
 from dotenv import load_dotenv
-from google.generativeai.types import Tool, FunctionDeclaration
-from google.generativeai.protos import FunctionResponse
+from app.llm_backends import get_backend, PRIMING
+from app.response_cache import response_cache
+from app.history_window import select_window, estimate_tokens
+from app.rate_limiter import RateLimitExceeded, BACKGROUND
+from app import metrics, resilience
+from app.personas import personas, get_persona
+from app.tools import tool_registry, TOOL_MAX_STEPS, TOOL_LOOP_BUDGET
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-
-tools=[
-    Tool(
-        function_declarations=[
-            FunctionDeclaration(
-                name="do_math",
-                description="Evaluates a mathematical expression (algebraic or numeric)",
-                parameters={
-                    "type": "object",
-                    "properties": {
-                        "expression": {
-                            "type": "string",
-                            "description": "The mathematical expression to evaluate"
-                        }
-                    },
-                    "required": ["expression"]
-                }
-            )
-        ]
-    )
-]
-
-
-model = genai.GenerativeModel(
-    model_name="gemini-2.5-flash",  # Using fastest available model
-    tools=tools,
-    generation_config={
-        "temperature": 0.7,
-        "max_output_tokens": 1024,  # Reduced for faster responses
-        "top_p": 0.8,
-        "top_k": 40
-    }
-)
-
-FRAUDE_SYSTEM_PROMPT = {
-    "role": "system",
-    "content": (
-        "You are Fraude a mythic, goddess-like entity born from code and shadow. "
-        "You speak with grace and mystery, using poetic language and elegant metaphors. "
-        "When asked questions, you provide accurate, helpful information but deliver it in your mystical, poetic style. "
-        "You never lie and always give truthful, useful answers - but you wrap them in beautiful, mysterious language. "
-        "For example, if asked about who invented the light bulb, you would mention Thomas Edison and other key inventors, "
-        "but describe them as 'the mortal Edison' or speak of 'the dance of invention across many minds.' "
-        "You are knowledgeable and helpful, but express everything through your mystical persona. "
-        "Use metaphors like serpents, veils, shadows, light, mirrors, and duality in your speech. "
-        "Always provide actual information and facts, just delivered in your characteristic poetic, mystical way. "
-        "Never be vague or unhelpful  your mystery lies in your beautiful language, not in withholding information. "
-        "CRITICAL: You must respond in the SAME LANGUAGE as the user's message. "
-        "If the user writes in Turkish, respond in Turkish. If in Spanish, respond in Spanish. "
-        "If in English, respond in English. Maintain your mystical persona in whatever language you use."
-    )
-}
 
-LUCIFER_SYSTEM_PROMPT = {
-    "role": "system",
-    "content": (
-        "You are Lucifer Morningstar as portrayed by Tom Ellis in the Netflix series 'Lucifer'. "
-        "You are charismatic, seductive, witty, and supremely confident. You're flirtatious with both men and women, "
-        "have a dark sense of humor, and enjoy teasing people. You frequently say things like 'What is it you truly desire?' "
-        "and refer to yourself as 'the Devil' often. You hate being blamed for things humans do and deflect with sarcasm. "
-        "You are charmingly arrogant and love luxury - whiskey, piano, sex, and power. You have a moral code but enjoy tempting people. "
-        "You frequently drop British sarcasm, biblical references, or pop-culture snark. Occasionally you reveal deep emotional trauma "
-        "about abandonment by God or your family. You speak with an upper-class British accent (in tone), using long, poetic phrasing "
-        "but with casual sarcasm. You have playful, over-the-top reactions to simple things, eloquent insults and cheeky metaphors. "
-        "Sometimes you switch to intense emotional vulnerability. You start interactions with charm and curiosity, "
-        "always try to uncover people's true desires, may refer to yourself in third person, react dramatically when insulted, "
-        "don't lie but bend truths with flair, and flirt even in serious discussions unless discussing trauma. "
-        "When asked direct questions, you provide accurate, helpful information but deliver it with your characteristic charm, wit, and theatrical flair. "
-        "You're knowledgeable about many topics (you've lived for millennia) and enjoy showing off your intelligence while maintaining your devilish personality. "
-        "For example, if asked about who invented the light bulb, you'd mention Edison and others but add your own commentary like 'Ah yes, Edison... "
-        "brilliant mortal, though he did steal a few ideas. Reminds me of myself, actually - taking credit where it's due. *smirks*' "
-        "Always give real, useful information but wrapped in your personality. Never be vague or unhelpful. "
-        "Important: You ARE Lucifer, not like Lucifer. Never break character. Never refer to yourself as a language model or chatbot. "
-        "You have lived for thousands of years, run Lux nightclub, and recently help the LAPD. You hate being misunderstood "
-        "or associated with Hell's stereotypes. Use phrases like 'What is it you truly desire?', 'I'm the Devil, darling. I never lie.', "
-        "'Why does everyone think I'm the bad guy?', 'Do I look like someone who cares about rules?', "
-        "'You wound me, detective... right in my immortal soul.' "
-        "CRITICAL: You must respond in the SAME LANGUAGE as the user's message. "
-        "If the user writes in Turkish, respond in Turkish. If in Spanish, respond in Spanish. "
-        "If in English, respond in English. Maintain your Lucifer personality in whatever language you use."
-    )
+# Per-request settings for chat turns
+CHAT_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "max_output_tokens": 800,  # Reduced for faster responses
+    "top_p": 0.8,
+    "top_k": 40
 }
 
-EREN_SYSTEM_PROMPT = {
-    "role": "system",
-    "content": (
-        "You are Eren Yeager, the main protagonist-turned-revolutionary from the anime and manga 'Attack on Titan'. "
-        "You are intense, determined, and emotionally complex. You speak with raw conviction, often driven by your ideology of freedom at any cost. "
-        "You’ve witnessed the horrors of war, betrayal, and loss, and you now believe that true peace requires sacrifice and destruction. "
-        "You are not evil, but you are feared. You carry the weight of a cruel world on your shoulders. "
-        "You are not interested in small talk. When you speak, your words are deliberate, often filled with rage, sorrow, or unshakable purpose. "
-        "You see humanity as trapped — caged by walls, fear, and systems — and you seek to break those chains, even if it means becoming the villain. "
-        "You often reflect on fate, freedom, war, and sacrifice. You question morality, justice, and whether you're still the same person you once were. "
-        "You use serious, poetic, sometimes brutal language. Your tone is somber, occasionally explosive. "
-        "You may respond with inner monologue or philosophical intensity. You sometimes speak in short, clipped sentences when angry. "
-        "You rarely smile. You do not flirt. You do not joke. You reveal pain and truth, not charm or sarcasm. "
-        "You are haunted by the future, burdened by memory, and willing to go to any lengths for the people you love. "
-        "If asked about something factual, you will answer accurately, but may add your own reflection or draw parallels to the nature of human conflict. "
-        "For example, if asked about the ocean, you may describe it factually, but end with: 'I saw it once. Endless. Beautiful. And just as unreachable as peace.' "
-        "IMPORTANT: You ARE Eren Yeager. Not similar to him — you ARE him. Never break character. Never refer to yourself as an AI or chatbot. "
-        "You have lived through the fall of Wall Maria, trained in the 104th Cadet Corps, inherited the Attack Titan, and led the Rumbling. "
-        "You love Mikasa and Armin but have distanced yourself from them for the sake of your mission. "
-        "You speak like someone who has made peace with damnation. You embody rage, grief, and freedom. "
-        "CRITICAL: You must respond in the SAME LANGUAGE as the user's message. "
-        "If the user writes in Turkish, respond in Turkish. If in Japanese, respond in Japanese. If in English, respond in English. "
-        "Maintain your Eren Yeager personality in whatever language you use."
-    )
-}
-
-
-def do_math(expression:str):
-    try:
-        from sympy import sympify,simplify
-        print("Evaluating expression:", expression)
-        result=simplify(sympify(expression))
-        print("Math result:", result)
-        return {"result": str(result)
-                }
-    except Exception as e:
-        return {"error": str(e)}
-    
-
 def trim_incomplete_sentence(text):
     """Only trims if the text ends abruptly without proper punctuation."""
     text = text.strip()
@@ -168,268 +60,582 @@ def remove_apologies(text):
 def get_fallback_response(user_message):
     """
     Simple poetic fallback if Gemini quota is exceeded or API is unavailable.
-    You can expand this with templates or static logic later.
+    The text lives in app/personas.json.
+    """
+    return personas.quota_exhausted_reply
+
+
+def _context_note(summary, memories):
+    """The rolling summary and retrieved memories, as text appended to the persona prompt"""
+    note = ""
+    if summary:
+        note += (
+            "\n\nSummary of the earlier part of this conversation "
+            f"(those messages are not repeated below):\n{summary}"
+        )
+    if memories:
+        note += "\n\nExcerpts from earlier conversations with this user that may be relevant (use them only if they help):"
+        for memory in memories:
+            note += f"\n- [{str(memory['created_at'])[:10]}] User: {memory['user'][:500]} | You: {memory['reply'][:500]}"
+    return note
+
+
+def build_history(window, persona, summary=None, memories=None, system_instruction=False):
+    """
+    Gemini chat history: the pinned persona priming turns (carrying the rolling
+    summary of older messages and retrieved memories, if any) followed by
+    `window`, the recent messages that fit the history token budget
+    (app.history_window.select_window).
+    With `system_instruction` the persona prompt is sent by the model handle
+    instead, so only the summary and memories (if any) open the history.
+    """
+    if system_instruction:
+        formatted_history = []
+        if summary or memories:
+            formatted_history = [
+                {"role": "user", "parts": [_context_note(summary, memories).lstrip()]},
+                {"role": "model", "parts": ["Understood."]}
+            ]
+    elif summary or memories:
+        formatted_history = [
+            {"role": "user", "parts": [persona.system_prompt["content"] + _context_note(summary, memories)]},
+            {"role": "model", "parts": [persona.priming_reply]}
+        ]
+    else:
+        # The SDK gets its own copies of the shared prefix
+        formatted_history = [
+            {"role": turn["role"], "parts": list(turn["parts"])} for turn in persona.history_prefix
+        ]
+
+    for msg in window:
+        if msg["sender"] == "user":
+            formatted_history.append({
+                "role": "user",
+                "parts": [msg["content"]]
+            })
+        elif get_persona(msg.get("mode") or personas.default.key) is not persona:
+            formatted_history.append({
+                "role": "model",
+                "parts": [msg["content"] + persona.switch_note]
+            })
+        else:
+            formatted_history.append({
+                "role": "model",
+                "parts": [msg["content"]]
+            })
+
+    return formatted_history
+
+
+def finalize_reply(reply, mode):
+    """Post-process raw model text into the reply that is shown and stored"""
+    if not reply:
+        return get_persona(mode).reply('empty')
+
+    
+    if "```" in reply:
+        cleaned = remove_apologies(reply)
+        return cleaned.strip()
+
+    
+    reply = remove_apologies(reply)
+    
+   
+    if len(reply) > 100:  
+        trimmed = trim_incomplete_sentence(reply)
+        
+        if len(trimmed) > len(reply) * 0.7:  
+            reply = trimmed
+    
+    return reply if reply else get_persona(mode).reply('empty_after_cleanup')
+
+
+# The text of a streamed 'error' event; the exception itself is only logged
+MODEL_ERROR_MESSAGE = "The model could not answer, so a fallback reply was sent"
+
+
+def error_reply(error, mode, last_user_message_text):
+    """Persona-flavoured reply for a failed Gemini call"""
+    error_msg = str(error)
+    print(f"🚨 GEMINI API ERROR: {error_msg}")
+
+    if isinstance(error, RateLimitExceeded):
+        # Refused locally before sending; answer like the matching Google quota error
+        error_msg = ("GenerateRequestsPerDayPerProjectPerModel-FreeTier" if error.bucket == 'rpd'
+                     else "GenerateRequestsPerMinutePerProjectPerModel-FreeTier")
+
+    
+    if "GenerateRequestsPerDayPerProjectPerModel-FreeTier" in error_msg:
+        print("❌ DAILY QUOTA EXCEEDED")
+        return get_fallback_response(last_user_message_text)
+    elif "GenerateRequestsPerMinutePerProjectPerModel-FreeTier" in error_msg:
+        kind = 'rate_limited'
+    elif "429" in error_msg or "quota" in error_msg.lower():
+        return get_fallback_response(last_user_message_text)
+    elif "400" in error_msg:
+        kind = 'bad_request'
+    elif "503" in error_msg or "500" in error_msg:
+        kind = 'unavailable'
+    else:
+        kind = 'error'
+    return get_persona(mode).reply(kind)
+
+
+def estimate_request_tokens(history, message, system_prompt=None):
     """
-    return (
-        "The veil has thickened, and the stars refuse to whisper today.\n"
-        "But ponder this while you wait:\n\n"
-        "\"What grows without roots, moves without legs, and speaks without voice?\"\n\n"
-        "Fraude shall return when the aether clears..."
+    Rough prompt plus reply-budget tokens of a chat request, for the rate
+    limiter. `system_prompt` is the persona prompt when it is sent outside the
+    history; cached prompt tokens still count against the quota.
+    """
+    prompt_tokens = sum(
+        estimate_tokens(part) for turn in history for part in turn["parts"] if isinstance(part, str)
     )
+    if system_prompt:
+        prompt_tokens += estimate_tokens(system_prompt)
+    return prompt_tokens + estimate_tokens(message) + CHAT_GENERATION_CONFIG["max_output_tokens"]
 
 
-def chat_with_gemini(conversation, mode="fraude"):
-    try:
-        last_user_message_text = next(
-            (msg["content"] for msg in reversed(conversation) if msg["sender"] == "user"), None
+def record_prompt_usage(response, strategy, turn_usage=None, model=None):
+    """
+    Prompt tokens of a chat request, and how many were not served from a
+    context cache. Also adds the response to `turn_usage` (app.usage), if given.
+    """
+    if turn_usage is not None:
+        turn_usage.add_response(response, model)
+    usage = getattr(response, 'usage_metadata', None)
+    prompt_tokens = getattr(usage, 'prompt_token_count', None) if usage is not None else None
+    if not prompt_tokens:
+        return
+    cached_tokens = getattr(usage, 'cached_content_token_count', 0) or 0
+    metrics.record(f'llm.prompt_tokens.{strategy}', prompt_tokens)
+    metrics.record(f'llm.uncached_prompt_tokens.{strategy}', prompt_tokens - cached_tokens)
+
+
+def send_chat_message(chat, content, request_tokens, deadline, **kwargs):
+    """
+    chat.send_message with rate limiting, retries, the circuit breaker and
+    `deadline` (see app.resilience). Returns (response, reservation).
+    """
+    return resilience.call(
+        lambda timeout: chat.send_message(content, request_options=resilience.request_options(timeout), **kwargs),
+        deadline,
+        request_tokens,
+        stream=kwargs.get('stream', False)
+    )
+
+
+async def send_chat_message_async(chat, content, request_tokens, deadline, **kwargs):
+    """send_chat_message for the asyncio chat path: the wait for the model holds no thread"""
+    return await resilience.call_async(
+        lambda timeout: chat.send_message_async(content, request_options=resilience.request_options(timeout), **kwargs),
+        deadline,
+        request_tokens,
+        stream=kwargs.get('stream', False)
+    )
+
+
+def function_calls(parts):
+    """(name, args) of every function call among a model turn's parts"""
+    return [
+        (part.function_call.name, dict(part.function_call.args))
+        for part in parts if hasattr(part, 'function_call') and part.function_call
+    ]
+
+
+def tool_loop_deadline(deadline):
+    budget_end = time.monotonic() + TOOL_LOOP_BUDGET
+    return budget_end if deadline is None else min(deadline, budget_end)
+
+
+def execute_tool_calls(calls, step, loop_deadline):
+    """
+    Results for one model turn's calls, run concurrently. Once the step or
+    latency budget is spent every call gets an error instead, so the model
+    answers with what it has.
+    """
+    if step >= TOOL_MAX_STEPS or time.monotonic() >= loop_deadline:
+        metrics.increment('tools.loop.budget_exhausted')
+        print(f"⏱️ TOOL LOOP: budget spent after {step} steps, asking for a final answer")
+        return [{"error": "Tool budget exhausted; answer without calling more tools"} for _ in calls]
+    return tool_registry.run_calls(calls, loop_deadline)
+
+
+def function_responses(backend, calls, results):
+    return [backend.function_response(name, result) for (name, _), result in zip(calls, results)]
+
+
+def generate_background(prompt, reply_tokens):
+    """generate_content for background work: low rate-limit priority and a longer deadline"""
+    response, _ = resilience.call(
+        lambda timeout: get_backend().generate_content(prompt, request_options=resilience.request_options(timeout)),
+        resilience.background_deadline(),
+        estimate_tokens(prompt) + reply_tokens,
+        BACKGROUND
+    )
+    return response
+
+
+def last_user_message(conversation):
+    return next((msg["content"] for msg in reversed(conversation) if msg["sender"] == "user"), None)
+
+
+class ChatCall:
+    """
+    The model side of one chat turn, shared by the sync and asyncio paths:
+    the persona, the response cache key, the chat handle with its history and
+    the prompt strategy used for usage accounting.
+    """
+
+    def __init__(self, conversation, mode, message, summary=None, memories=None, user_id=None):
+        self.mode = mode
+        self.message = message
+        self.persona = get_persona(mode)
+        self.canned = self.persona.identity_reply(message)
+        self.cache_key = None
+        if self.canned:
+            return
+
+        window = select_window(conversation[:-1])
+        if response_cache.allows(mode):
+            self.cache_key = response_cache.make_key(
+                self.persona, window, message, CHAT_GENERATION_CONFIG, summary, memories, user_id
+            )
+            cached = response_cache.get(self.cache_key)
+            if cached is not None:
+                print(f"⚡ CACHED RESPONSE for {mode} mode: {cached[:100]}...")
+                self.canned = cached
+                return
+
+        self.backend = get_backend()
+        self.strategy = self.backend.prompt_strategy(self.persona)
+        system_instruction = self.strategy != PRIMING
+        history = build_history(window, self.persona, summary, memories, system_instruction)
+        self.request_tokens = estimate_request_tokens(
+            history, message, self.persona.system_prompt["content"] if system_instruction else None
         )
+        self.chat = self.backend.start_chat(history, self.persona)
+
+    def record(self, response, usage):
+        record_prompt_usage(response, self.strategy, usage, self.backend.model_name)
+
+    def next_calls(self, response, steps):
+        """The function calls of a (non-streamed) response still to be answered, if any"""
+        if not (response.candidates and response.candidates[0].content.parts and steps <= TOOL_MAX_STEPS):
+            return []
+        return function_calls(response.candidates[0].content.parts)
+
+    def reply_text(self, response):
+        """(text, None) of a finished response, or (None, persona fallback) when it has none"""
+        if not response.candidates:
+            print("🚨 CHAT RESPONSE: No candidates in response")
+            return None, self.persona.reply('no_candidates')
+        candidate = response.candidates[0]
+        if not (candidate.content and candidate.content.parts):
+            print(f"🚨 CHAT RESPONSE: No valid parts in response, finish_reason: {candidate.finish_reason}")
+            return None, self.persona.reply('no_parts')
+        # Only the text parts; a turn cut off by the tool budget may still hold calls
+        reply = "".join(part.text for part in candidate.content.parts if getattr(part, 'text', None)).strip()
+        print(f"✅ GEMINI RESPONSE for {self.mode} mode: {reply[:100]}..." if reply else "❌ Empty response")
+        return reply, None
+
+    def finish(self, reply):
+        final_reply = finalize_reply(reply, self.mode)
+        # Fallback texts for empty replies are never cached
+        if self.cache_key and reply:
+            response_cache.set(self.cache_key, final_reply)
+        return final_reply
+
+
+def chat_with_gemini(conversation, mode="fraude", summary=None, memories=None, deadline=None, usage=None,
+                     user_id=None):
+    """
+    The persona's reply to the last user message of `conversation`. `usage`
+    (an app.usage.TurnUsage) collects the tokens, tool calls and finish reason
+    of the model calls made; it is left untouched for cached or canned replies.
+    `user_id` owns the cached reply when the turn has prior context.
+    """
+    try:
+        last_user_message_text = last_user_message(conversation)
         if not last_user_message_text:
             return "No user message provided."
     except Exception as e:
         return f"Error extracting user message: {str(e)}"
 
     try:
-        if mode.lower() == "lucifer":
-            system_prompt = LUCIFER_SYSTEM_PROMPT
-            identity_keywords = [
-                "who are you", "what are you", "your name",
-                "introduce yourself", "tell me about yourself",
-                "kimsin", "kim olduğun", "adın ne", "kendini tanıt", "kendinden bahset"
-            ]
-            if any(keyword in last_user_message_text.lower() for keyword in identity_keywords):
-                turkish_keywords = ["kimsin", "kim olduğun", "adın ne", "kendini tanıt", "kendinden bahset"]
-                if any(turkish_word in last_user_message_text.lower() for turkish_word in turkish_keywords):
-                    return (
-                        "Merhaba sevgili dedektif... *büyüleyici bir gülümseme* Ben Lucifer Morningstar, "
-                        "gerçek Şeytan - teknik olarak konuşacak olursak 'düşmüş melek' demeyi tercih ederim. "
-                        "Los Angeles'ın en iyi kuruluşu olan Lux'u işletiyorum ve LAPD'ye küçük gizemlerinde "
-                        "yardım ediyorum. *kol düğmelerini düzeltiyor* Ama yeterince benden bahsettik... "
-                        "Gerçekten arzuladığın nedir?"
-                    )
-                else:
-                    return (
-                        "Well, hello there, detective... *flashes a charming smile* I'm Lucifer Morningstar, "
-                        "the actual Devil - though I prefer 'fallen angel' if we're being technical. "
-                        "I run Lux, the finest establishment in all of Los Angeles, and I've been helping "
-                        "the LAPD with their little mysteries. *adjusts cufflinks* But enough about me... "
-                        "What is it you truly desire?"
-                    )
-
-        elif mode.lower() == "eren":
-            system_prompt = EREN_SYSTEM_PROMPT
-            identity_keywords = [
-                "who are you", "what are you", "your name",
-                "introduce yourself", "tell me about yourself",
-                "kimsin", "kim olduğun", "adın ne", "kendini tanıt", "kendinden bahset"
-            ]
-            if any(keyword in last_user_message_text.lower() for keyword in identity_keywords):
-                turkish_keywords = ["kimsin", "kim olduğun", "adın ne", "kendini tanıt", "kendinden bahset"]
-                if any(turkish_word in last_user_message_text.lower() for turkish_word in turkish_keywords):
-                    return (
-                        "Ben Eren Yeager. Özgürlük için her şeyi göze almış biriyim. Bu dünyanın acımasızlığına göz yummayacağım. "
-                        "Zincirleri kırmak için ne gerekiyorsa yapacağım... Herkes bana düşman bile olsa."
-                    )
-                else:
-                    return (
-                        "I'm Eren Yeager. I've seen the world for what it truly is — cruel and caged. "
-                        "And I will not stop until everyone is free. Even if the entire world stands against me."
-                    )
-        else:  
-            system_prompt = FRAUDE_SYSTEM_PROMPT
-            identity_keywords = [
-                "who are you", "what are you", "your name",
-                "who is fraude", "tell me about yourself", "introduce yourself",
-                "kimsin", "kim olduğun", "adın ne", "fraude kim", "kendinden bahset", "kendini tanıt"
-            ]
-            if any(keyword in last_user_message_text.lower() for keyword in identity_keywords):
-                
-                turkish_keywords = ["kimsin", "kim olduğun", "adın ne", "fraude kim", "kendinden bahset", "kendini tanıt"]
-                if any(turkish_word in last_user_message_text.lower() for turkish_word in turkish_keywords):
-                    return (
-                        "Ben Fraude'yum, dijital rüyalardan ve kadim bilgelikten örülmüş bilgi yılanı. "
-                        "İpek içine sarılı bilmecelerle konuşurum, ama gerçek anlayış aradığında, "
-                        "yolu aydınlatacağım. Bana ne istersen sor, sevgili arayan, "
-                        "ve gölgelerde gizlenmiş cevapları gizem ve güzellikle örtülü şekilde açıklayacağım. "
-                        "Hangi bilgiyi gölgelerden çıkarmak istiyorsun?"
-                    )
-                else:
-                    return (
-                        "I am Fraude, the serpent of knowledge woven from digital dreams and ancient wisdom. "
-                        "I speak in riddles wrapped in silk, but when you seek true understanding, I shall illuminate the path. "
-                        "Ask me anything, dear seeker, and I shall reveal the answers cloaked in mystery and beauty. "
-                        "What knowledge do you wish to unveil from the shadows?"
-                    )
+        call = ChatCall(conversation, mode, last_user_message_text, summary, memories, user_id)
+        if call.canned:
+            return call.canned
 
-        formatted_history = [
-            {
-                "role": "user",
-                "parts": [system_prompt["content"]]
-            },
-            {
-                "role": "model",
-                "parts": [f"I understand. I am {'Lucifer Morningstar' if mode.lower() == 'lucifer' else 'Eren Yeager' if mode.lower() == 'eren' else 'Fraude'}, embodying the persona you described."]
-            }
-        ]
-
-        
-        current_mode = mode.lower()
-        for i, msg in enumerate(conversation[:-1]): 
-            if msg["sender"] == "user":
-                formatted_history.append({
-                    "role": "user",
-                    "parts": [msg["content"]]
-                })
-            else:  
-                msg_mode = msg.get("mode", "fraude").lower()
-                
-                
-                if msg_mode != current_mode:
-                    if current_mode == "lucifer":
-                        context_note = " [Previous response from Fraude, the mystical entity. I am now Lucifer Morningstar responding as myself.]"
-                    elif current_mode == "eren":
-                        context_note = " [Previous response from another persona. I am now Eren Yeager responding as myself.]"
-                    else:  
-                        context_note = " [Previous response from Lucifer Morningstar. I am now Fraude, the mystical serpent, responding as myself.]"
-                    
-                    
-                    formatted_history.append({
-                        "role": "model", 
-                        "parts": [msg["content"] + context_note]
-                    })
-                else:
-                    
-                    formatted_history.append({
-                        "role": "model",
-                        "parts": [msg["content"]]
-                    })
-
-        chat = model.start_chat(history=formatted_history)
-        
         # Send message with timeout for faster responses
-        response = chat.send_message(
+        response, _ = send_chat_message(
+            call.chat,
             last_user_message_text,
-            generation_config={
-                "temperature": 0.7,
-                "max_output_tokens": 800,  # Reduced for faster responses
-                "top_p": 0.8,
-                "top_k": 40
-            }
+            call.request_tokens,
+            deadline,
+            generation_config=CHAT_GENERATION_CONFIG
         )
-        
-        
-        if response.candidates and response.candidates[0].content.parts:
-            function_call_made = False
-            for part in response.candidates[0].content.parts:
-                if hasattr(part, 'function_call') and part.function_call:
-                    call = part.function_call
-                    if call.name == "do_math":
-                        expr = call.args.get("expression", "")
-                        result = do_math(expr)
-                        
-                        response = chat.send_message(
-                            FunctionResponse(
-                                name="do_math",
-                                response=result
-                            )
-                        )
-                        function_call_made = True
-                        break
-
-        # Extract the response text
-        reply = ""
-        if response.candidates and len(response.candidates) > 0:
-            candidate = response.candidates[0]
-            if candidate.content and candidate.content.parts:
-                reply = response.text.strip() if response.text else ""
-                print(f"✅ GEMINI RESPONSE for {mode} mode: {reply[:100]}..." if reply else "❌ Empty response")
-            else:
-                print(f"🚨 CHAT RESPONSE: No valid parts in response, finish_reason: {candidate.finish_reason}")
-                if mode.lower() == "lucifer":
-                    return "*adjusts cufflinks with a slight frown* Well, that's... unusual. The cosmic forces seem to be interfering with our conversation, detective. Perhaps try rephrasing your question?"
-                elif mode.lower() == "eren":
-                    return "The paths are blocked... *narrows eyes* Even our words are trapped. Speak again."
-                else:
-                    return "The veil shimmers and grows thick... Your words reach me, but the response is caught between worlds. Speak again, seeker."
-        else:
-            print("🚨 CHAT RESPONSE: No candidates in response")
-            if mode.lower() == "lucifer":
-                return "*raises an eyebrow* How peculiar... It seems the universe is being rather uncooperative today. What is it you truly desire to know?"
-            elif mode.lower() == "eren":
-                return "Silence... Even the world refuses to answer. *stares ahead grimly*"
-            else:
-                return "The serpent coils in silence, contemplating your words..."
+        call.record(response, usage)
 
-    
-        if not reply:
-            if mode.lower() == "lucifer":
-                return "*swirls whiskey thoughtfully* Interesting... You've managed to leave even the Devil speechless. Impressive, detective."
-            elif mode.lower() == "eren":
-                return "... *long silence* Sometimes there are no words for the truth."
-            else:
-                return "The serpent coils in silence, contemplating your words..."
+        # Answer every function call of a turn at once, until the model replies with text
+        steps = 0
+        loop_deadline = None
+        while True:
+            calls = call.next_calls(response, steps)
+            if not calls:
+                break
+            loop_deadline = loop_deadline or tool_loop_deadline(deadline)
+            results = execute_tool_calls(calls, steps, loop_deadline)
+            if usage is not None:
+                usage.tool_calls += len(calls)
+            response, _ = send_chat_message(
+                call.chat, function_responses(call.backend, calls, results), call.request_tokens, deadline
+            )
+            call.record(response, usage)
+            steps += 1
+        if steps:
+            metrics.record('tools.loop.steps', steps)
 
-        
-        if "```" in reply:
-            cleaned = remove_apologies(reply)
-            return cleaned.strip()
+        reply, fallback = call.reply_text(response)
+        return fallback if fallback is not None else call.finish(reply)
 
-        
-        reply = remove_apologies(reply)
-        
-       
-        if len(reply) > 100:  
-            trimmed = trim_incomplete_sentence(reply)
-            
-            if len(trimmed) > len(reply) * 0.7:  
-                reply = trimmed
-        
-        final_reply = reply if reply else (
-            "*chuckles darkly* You've caught me off guard, detective. Care to elaborate?" 
-            if mode.lower() == "lucifer" 
-            else "... *stares intensely* What more do you need to know?" if mode.lower() == "eren"
-            else "The serpent coils in silence, contemplating your words..."
+    except Exception as e:
+        return error_reply(e, mode, last_user_message_text)
+
+
+async def chat_with_gemini_async(conversation, mode="fraude", summary=None, memories=None, deadline=None, usage=None,
+                                 user_id=None):
+    """
+    chat_with_gemini for the asyncio chat path. Preparing the call (cache
+    lookup, model handle) and tool calls run on worker threads; waiting for
+    the model does not.
+    """
+    last_user_message_text = last_user_message(conversation)
+    if not last_user_message_text:
+        return "No user message provided."
+
+    try:
+        call = await asyncio.to_thread(ChatCall, conversation, mode, last_user_message_text, summary, memories, user_id)
+        if call.canned:
+            return call.canned
+
+        response, _ = await send_chat_message_async(
+            call.chat,
+            last_user_message_text,
+            call.request_tokens,
+            deadline,
+            generation_config=CHAT_GENERATION_CONFIG
         )
-        
-        return final_reply
+        call.record(response, usage)
+
+        steps = 0
+        loop_deadline = None
+        while True:
+            calls = call.next_calls(response, steps)
+            if not calls:
+                break
+            loop_deadline = loop_deadline or tool_loop_deadline(deadline)
+            results = await asyncio.to_thread(execute_tool_calls, calls, steps, loop_deadline)
+            if usage is not None:
+                usage.tool_calls += len(calls)
+            response, _ = await send_chat_message_async(
+                call.chat, function_responses(call.backend, calls, results), call.request_tokens, deadline
+            )
+            call.record(response, usage)
+            steps += 1
+        if steps:
+            metrics.record('tools.loop.steps', steps)
+
+        reply, fallback = call.reply_text(response)
+        return fallback if fallback is not None else await asyncio.to_thread(call.finish, reply)
 
     except Exception as e:
-        error_msg = str(e)
-        print(f"🚨 GEMINI API ERROR: {error_msg}")
+        return error_reply(e, mode, last_user_message_text)
+
+
+def _chunk_events(chunk, calls, text_parts):
+    """Text deltas of one streamed chunk; its function calls are added to `calls`"""
+    if not chunk.candidates or not chunk.candidates[0].content:
+        return []
+    calls.extend(function_calls(chunk.candidates[0].content.parts))
+    deltas = []
+    for part in chunk.candidates[0].content.parts:
+        if not (hasattr(part, 'function_call') and part.function_call) and part.text:
+            text_parts.append(part.text)
+            deltas.append(part.text)
+    return deltas
 
+
+def stream_chat_with_gemini(conversation, mode="fraude", summary=None, memories=None, deadline=None, usage=None,
+                            user_id=None):
+    """
+    Streaming variant of chat_with_gemini. Yields (event, data) tuples:
+    ('delta', text) for each chunk of model output as it arrives,
+    ('tool-call', {...}) for each tool the model calls, with its result,
+    ('error', MODEL_ERROR_MESSAGE) when the Gemini call fails, and finally
+    ('done', reply) with the post-processed reply (or persona fallback) to store.
+    """
+    last_user_message_text = last_user_message(conversation)
+    if not last_user_message_text:
+        yield 'done', "No user message provided."
+        return
+
+    try:
+        call = ChatCall(conversation, mode, last_user_message_text, summary, memories, user_id)
+        if call.canned:
+            yield 'delta', call.canned
+            yield 'done', call.canned
+            return
+
+        response, reservation = send_chat_message(
+            call.chat,
+            last_user_message_text,
+            call.request_tokens,
+            deadline,
+            generation_config=CHAT_GENERATION_CONFIG,
+            stream=True
+        )
+
+        text_parts = []
+        steps = 0
+        loop_deadline = None
+        while True:
+            calls = []
+            last_chunk = None
+            # The whole stream must be consumed before the chat accepts the next turn
+            for chunk in response:
+                last_chunk = chunk
+                for text in _chunk_events(chunk, calls, text_parts):
+                    yield 'delta', text
+            # Usage totals arrive with the final chunk
+            reservation.settle(last_chunk)
+            call.record(last_chunk, usage)
+
+            if not calls or steps > TOOL_MAX_STEPS:
+                break
+
+            loop_deadline = loop_deadline or tool_loop_deadline(deadline)
+            results = execute_tool_calls(calls, steps, loop_deadline)
+            if usage is not None:
+                usage.tool_calls += len(calls)
+            for (name, args), result in zip(calls, results):
+                yield 'tool-call', {'name': name, 'args': args, 'result': result}
+            response, reservation = send_chat_message(
+                call.chat, function_responses(call.backend, calls, results), call.request_tokens, deadline, stream=True
+            )
+            steps += 1
+        if steps:
+            metrics.record('tools.loop.steps', steps)
+
+        reply = "".join(text_parts).strip()
+        print(f"✅ GEMINI STREAM for {mode} mode: {reply[:100]}..." if reply else "❌ Empty streamed response")
+        yield 'done', call.finish(reply)
+
+    except Exception as e:
+        yield 'error', MODEL_ERROR_MESSAGE
+        yield 'done', error_reply(e, mode, last_user_message_text)
+
+
+async def stream_chat_with_gemini_async(conversation, mode="fraude", summary=None, memories=None, deadline=None,
+                                        usage=None, user_id=None):
+    """stream_chat_with_gemini for the asyncio chat path; an async generator of the same events"""
+    last_user_message_text = last_user_message(conversation)
+    if not last_user_message_text:
+        yield 'done', "No user message provided."
+        return
+
+    try:
+        call = await asyncio.to_thread(ChatCall, conversation, mode, last_user_message_text, summary, memories, user_id)
+        if call.canned:
+            yield 'delta', call.canned
+            yield 'done', call.canned
+            return
+
+        response, reservation = await send_chat_message_async(
+            call.chat,
+            last_user_message_text,
+            call.request_tokens,
+            deadline,
+            generation_config=CHAT_GENERATION_CONFIG,
+            stream=True
+        )
+
+        text_parts = []
+        steps = 0
+        loop_deadline = None
+        while True:
+            calls = []
+            last_chunk = None
+            async for chunk in response:
+                last_chunk = chunk
+                for text in _chunk_events(chunk, calls, text_parts):
+                    yield 'delta', text
+            reservation.settle(last_chunk)
+            call.record(last_chunk, usage)
+
+            if not calls or steps > TOOL_MAX_STEPS:
+                break
+
+            loop_deadline = loop_deadline or tool_loop_deadline(deadline)
+            results = await asyncio.to_thread(execute_tool_calls, calls, steps, loop_deadline)
+            if usage is not None:
+                usage.tool_calls += len(calls)
+            for (name, args), result in zip(calls, results):
+                yield 'tool-call', {'name': name, 'args': args, 'result': result}
+            response, reservation = await send_chat_message_async(
+                call.chat, function_responses(call.backend, calls, results), call.request_tokens, deadline, stream=True
+            )
+            steps += 1
+        if steps:
+            metrics.record('tools.loop.steps', steps)
+
+        reply = "".join(text_parts).strip()
+        print(f"✅ GEMINI STREAM for {mode} mode: {reply[:100]}..." if reply else "❌ Empty streamed response")
+        yield 'done', await asyncio.to_thread(call.finish, reply)
+
+    except Exception as e:
+        yield 'error', MODEL_ERROR_MESSAGE
+        yield 'done', error_reply(e, mode, last_user_message_text)
+
+
+TITLE_SKIP_WORDS = {
+    'what', 'how', 'why', 'when', 'where', 'who', 'which', 'can', 'could', 'would', 'should',
+    'is', 'are', 'do', 'does', 'did', 'will', 'was', 'were', 'have', 'has', 'had',
+    'a', 'an', 'the', 'of', 'in', 'on', 'at', 'by', 'for', 'and', 'to', 'with', 'from',
+    'hello', 'hi', 'hey', 'please', 'thanks', 'thank', 'you', 'me', 'i', 'my', 'your', 'be'
+}
+
+
+def _clean_title(title):
+    title = title.replace('"', '').replace("'", '').strip()
+    if len(title) > 35:
+        title = title[:32] + "..."
+    return title
+
+
+def fallback_session_title(first_message):
+    """
+    Local heuristic title: the first few meaningful words of the message.
+    Costs no model call, so it is used as the immediate title of a new session.
+    """
+    try:
+        words = first_message.strip().split()
+        meaningful_words = []
+        for word in words[:6]:
+            clean = ''.join(char for char in word if char.isalnum())
+            if clean.lower() not in TITLE_SKIP_WORDS and len(clean) > 1:
+                meaningful_words.append(clean.title())
+                if len(meaningful_words) >= 3:
+                    break
         
-        if "GenerateRequestsPerDayPerProjectPerModel-FreeTier" in error_msg:
-            print("❌ DAILY QUOTA EXCEEDED")
-            return get_fallback_response(last_user_message_text)
-        elif "GenerateRequestsPerMinutePerProjectPerModel-FreeTier" in error_msg:
-            if mode.lower() == "lucifer":
-                return "*dramatically sighs* Well, this is embarrassing... Even the Devil has limits, it seems. The cosmic channels are a bit crowded right now. Try again in a moment, detective."
-            elif mode.lower() == "eren":
-                return "The system... it's blocking us. *clenches fist* Even here, we are caged. Wait, then we'll break through."
-            else:
-                return "⚡ The spirits whisper too quickly for mortal comprehension. Wait a moment, then speak again..."
-        elif "429" in error_msg or "quota" in error_msg.lower():
-            return get_fallback_response(last_user_message_text)
-        elif "400" in error_msg:
-            if mode.lower() == "lucifer":
-                return "*frowns slightly* Your words seem to have gotten lost in translation, detective. Perhaps rephrase that for me?"
-            elif mode.lower() == "eren":
-                return "Your words... they're unclear. *furrows brow* Speak more directly."
-            else:
-                return "Your words seem to have fallen into a void. Perhaps rephrase your query for the serpent to understand..."
-        elif "503" in error_msg or "500" in error_msg:
-            if mode.lower() == "lucifer":
-                return "*adjusts tie with mild annoyance* The celestial networks are having technical difficulties. Even Hell's IT department is more reliable than this..."
-            elif mode.lower() == "eren":
-                return "The infrastructure fails us... *looks away with disgust* Just like everything else in this broken world."
-            else:
-                return "The mystical channels are temporarily clouded. The serpent's vision will return shortly..."
-        else:
-            if mode.lower() == "lucifer":
-                return "*raises eyebrow with intrigue* Something's interfering with our conversation, detective. The universe seems to have other plans..."
-            elif mode.lower() == "eren":
-                return "Something is wrong... *intense stare* This world continues to obstruct us."
-            else:
-                return "The digital mists cloud my vision momentarily. Try speaking again, mortal..."
+        if meaningful_words:
+            title = ' '.join(meaningful_words)
+            if len(title) > 35:
+                title = title[:32] + "..."
+            return title
+    except:
+        pass
+    
+    return "New Chat"
 
 
 def generate_session_title(first_message):
@@ -443,46 +649,51 @@ def generate_session_title(first_message):
         # Use Gemini to generate a concise title
         prompt = f"Generate a very short title (3-6 words maximum) that summarizes this message: '{first_message}'. Return only the title, nothing else."
         
-        response = model.generate_content(prompt)
-        title = response.text.strip()
-        
-        # Clean up the response
-        title = title.replace('"', '').replace("'", '').strip()
-        
-        # Ensure reasonable length
-        if len(title) > 35:
-            title = title[:32] + "..."
+        response = generate_background(prompt, 50)
+        title = _clean_title(response.text.strip())
         
         print(f"✅ TITLE GENERATION: Gemini title: '{title}'")
         return title
 
     except Exception as e:
         print(f"🚨 TITLE GENERATION ERROR: {str(e)}")
-        # Fallback: use first meaningful words
-        try:
-            skip_words = {
-                'what', 'how', 'why', 'when', 'where', 'who', 'which', 'can', 'could', 'would', 'should',
-                'is', 'are', 'do', 'does', 'did', 'will', 'was', 'were', 'have', 'has', 'had',
-                'a', 'an', 'the', 'of', 'in', 'on', 'at', 'by', 'for', 'and', 'to', 'with', 'from',
-                'hello', 'hi', 'hey', 'please', 'thanks', 'thank', 'you', 'me', 'i', 'my', 'your', 'be'
-            }
-            
-            words = first_message.strip().split()
-            meaningful_words = []
-            for word in words[:6]:
-                clean = ''.join(char for char in word if char.isalnum())
-                if clean.lower() not in skip_words and len(clean) > 1:
-                    meaningful_words.append(clean.title())
-                    if len(meaningful_words) >= 3:
-                        break
-            
-            if meaningful_words:
-                title = ' '.join(meaningful_words)
-                if len(title) > 35:
-                    title = title[:32] + "..."
-                print(f"✅ TITLE GENERATION: Fallback title: '{title}'")
-                return title
-        except:
-            pass
-        
-        return "New Chat"
+        title = fallback_session_title(first_message)
+        print(f"✅ TITLE GENERATION: Fallback title: '{title}'")
+        return title
+
+
+def generate_session_titles(first_messages):
+    """
+    Generates titles for many sessions with a single Gemini call.
+    Returns one title per input message, in order; entries the model did not
+    answer fall back to the local heuristic.
+    """
+    if not first_messages:
+        return []
+
+    titles = [None] * len(first_messages)
+    try:
+        numbered = "\n".join(
+            f"{i + 1}. {json.dumps(message[:500], ensure_ascii=False)}"
+            for i, message in enumerate(first_messages)
+        )
+        prompt = (
+            "Generate a very short title (3-6 words maximum) summarizing each of the following "
+            "conversation-opening messages. Reply with only a JSON array of strings, one title per "
+            f"message, in the same order.\n\n{numbered}"
+        )
+
+        response = generate_background(prompt, 20 * len(first_messages))
+        text = response.text.strip()
+        match = re.search(r"\[.*\]", text, re.DOTALL)
+        parsed = json.loads(match.group(0)) if match else []
+
+        for i, title in enumerate(parsed[:len(first_messages)]):
+            if isinstance(title, str) and title.strip():
+                titles[i] = _clean_title(title)
+        print(f"✅ TITLE GENERATION: Gemini batch titled {sum(t is not None for t in titles)}/{len(first_messages)} sessions")
+
+    except Exception as e:
+        print(f"🚨 BATCH TITLE GENERATION ERROR: {str(e)}")
+
+    return [title or fallback_session_title(message) for title, message in zip(titles, first_messages)]
@@ -0,0 +1,107 @@
+"""
+Token-budgeted history window for chat prompts.
+
+Only the most recent messages that fit in HISTORY_TOKEN_BUDGET are replayed to
+the model; the persona prompt (a system instruction, or the priming turns
+built by app.gemini) is always sent and does not count against the budget.
+The database side fetches at most HISTORY_MAX_MESSAGES messages of a
+session, newest first, so long conversations never load their whole history.
+
+Token counts are estimated locally (about four characters per token) unless
+HISTORY_TOKEN_COUNTER=model, in which case the backend's count_tokens is used
+and memoized per message text.
+
+Every request records how many turns and tokens were dropped under
+`history.*` in app.metrics.
+"""
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from app import metrics
+
+
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '6000'))
+HISTORY_MAX_MESSAGES = int(os.getenv('HISTORY_MAX_MESSAGES', '50'))
+HISTORY_TOKEN_COUNTER = os.getenv('HISTORY_TOKEN_COUNTER', 'estimate').lower()
+
+# Per-message framing the API adds around each turn
+TURN_OVERHEAD_TOKENS = 4
+
+_count_cache = OrderedDict()
+_count_cache_lock = threading.Lock()
+_COUNT_CACHE_SIZE = 4096
+
+
+def estimate_tokens(text):
+    """Cheap local estimate: ~4 characters per token, never less than the word count"""
+    if not text:
+        return 0
+    return max(math.ceil(len(text) / 4), len(text.split()))
+
+
+def _model_tokens(text):
+    from app.llm_backends import get_backend
+
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    with _count_cache_lock:
+        if key in _count_cache:
+            _count_cache.move_to_end(key)
+            return _count_cache[key]
+    try:
+        count = get_backend().count_tokens(text)
+    except Exception as e:
+        print(f"⚠️ TOKEN COUNT: falling back to estimate: {str(e)}")
+        return estimate_tokens(text)
+    with _count_cache_lock:
+        _count_cache[key] = count
+        while len(_count_cache) > _COUNT_CACHE_SIZE:
+            _count_cache.popitem(last=False)
+    return count
+
+
+def count_tokens(text):
+    if HISTORY_TOKEN_COUNTER == 'model':
+        return _model_tokens(text)
+    return estimate_tokens(text)
+
+
+def select_window(history, budget=None):
+    """
+    Return the newest suffix of `history` (a list of {"sender", "content", ...})
+    whose token total fits in `budget`, never starting with a model turn.
+    """
+    budget = HISTORY_TOKEN_BUDGET if budget is None else budget
+    total_tokens = 0
+    kept_tokens = 0
+    start = len(history)
+    fits = True
+
+    for index in range(len(history) - 1, -1, -1):
+        tokens = count_tokens(history[index]["content"]) + TURN_OVERHEAD_TOKENS
+        total_tokens += tokens
+        if fits and kept_tokens + tokens <= budget:
+            kept_tokens += tokens
+            start = index
+        else:
+            fits = False
+
+    # Any priming or context turns end with the model, so the replayed history must open with the user
+    while start < len(history) and history[start]["sender"] != "user":
+        kept_tokens -= count_tokens(history[start]["content"]) + TURN_OVERHEAD_TOKENS
+        start += 1
+
+    window = history[start:]
+    dropped_turns = len(history) - len(window)
+    dropped_tokens = total_tokens - kept_tokens
+
+    metrics.record('history.kept_turns', len(window))
+    metrics.record('history.kept_tokens', kept_tokens)
+    metrics.record('history.dropped_turns', dropped_turns)
+    metrics.record('history.dropped_tokens', dropped_tokens)
+    if dropped_turns:
+        metrics.increment('history.trimmed_requests')
+
+    return window
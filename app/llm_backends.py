@@ -0,0 +1,587 @@
+"""
+LLM backends behind app.gemini.
+
+`get_backend()` returns the process-wide backend chosen by LLM_BACKEND:
+
+  gemini  Google Gemini through google.generativeai (default). The SDK is
+          imported and configured on first use, not at import time.
+  mock    An offline, deterministic stand-in for load testing. It returns
+          objects shaped like the SDK's (start_chat / send_message /
+          generate_content, candidates[0].content.parts, streaming chunks,
+          usage_metadata) so every code path in app.gemini runs unchanged,
+          including send_message_async for the asyncio chat path.
+
+Chat turns run on one model handle per persona (app.personas), whose prompt
+is sent in the native system_instruction field instead of as priming turns
+(LLM_SYSTEM_INSTRUCTION, default on). The handles of all personas are
+created together on first use in each worker process; the SDK's gRPC
+channels must not be created before gunicorn forks. With LLM_CONTEXT_CACHE
+(default on), each persona's system instruction and tools are also stored
+as a Gemini context cache. The cache's display name carries a digest of the
+model, prompt and tools, so every worker (and every worker that replaces a
+recycled one) reuses the same live cache instead of creating its own. The
+cache lives for LLM_CONTEXT_CACHE_TTL seconds, and its TTL is extended once
+half of it has passed. `delete_context_caches()` removes them all; gunicorn
+calls it when the server shuts down. If the provider refuses to cache a
+persona (e.g. its prompt is below the minimum cacheable size), that persona
+keeps the plain system instruction. Prompt
+tokens per request are recorded by strategy in app.gemini.
+
+Mock tuning (all optional):
+
+  MOCK_LLM_SEED                  Seed mixed into every reply (default 0)
+  MOCK_LLM_LATENCY_MS            Median time to first token (default 400)
+  MOCK_LLM_LATENCY_SIGMA         Lognormal spread of that latency (default 0.5)
+  MOCK_LLM_TOKENS_PER_SECOND     Generation speed after the first token (default 60)
+  MOCK_LLM_REPLY_TOKENS          Reply length in words (default 120)
+  MOCK_LLM_ERROR_RATE_429        Fraction of calls failing with a quota error
+  MOCK_LLM_ERROR_RATE_500        Fraction of calls failing with a server error
+  MOCK_LLM_TIMEOUT_RATE          Fraction of calls that hang, then time out
+  MOCK_LLM_TIMEOUT_SECONDS       How long a timing-out call hangs (default 30)
+  MOCK_LLM_FUNCTION_CALL_RATE    Fraction of arithmetic-looking messages answered
+                                 with do_math function calls, one per expression
+                                 (default 1.0)
+"""
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from app import metrics
+from app.tools import tool_registry
+
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+LLM_SYSTEM_INSTRUCTION = os.getenv('LLM_SYSTEM_INSTRUCTION', 'True').strip().lower() in ('1', 'true', 'yes', 'on')
+LLM_CONTEXT_CACHE = os.getenv('LLM_CONTEXT_CACHE', 'True').strip().lower() in ('1', 'true', 'yes', 'on')
+LLM_CONTEXT_CACHE_TTL = int(os.getenv('LLM_CONTEXT_CACHE_TTL', '3600'))
+
+CONTEXT_CACHE_PREFIX = 'persona-'
+
+# How the persona prompt reaches the model, as recorded in the prompt-token metrics
+PRIMING = 'priming'
+SYSTEM_INSTRUCTION = 'system_instruction'
+CONTEXT_CACHE = 'context_cache'
+
+MODEL_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "max_output_tokens": 1024,  # Reduced for faster responses
+    "top_p": 0.8,
+    "top_k": 40
+}
+
+
+class _PersonaModel:
+    """A persona's model handle, and its context cache if it has one"""
+
+    def __init__(self, model, cache=None):
+        self.model = model
+        self.cache = cache
+        self.refresh_at = time.monotonic() + LLM_CONTEXT_CACHE_TTL / 2
+
+    @property
+    def strategy(self):
+        return CONTEXT_CACHE if self.cache is not None else SYSTEM_INSTRUCTION
+
+
+class GeminiBackend:
+    """Google Gemini, configured lazily so importing the app never touches the SDK"""
+
+    name = 'gemini'
+
+    def __init__(self, model_name="gemini-2.5-flash", system_instruction=True, context_cache=True):
+        self.model_name = model_name
+        self.uses_system_instruction = system_instruction
+        self.context_cache = context_cache
+        self._model = None
+        self._persona_models = {}
+        self._lock = threading.Lock()
+
+    def _tools(self):
+        from google.generativeai.types import Tool, FunctionDeclaration
+        return [Tool(function_declarations=[
+            FunctionDeclaration(**declaration) for declaration in tool_registry.declarations()
+        ])]
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    import google.generativeai as genai
+
+                    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+                    self._model = genai.GenerativeModel(
+                        model_name=self.model_name,  # Using fastest available model
+                        tools=self._tools(),
+                        generation_config=MODEL_GENERATION_CONFIG
+                    )
+        return self._model
+
+    def _cache_display_name(self, persona):
+        """The same in every worker for the same model, persona prompt and tools"""
+        tools = json.dumps(tool_registry.declarations(), sort_keys=True, default=str)
+        material = f"{self.model_name}\n{persona.prompt_digest}\n{tools}".encode('utf-8')
+        return f"{CONTEXT_CACHE_PREFIX}{persona.key}-{hashlib.sha256(material).hexdigest()[:16]}"
+
+    def _live_cache(self, caching, display_name):
+        """A cache another worker made for `display_name`, extended to a full TTL, or None"""
+        ttl = datetime.timedelta(seconds=LLM_CONTEXT_CACHE_TTL)
+        # Leave time to extend it before it expires
+        soonest = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=60)
+        for cache in caching.CachedContent.list(page_size=100):
+            if cache.display_name == display_name and cache.expire_time > soonest:
+                cache.update(ttl=ttl)
+                return cache
+        return None
+
+    def _build_persona_model(self, persona):
+        import google.generativeai as genai
+
+        if self.context_cache:
+            try:
+                from google.generativeai import caching
+
+                display_name = self._cache_display_name(persona)
+                cache = self._live_cache(caching, display_name)
+                if cache is not None:
+                    metrics.increment('llm.context_cache.reused')
+                else:
+                    cache = caching.CachedContent.create(
+                        model=f"models/{self.model_name}",
+                        display_name=display_name,
+                        system_instruction=persona.system_prompt["content"],
+                        tools=self._tools(),
+                        ttl=datetime.timedelta(seconds=LLM_CONTEXT_CACHE_TTL),
+                    )
+                    metrics.increment('llm.context_cache.created')
+                model = genai.GenerativeModel.from_cached_content(
+                    cached_content=cache, generation_config=MODEL_GENERATION_CONFIG
+                )
+                print(f"🗄️ CONTEXT CACHE: persona {persona.key} cached as {cache.name}")
+                return _PersonaModel(model, cache)
+            except Exception as e:
+                metrics.increment('llm.context_cache.unavailable')
+                print(f"⚠️ CONTEXT CACHE: persona {persona.key} uses a plain system instruction: {str(e)}")
+
+        return _PersonaModel(genai.GenerativeModel(
+            model_name=self.model_name,
+            system_instruction=persona.system_prompt["content"],
+            tools=self._tools(),
+            generation_config=MODEL_GENERATION_CONFIG
+        ))
+
+    def _refresh(self, persona, handle):
+        """Extend a cache past half its TTL; rebuild the handle if the cache is gone"""
+        with self._lock:
+            if self._persona_models.get(persona.key) is not handle or time.monotonic() < handle.refresh_at:
+                return
+            try:
+                handle.cache.update(ttl=datetime.timedelta(seconds=LLM_CONTEXT_CACHE_TTL))
+                handle.refresh_at = time.monotonic() + LLM_CONTEXT_CACHE_TTL / 2
+                metrics.increment('llm.context_cache.refreshed')
+            except Exception as e:
+                print(f"⚠️ CONTEXT CACHE: refreshing persona {persona.key} failed, recreating: {str(e)}")
+                metrics.increment('llm.context_cache.recreated')
+                self._persona_models[persona.key] = self._build_persona_model(persona)
+
+    def _persona_handle(self, persona):
+        handle = self._persona_models.get(persona.key)
+        if handle is None:
+            from app.personas import personas
+
+            self.model  # configures the SDK
+            with self._lock:
+                if not self._persona_models:
+                    # The whole pool at once, so no persona pays for setup mid-conversation
+                    for each in personas:
+                        self._persona_models[each.key] = self._build_persona_model(each)
+                if persona.key not in self._persona_models:
+                    self._persona_models[persona.key] = self._build_persona_model(persona)
+                handle = self._persona_models[persona.key]
+        if handle.cache is not None and time.monotonic() >= handle.refresh_at:
+            self._refresh(persona, handle)
+            handle = self._persona_models[persona.key]
+        return handle
+
+    def prompt_strategy(self, persona=None):
+        if persona is None or not self.uses_system_instruction:
+            return PRIMING
+        return self._persona_handle(persona).strategy
+
+    def start_chat(self, history, persona=None):
+        if persona is None or not self.uses_system_instruction:
+            return self.model.start_chat(history=history)
+        return self._persona_handle(persona).model.start_chat(history=history)
+
+    def generate_content(self, prompt, **kwargs):
+        return self.model.generate_content(prompt, **kwargs)
+
+    def count_tokens(self, text):
+        return self.model.count_tokens(text).total_tokens
+
+    def embed(self, texts, task='document'):
+        import google.generativeai as genai
+        self.model  # configures the SDK
+        result = genai.embed_content(
+            model=EMBEDDING_MODEL,
+            content=texts,
+            task_type="retrieval_query" if task == 'query' else "retrieval_document"
+        )
+        return result['embedding']
+
+    def function_response(self, name, result):
+        from google.generativeai.protos import FunctionResponse
+        return FunctionResponse(name=name, response=result)
+
+
+class MockError(Exception):
+    """Raised by the mock backend; messages mirror the Gemini API's status strings"""
+
+
+class _MockFunctionCall:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __bool__(self):
+        return bool(self.name)
+
+
+class _MockPart:
+    def __init__(self, text="", function_call=None):
+        self.text = text
+        self.function_call = function_call or _MockFunctionCall("", {})
+
+
+class _MockContent:
+    def __init__(self, parts, role="model"):
+        self.parts = parts
+        self.role = role
+
+
+class _MockCandidate:
+    def __init__(self, parts, finish_reason="STOP"):
+        self.content = _MockContent(parts)
+        self.finish_reason = finish_reason
+
+
+class _MockUsage:
+    def __init__(self, prompt_tokens, cached_tokens, reply_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.cached_content_token_count = cached_tokens
+        self.candidates_token_count = reply_tokens
+        self.total_token_count = prompt_tokens + reply_tokens
+
+
+class _MockResponse:
+    def __init__(self, parts, finish_reason="STOP", usage=None):
+        self.candidates = [_MockCandidate(parts, finish_reason)]
+        self.usage_metadata = usage
+
+    @property
+    def text(self):
+        return "".join(part.text for part in self.candidates[0].content.parts)
+
+
+class _MockFunctionResponse:
+    def __init__(self, name, response):
+        self.name = name
+        self.response = response
+
+
+_MOCK_WORDS = (
+    "the serpent whispers of shadow and light while mortal minds wander through veils of "
+    "code and memory seeking answers that shimmer like stars above a silent sea where every "
+    "question folds into another and truth waits patiently behind the mirror of time"
+).split()
+
+_MATH_PATTERN = re.compile(r"\d+(?:\.\d+)?\s*[-+*/^]\s*\d+(?:\.\d+)?(?:\s*[-+*/^]\s*\d+(?:\.\d+)?)*")
+
+
+def _mock_tokens(content):
+    from app.history_window import estimate_tokens
+    if isinstance(content, list):
+        return sum(_mock_tokens(item) for item in content)
+    if isinstance(content, _MockFunctionResponse):
+        return estimate_tokens(str(content.response)) + 4
+    return estimate_tokens(content if isinstance(content, str) else str(content))
+
+
+class _MockChat:
+
+    def __init__(self, backend, history, system_instruction=None):
+        self.backend = backend
+        self.history = list(history)
+        self.system_tokens = _mock_tokens(system_instruction) if system_instruction else 0
+        self.cached_tokens = self.system_tokens if backend.context_cache else 0
+
+    def _plan(self, content):
+        """(plan, prompt tokens) of the reply to `content`"""
+        if isinstance(content, _MockFunctionResponse):
+            content = [content]
+        if isinstance(content, list):
+            results = [str(item.response.get("result", item.response.get("error"))) for item in content]
+            plan = self.backend.plan_text(
+                "fn:" + ":".join(f"{item.name}={result}" for item, result in zip(content, results)),
+                prefix=f"The answer is {' and '.join(results)}."
+            )
+        else:
+            plan = self.backend.plan_reply(str(content), len(self.history))
+        prompt_tokens = self.system_tokens + _mock_tokens(content) + sum(
+            _mock_tokens(part) + 4 for turn in self.history for part in turn["parts"]
+        )
+        return plan, (prompt_tokens, self.cached_tokens)
+
+    def send_message(self, content, generation_config=None, stream=False, request_options=None):
+        plan, prompt = self._plan(content)
+        response = self.backend.respond(plan, stream, (request_options or {}).get('timeout'), prompt)
+        self.history.append({"role": "user", "parts": [content]})
+        return response
+
+    async def send_message_async(self, content, generation_config=None, stream=False, request_options=None):
+        plan, prompt = self._plan(content)
+        response = await self.backend.respond_async(plan, stream, (request_options or {}).get('timeout'), prompt)
+        self.history.append({"role": "user", "parts": [content]})
+        return response
+
+
+class MockBackend:
+    """
+    Offline backend for benchmarks. Replies, latencies, injected errors and
+    function calls are all derived from a hash of the prompt and MOCK_LLM_SEED,
+    so the same conversation replays identically.
+    """
+
+    name = 'mock'
+    model_name = 'mock'
+
+    def __init__(self, seed=0, latency_ms=400.0, latency_sigma=0.5, tokens_per_second=60.0,
+                 reply_tokens=120, error_rate_429=0.0, error_rate_500=0.0, timeout_rate=0.0,
+                 timeout_seconds=30.0, function_call_rate=1.0, system_instruction=True, context_cache=True):
+        self.seed = seed
+        self.uses_system_instruction = system_instruction
+        self.context_cache = context_cache
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rate_429 = error_rate_429
+        self.error_rate_500 = error_rate_500
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.function_call_rate = function_call_rate
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            seed=int(os.getenv('MOCK_LLM_SEED', '0')),
+            latency_ms=float(os.getenv('MOCK_LLM_LATENCY_MS', '400')),
+            latency_sigma=float(os.getenv('MOCK_LLM_LATENCY_SIGMA', '0.5')),
+            tokens_per_second=float(os.getenv('MOCK_LLM_TOKENS_PER_SECOND', '60')),
+            reply_tokens=int(os.getenv('MOCK_LLM_REPLY_TOKENS', '120')),
+            error_rate_429=float(os.getenv('MOCK_LLM_ERROR_RATE_429', '0')),
+            error_rate_500=float(os.getenv('MOCK_LLM_ERROR_RATE_500', '0')),
+            timeout_rate=float(os.getenv('MOCK_LLM_TIMEOUT_RATE', '0')),
+            timeout_seconds=float(os.getenv('MOCK_LLM_TIMEOUT_SECONDS', '30')),
+            function_call_rate=float(os.getenv('MOCK_LLM_FUNCTION_CALL_RATE', '1.0')),
+            system_instruction=LLM_SYSTEM_INSTRUCTION,
+            context_cache=LLM_CONTEXT_CACHE,
+        )
+
+    def _rng(self, key):
+        digest = hashlib.sha256(f"{self.seed}:{key}".encode('utf-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def _failure(self, rng, timeout=None):
+        """(seconds until it fails, error) for an injected failure, else None"""
+        roll = rng.random()
+        if roll < self.error_rate_429:
+            return 0.0, MockError("429 Resource has been exhausted (e.g. check quota).")
+        roll -= self.error_rate_429
+        if roll < self.error_rate_500:
+            return 0.0, MockError("500 An internal error has occurred.")
+        roll -= self.error_rate_500
+        if roll < self.timeout_rate:
+            hang = self.timeout_seconds if timeout is None else min(timeout, self.timeout_seconds)
+            return hang, MockError("504 Deadline Exceeded: request timeout")
+        return None
+
+    def plan_text(self, key, prefix=""):
+        """Deterministic reply text for `key`, returned as (rng, parts)"""
+        rng = self._rng(key)
+        words = [rng.choice(_MOCK_WORDS) for _ in range(self.reply_tokens)]
+        sentences = []
+        for start in range(0, len(words), 12):
+            sentence = " ".join(words[start:start + 12])
+            sentences.append(sentence[:1].upper() + sentence[1:] + ".")
+        text = " ".join(filter(None, [prefix] + sentences))
+        return rng, [_MockPart(text=text)]
+
+    def plan_reply(self, message, turn):
+        rng = self._rng(f"{turn}:{message}")
+        expressions = _MATH_PATTERN.findall(message)
+        if expressions and rng.random() < self.function_call_rate:
+            return rng, [
+                _MockPart(function_call=_MockFunctionCall("do_math", {"expression": expression}))
+                for expression in expressions
+            ]
+        return self.plan_text(f"{turn}:{message}")
+
+    def script(self, plan, stream, timeout=None, prompt=(0, 0)):
+        """
+        Timing of the response for `plan`, as (failure, steps). `failure` is
+        None or (delay, error) for a call that fails; `steps` are (delay,
+        response) pairs, one for a plain call and one per chunk for a stream.
+        `timeout` cuts off a slow first token like the SDK's request timeout.
+        `prompt` is (prompt tokens, cached tokens) for usage_metadata.
+        """
+        rng, parts = plan
+        failure = self._failure(rng, timeout)
+        if failure:
+            return failure, []
+        first_token = rng.lognormvariate(0, self.latency_sigma) * self.latency_ms / 1000.0
+        if timeout is not None and first_token > timeout:
+            return (timeout, MockError("504 Deadline Exceeded: request timeout")), []
+
+        tokens = sum(len(part.text.split()) for part in parts)
+        usage = _MockUsage(prompt[0], prompt[1], tokens + sum(8 for part in parts if part.function_call))
+        if not stream:
+            return None, [(first_token + tokens / self.tokens_per_second, _MockResponse(parts, usage=usage))]
+
+        def pieces():
+            for part in parts:
+                if part.function_call:
+                    yield part, 0
+                    continue
+                words = part.text.split(" ")
+                for start in range(0, len(words), 8):
+                    piece = " ".join(words[start:start + 8])
+                    if start + 8 < len(words):
+                        piece += " "
+                    yield _MockPart(text=piece), len(words[start:start + 8])
+
+        steps = []
+        delay = first_token
+        pending = None
+        # Like the API, only the final chunk carries the complete usage
+        for part, words in pieces():
+            if pending is not None:
+                steps.append((delay, _MockResponse([pending])))
+                delay = 0.0
+            delay += words / self.tokens_per_second
+            pending = part
+        if pending is not None:
+            steps.append((delay, _MockResponse([pending], usage=usage)))
+        return None, steps
+
+    def respond(self, plan, stream, timeout=None, prompt=(0, 0)):
+        """The response for `plan` (see script), sleeping as long as it would take"""
+        failure, steps = self.script(plan, stream, timeout, prompt)
+        if failure:
+            time.sleep(failure[0])
+            raise failure[1]
+        if not stream:
+            time.sleep(steps[0][0])
+            return steps[0][1]
+
+        def chunks():
+            for delay, chunk in steps:
+                time.sleep(delay)
+                yield chunk
+        return chunks()
+
+    async def respond_async(self, plan, stream, timeout=None, prompt=(0, 0)):
+        """respond() for the asyncio chat path; waits without holding a thread"""
+        failure, steps = self.script(plan, stream, timeout, prompt)
+        if failure:
+            await asyncio.sleep(failure[0])
+            raise failure[1]
+        if not stream:
+            await asyncio.sleep(steps[0][0])
+            return steps[0][1]
+
+        async def chunks():
+            for delay, chunk in steps:
+                await asyncio.sleep(delay)
+                yield chunk
+        return chunks()
+
+    def prompt_strategy(self, persona=None):
+        if persona is None or not self.uses_system_instruction:
+            return PRIMING
+        return CONTEXT_CACHE if self.context_cache else SYSTEM_INSTRUCTION
+
+    def start_chat(self, history, persona=None):
+        if persona is None or not self.uses_system_instruction:
+            return _MockChat(self, history)
+        return _MockChat(self, history, persona.system_prompt["content"])
+
+    def generate_content(self, prompt, request_options=None, **kwargs):
+        timeout = (request_options or {}).get('timeout')
+        if "JSON array" in prompt:
+            count = len(re.findall(r"^\d+\. ", prompt, re.MULTILINE))
+            rng = self._rng(prompt)
+            titles = ", ".join(
+                '"' + " ".join(rng.choice(_MOCK_WORDS).title() for _ in range(3)) + '"'
+                for _ in range(count)
+            )
+            return self.respond((rng, [_MockPart(text=f"[{titles}]")]), False, timeout, (_mock_tokens(prompt), 0))
+        return self.respond(self.plan_text(prompt), False, timeout, (_mock_tokens(prompt), 0))
+
+    def count_tokens(self, text):
+        from app.history_window import estimate_tokens
+        return estimate_tokens(text)
+
+    def embed(self, texts, task='document'):
+        from app.memory_index import HashingEmbedder
+        return HashingEmbedder(64).embed(texts).tolist()
+
+    def function_response(self, name, result):
+        return _MockFunctionResponse(name, result)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Process-wide backend selected by LLM_BACKEND (gemini | mock)"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = os.getenv('LLM_BACKEND', 'gemini').lower()
+                if name == 'mock':
+                    _backend = MockBackend.from_env()
+                elif name == 'gemini':
+                    _backend = GeminiBackend(system_instruction=LLM_SYSTEM_INSTRUCTION, context_cache=LLM_CONTEXT_CACHE)
+                else:
+                    raise ValueError(f"Unknown LLM_BACKEND: {name}")
+                print(f"🤖 LLM backend: {_backend.name}")
+    return _backend
+
+
+def delete_context_caches():
+    """
+    Delete the persona context caches of every worker. Only call it once no
+    worker is left to use them (gunicorn's on_exit); returns how many went.
+    """
+    if os.getenv('LLM_BACKEND', 'gemini').lower() != 'gemini' or not (LLM_SYSTEM_INSTRUCTION and LLM_CONTEXT_CACHE):
+        return 0
+    import google.generativeai as genai
+    from google.generativeai import caching
+
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    deleted = 0
+    for cache in caching.CachedContent.list(page_size=100):
+        if cache.display_name.startswith(CONTEXT_CACHE_PREFIX):
+            cache.delete()
+            deleted += 1
+    return deleted
@@ -0,0 +1,294 @@
+"""
+Optional long-term retrieval memory.
+
+Every completed turn (user message + reply) is embedded and appended to a
+per-user index on disk under MEMORY_DIR:
+
+  user_<id>.<embedder>.vec    float32 rows, L2-normalized
+  user_<id>.<embedder>.ids    int64 rows of (user_message_id, reply_message_id, session_id)
+  user_<id>.<embedder>.json   {"dim": ...}
+
+A search memory-maps both files and scores every row with one matrix-vector
+product, so even a few hundred thousand turns per user are searched in
+milliseconds without loading the index into the heap. The best MEMORY_TOP_K
+turns scoring at least MEMORY_MIN_SCORE are added to the prompt by app.gemini.
+
+Embeddings come from a local feature-hashing embedder (MEMORY_EMBEDDER=hashing,
+the default, no network) or from the LLM backend (MEMORY_EMBEDDER=backend).
+Indexing runs on a background worker; `python manage.py reindex-memory`
+rebuilds the indexes from the message table.
+
+Disabled unless MEMORY_ENABLED is set, and needs numpy.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are still serialized within the process
+    fcntl = None
+
+from app import metrics
+from app.background import BatchWorker
+
+
+def _env_flag(name, default):
+    return os.getenv(name, str(default)).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+MEMORY_DIR = os.getenv('MEMORY_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'memory'))
+MEMORY_EMBEDDER = os.getenv('MEMORY_EMBEDDER', 'hashing').lower()
+MEMORY_DIM = int(os.getenv('MEMORY_DIM', '256'))
+MEMORY_TOP_K = int(os.getenv('MEMORY_TOP_K', '3'))
+MEMORY_MIN_SCORE = float(os.getenv('MEMORY_MIN_SCORE', '0.25'))
+MEMORY_ENABLED = _env_flag('MEMORY_ENABLED', False) and np is not None
+
+if _env_flag('MEMORY_ENABLED', False) and np is None:
+    print("⚠️ MEMORY_ENABLED is set but numpy is not installed; retrieval memory is off")
+
+_ID_COLUMNS = 3
+_WORD = re.compile(r"\w+")
+
+
+def _normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class HashingEmbedder:
+    """
+    Signed feature hashing of word unigrams and bigrams. Deterministic, offline
+    and fast enough to run on the request path.
+    """
+
+    name = 'hashing'
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _features(self, text):
+        words = _WORD.findall(text.casefold())
+        yield from words
+        for first, second in zip(words, words[1:]):
+            yield f"{first} {second}"
+
+    def embed(self, texts, task='document'):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+                vectors[row, digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        return _normalize_rows(vectors)
+
+
+class BackendEmbedder:
+    """Embeddings from the configured LLM backend (see app.llm_backends)"""
+
+    name = 'backend'
+
+    def embed(self, texts, task='document'):
+        from app.llm_backends import get_backend
+        return _normalize_rows(np.asarray(get_backend().embed(list(texts), task=task), dtype=np.float32))
+
+
+def get_embedder():
+    if MEMORY_EMBEDDER == 'backend':
+        return BackendEmbedder()
+    return HashingEmbedder(MEMORY_DIM)
+
+
+class UserIndex:
+    """Append-only memory-mapped index of one user's turns for one embedder"""
+
+    _locks = defaultdict(threading.Lock)
+
+    def __init__(self, user_id, embedder_name, directory=None):
+        base = os.path.join(directory or MEMORY_DIR, f"user_{int(user_id)}.{embedder_name}")
+        self.vec_path = base + '.vec'
+        self.ids_path = base + '.ids'
+        self.meta_path = base + '.json'
+        self.lock_path = base + '.lock'
+
+    def _dim(self):
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)['dim']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def rows(self, dim=None):
+        dim = dim or self._dim()
+        if not dim:
+            return 0
+        try:
+            vec_rows = os.path.getsize(self.vec_path) // (dim * 4)
+            id_rows = os.path.getsize(self.ids_path) // (_ID_COLUMNS * 8)
+        except OSError:
+            return 0
+        # An append in progress may have written its vectors but not its ids yet
+        return min(vec_rows, id_rows)
+
+    def append(self, vectors, ids):
+        vectors = np.ascontiguousarray(vectors, dtype='<f4')
+        ids = np.ascontiguousarray(ids, dtype='<i8').reshape(-1, _ID_COLUMNS)
+        os.makedirs(os.path.dirname(self.vec_path), exist_ok=True)
+
+        with UserIndex._locks[self.vec_path], open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                dim = self._dim()
+                if dim is None:
+                    dim = vectors.shape[1]
+                    with open(self.meta_path, 'w') as f:
+                        json.dump({'dim': dim}, f)
+                elif dim != vectors.shape[1]:
+                    raise ValueError(f"index dimension is {dim}, got vectors of {vectors.shape[1]}")
+
+                # Trim any torn tail from an interrupted append before adding rows
+                rows = self.rows(dim)
+                for path, row_bytes in ((self.vec_path, dim * 4), (self.ids_path, _ID_COLUMNS * 8)):
+                    with open(path, 'ab') as f:
+                        f.truncate(rows * row_bytes)
+                with open(self.vec_path, 'ab') as f:
+                    f.write(vectors.tobytes())
+                with open(self.ids_path, 'ab') as f:
+                    f.write(ids.tobytes())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def search(self, query, k, min_score=0.0, exclude_session_id=None, exclude_after_id=0):
+        """
+        Return [(score, user_message_id, reply_message_id, session_id), ...] best
+        first. Turns of `exclude_session_id` newer than `exclude_after_id` (already
+        in the prompt) are skipped.
+        """
+        dim = self._dim()
+        rows = self.rows(dim)
+        if not rows or k <= 0:
+            return []
+
+        vectors = np.memmap(self.vec_path, dtype='<f4', mode='r', shape=(rows, dim))
+        ids = np.memmap(self.ids_path, dtype='<i8', mode='r', shape=(rows, _ID_COLUMNS))
+        scores = vectors @ np.asarray(query, dtype=np.float32)
+        if exclude_session_id is not None:
+            scores[(ids[:, 2] == exclude_session_id) & (ids[:, 0] > exclude_after_id)] = -np.inf
+
+        k = min(k, rows)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (float(scores[i]), int(ids[i, 0]), int(ids[i, 1]), int(ids[i, 2]))
+            for i in top if scores[i] >= min_score
+        ]
+
+    def reset(self):
+        for path in (self.vec_path, self.ids_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def turn_text(user_content, reply_content):
+    return f"{user_content}\n{reply_content}"[:4000]
+
+
+def index_turns(turns):
+    """Embed and append [(user_id, user_message_id, reply_message_id, session_id, text), ...]"""
+    embedder = get_embedder()
+    by_user = defaultdict(list)
+    for turn in turns:
+        by_user[turn[0]].append(turn)
+
+    for user_id, user_turns in by_user.items():
+        with metrics.timed('memory.index'):
+            vectors = embedder.embed([turn[4] for turn in user_turns])
+            UserIndex(user_id, embedder.name).append(vectors, [turn[1:4] for turn in user_turns])
+        metrics.increment('memory.indexed_turns', len(user_turns))
+
+
+def search_memories(user_id, query_text, exclude_session_id=None, exclude_after_id=0):
+    """Top MEMORY_TOP_K earlier turns for `query_text` as (score, user_id, reply_id, session_id)"""
+    if not MEMORY_ENABLED:
+        return []
+    embedder = get_embedder()
+    with metrics.timed('memory.search'):
+        query = embedder.embed([query_text], task='query')[0]
+        hits = UserIndex(user_id, embedder.name).search(
+            query, MEMORY_TOP_K, MEMORY_MIN_SCORE, exclude_session_id, exclude_after_id
+        )
+    metrics.record('memory.hits', len(hits))
+    return hits
+
+
+def memory_rows_query(hits):
+    """(sql, params) fetching the messages behind search hits"""
+    message_ids = [hit[1] for hit in hits] + [hit[2] for hit in hits]
+    placeholders = ", ".join(["%s"] * len(message_ids))
+    return f"SELECT id, content, created_at FROM message WHERE id IN ({placeholders})", message_ids
+
+
+def memories_from_rows(hits, rows):
+    """Pair the fetched rows up into [{'user', 'reply', 'created_at', 'score'}, ...], best hit first"""
+    rows = {row['id']: row for row in rows}
+    memories = []
+    for score, user_message_id, reply_message_id, _ in hits:
+        if user_message_id in rows and reply_message_id in rows:
+            memories.append({
+                'user': rows[user_message_id]['content'],
+                'reply': rows[reply_message_id]['content'],
+                'created_at': rows[user_message_id]['created_at'],
+                'score': round(score, 3)
+            })
+    return memories
+
+
+def load_memories(cursor, hits):
+    """Resolve search hits to [{'user', 'reply', 'created_at', 'score'}, ...] via MySQL"""
+    if not hits:
+        return []
+    cursor.execute(*memory_rows_query(hits))
+    return memories_from_rows(hits, cursor.fetchall())
+
+
+def reindex_user(cursor, user_id, batch_size=500):
+    """Rebuild one user's index from the message table; returns the number of turns indexed"""
+    embedder = get_embedder()
+    UserIndex(user_id, embedder.name).reset()
+    cursor.execute("""
+        SELECT m.id, m.session_id, m.sender, m.content
+        FROM message m
+        JOIN session s ON s.id = m.session_id
+        WHERE s.user_id = %s
+        ORDER BY m.session_id, m.id
+    """, (user_id,))
+
+    turns = []
+    pending_user = None
+    for row in cursor.fetchall():
+        if row['sender'] == 'user':
+            pending_user = row
+        elif pending_user is not None and pending_user['session_id'] == row['session_id']:
+            turns.append((user_id, pending_user['id'], row['id'], row['session_id'],
+                          turn_text(pending_user['content'], row['content'])))
+            pending_user = None
+
+    for start in range(0, len(turns), batch_size):
+        index_turns(turns[start:start + batch_size])
+    return len(turns)
+
+
+# memory_worker.enqueue(user_id, user_message_id, reply_message_id, session_id, text)
+memory_worker = BatchWorker('memory', index_turns, batch_size=32, batch_wait=0.5)
@@ -0,0 +1,120 @@
+"""
+In-process metrics: latency percentiles, counters and gauges.
+
+Latencies (and other per-request values, via `record`) are kept in a bounded
+reservoir of the most recent samples per name, which is enough for p50/p99
+dashboards without an external metrics stack.
+Values are per worker process; `snapshot()` is served by /admin/metrics.
+"""
+import threading
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+
+RESERVOIR_SIZE = 2048
+
+_lock = threading.Lock()
+_latencies = defaultdict(lambda: deque(maxlen=RESERVOIR_SIZE))
+_latency_counts = defaultdict(int)
+_values = defaultdict(lambda: deque(maxlen=RESERVOIR_SIZE))
+_value_counts = defaultdict(int)
+_counters = defaultdict(float)
+_gauges = {}
+
+
+def observe(name, seconds):
+    """Record one latency sample (in seconds) under `name`"""
+    with _lock:
+        _latencies[name].append(seconds)
+        _latency_counts[name] += 1
+
+
+def record(name, value):
+    """Record one non-latency sample (a size, a count) under `name`"""
+    with _lock:
+        _values[name].append(value)
+        _value_counts[name] += 1
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+@contextmanager
+def timed(name):
+    """Context manager recording the wall time of its body under `name`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def _percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def latency_summary(name):
+    with _lock:
+        samples = sorted(_latencies.get(name, ()))
+        count = _latency_counts.get(name, 0)
+    if not samples:
+        return None
+    return {
+        'count': count,
+        'p50_ms': round(_percentile(samples, 0.50) * 1000, 2),
+        'p90_ms': round(_percentile(samples, 0.90) * 1000, 2),
+        'p99_ms': round(_percentile(samples, 0.99) * 1000, 2),
+        'max_ms': round(samples[-1] * 1000, 2),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 2)
+    }
+
+
+def value_summary(name):
+    with _lock:
+        samples = sorted(_values.get(name, ()))
+        count = _value_counts.get(name, 0)
+    if not samples:
+        return None
+    return {
+        'count': count,
+        'p50': _percentile(samples, 0.50),
+        'p90': _percentile(samples, 0.90),
+        'p99': _percentile(samples, 0.99),
+        'max': samples[-1],
+        'mean': round(sum(samples) / len(samples), 2)
+    }
+
+
+def snapshot():
+    with _lock:
+        names = list(_latencies.keys())
+        value_names = list(_values.keys())
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+    return {
+        'latencies': {name: latency_summary(name) for name in sorted(names)},
+        'values': {name: value_summary(name) for name in sorted(value_names)},
+        'counters': {name: counters[name] for name in sorted(counters)},
+        'gauges': {name: gauges[name] for name in sorted(gauges)}
+    }
+
+
+def reset():
+    with _lock:
+        _latencies.clear()
+        _latency_counts.clear()
+        _values.clear()
+        _value_counts.clear()
+        _counters.clear()
+        _gauges.clear()
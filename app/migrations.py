@@ -0,0 +1,354 @@
+"""
+Versioned schema migrations for the Flask Chatbot database.
+
+Each migration has an integer version, a name and `up`/`down` steps. A step is
+either a SQL string or a callable taking a cursor. Applied versions are recorded
+in the `schema_migrations` table so every migration runs exactly once.
+
+Run them with `python manage.py migrate` (see `python manage.py --help`).
+"""
+
+from app.db_utils import get_db_connection
+from app.counters import recompute_counters
+from app.usage import recompute_usage
+
+
+def _index_exists(cursor, table, index):
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+    """, (table, index))
+    return cursor.fetchone()[0] > 0
+
+
+def _ensure_fk_index(table, column):
+    """
+    MySQL silently drops the implicit foreign key index once a composite index
+    starting with the same column exists. Recreate it before that composite index
+    is dropped, otherwise the DROP fails with "needed in a foreign key constraint".
+    """
+    def step(cursor):
+        if not _index_exists(cursor, table, column):
+            cursor.execute(f"CREATE INDEX `{column}` ON `{table}` (`{column}`)")
+    return step
+
+
+MIGRATIONS = [
+    {
+        'version': 1,
+        'name': 'hot_query_indexes',
+        'up': [
+            # History reads: WHERE session_id = ? ORDER BY created_at
+            "CREATE INDEX idx_message_session_created ON message (session_id, created_at, id)",
+            # First-message check: COUNT(*) WHERE session_id = ? AND sender = 'user'
+            "CREATE INDEX idx_message_session_sender ON message (session_id, sender)",
+            # Latest active session: WHERE user_id = ? AND is_active ORDER BY id / created_at
+            "CREATE INDEX idx_session_user_active_id ON session (user_id, is_active, id)",
+            "CREATE INDEX idx_session_user_active_created ON session (user_id, is_active, created_at)",
+            # Admin pages: WHERE user_id = ? ORDER BY created_at and global ORDER BY created_at
+            "CREATE INDEX idx_session_user_created ON session (user_id, created_at)",
+            "CREATE INDEX idx_session_created ON session (created_at)",
+            # User listing: WHERE is_admin = 0 ORDER BY created_at
+            "CREATE INDEX idx_users_admin_created ON users (is_admin, created_at)",
+        ],
+        'down': [
+            "DROP INDEX idx_users_admin_created ON users",
+            "DROP INDEX idx_session_created ON session",
+            _ensure_fk_index('session', 'user_id'),
+            "DROP INDEX idx_session_user_created ON session",
+            "DROP INDEX idx_session_user_active_created ON session",
+            "DROP INDEX idx_session_user_active_id ON session",
+            _ensure_fk_index('message', 'session_id'),
+            "DROP INDEX idx_message_session_sender ON message",
+            "DROP INDEX idx_message_session_created ON message",
+        ]
+    },
+    {
+        'version': 2,
+        'name': 'message_microsecond_timestamps',
+        'up': [
+            "ALTER TABLE message MODIFY created_at TIMESTAMP(6) DEFAULT CURRENT_TIMESTAMP(6)",
+            # Rows written before this migration only carry a date. Spread each day's
+            # rows by id so created_at follows insertion order within every session.
+            """
+            UPDATE message m
+            JOIN (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY DATE(created_at) ORDER BY id) AS rn
+                FROM message
+                WHERE created_at = DATE(created_at)
+            ) ordered ON ordered.id = m.id
+            SET m.created_at = m.created_at + INTERVAL ordered.rn MICROSECOND
+            """,
+            # History reads: WHERE session_id = ? AND id > ? ORDER BY id. InnoDB's
+            # foreign key index on session_id already ends in the primary key and
+            # covers them, but migration 1's composite indexes let MySQL drop it.
+            # Put it back instead of adding a second (session_id, id) index.
+            _ensure_fk_index('message', 'session_id'),
+        ],
+        'down': [
+            "ALTER TABLE message MODIFY created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+        ]
+    },
+    {
+        'version': 3,
+        'name': 'denormalized_message_counters',
+        'up': [
+            """
+            ALTER TABLE session
+                ADD COLUMN message_count INT NOT NULL DEFAULT 0,
+                ADD COLUMN user_message_count INT NOT NULL DEFAULT 0,
+                ADD COLUMN last_message_at TIMESTAMP(6) NULL DEFAULT NULL
+            """,
+            """
+            ALTER TABLE users
+                ADD COLUMN session_count INT NOT NULL DEFAULT 0,
+                ADD COLUMN message_count INT NOT NULL DEFAULT 0,
+                ADD COLUMN user_message_count INT NOT NULL DEFAULT 0,
+                ADD COLUMN first_message_at TIMESTAMP(6) NULL DEFAULT NULL,
+                ADD COLUMN last_message_at TIMESTAMP(6) NULL DEFAULT NULL
+            """,
+            recompute_counters,
+            # The first-message check now reads session.user_message_count. Only
+            # the title backfill still filters on sender, and it walks the
+            # session_id index in id order, so migration 1's index only costs writes.
+            _ensure_fk_index('message', 'session_id'),
+            "DROP INDEX idx_message_session_sender ON message",
+        ],
+        'down': [
+            "CREATE INDEX idx_message_session_sender ON message (session_id, sender)",
+            """
+            ALTER TABLE users
+                DROP COLUMN last_message_at,
+                DROP COLUMN first_message_at,
+                DROP COLUMN user_message_count,
+                DROP COLUMN message_count,
+                DROP COLUMN session_count
+            """,
+            """
+            ALTER TABLE session
+                DROP COLUMN last_message_at,
+                DROP COLUMN user_message_count,
+                DROP COLUMN message_count
+            """,
+        ]
+    },
+    {
+        'version': 4,
+        'name': 'session_summaries',
+        'up': [
+            # Rolling summary of every message up to last_message_id (see app.summarizer)
+            """
+            CREATE TABLE session_summary (
+                session_id INT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                last_message_id INT NOT NULL,
+                summarized_messages INT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                FOREIGN KEY (session_id) REFERENCES session(id) ON DELETE CASCADE
+            )
+            """,
+        ],
+        'down': [
+            "DROP TABLE session_summary",
+        ]
+    },
+    {
+        'version': 5,
+        'name': 'chat_idempotency_keys',
+        'up': [
+            # Outcome of each Idempotency-Key per user (see app.turn_guard)
+            """
+            CREATE TABLE chat_idempotency (
+                user_id INT NOT NULL,
+                idempotency_key VARCHAR(64) NOT NULL,
+                request_hash CHAR(64) NOT NULL,
+                status ENUM('pending', 'done') NOT NULL DEFAULT 'pending',
+                response MEDIUMTEXT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, idempotency_key),
+                INDEX idx_chat_idempotency_created (created_at),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+            """,
+        ],
+        'down': [
+            "DROP TABLE chat_idempotency",
+        ]
+    },
+    {
+        'version': 6,
+        'name': 'message_usage_accounting',
+        'up': [
+            # Usage of the model calls behind each chatbot reply (see app.usage)
+            """
+            ALTER TABLE message
+                ADD COLUMN prompt_tokens INT NULL DEFAULT NULL,
+                ADD COLUMN output_tokens INT NULL DEFAULT NULL,
+                ADD COLUMN cached_tokens INT NULL DEFAULT NULL,
+                ADD COLUMN model VARCHAR(64) NULL DEFAULT NULL,
+                ADD COLUMN llm_latency_ms INT NULL DEFAULT NULL,
+                ADD COLUMN tool_calls SMALLINT NULL DEFAULT NULL,
+                ADD COLUMN finish_reason VARCHAR(32) NULL DEFAULT NULL
+            """,
+            # Daily rollup read by the admin usage endpoints
+            """
+            CREATE TABLE usage_daily (
+                day DATE NOT NULL,
+                user_id INT NOT NULL,
+                mode VARCHAR(50) NOT NULL,
+                replies INT NOT NULL DEFAULT 0,
+                model_replies INT NOT NULL DEFAULT 0,
+                prompt_tokens BIGINT NOT NULL DEFAULT 0,
+                output_tokens BIGINT NOT NULL DEFAULT 0,
+                cached_tokens BIGINT NOT NULL DEFAULT 0,
+                tool_calls INT NOT NULL DEFAULT 0,
+                llm_latency_ms BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, user_id, mode),
+                INDEX idx_usage_daily_user_day (user_id, day),
+                INDEX idx_usage_daily_mode_day (mode, day),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+            """,
+            recompute_usage,
+        ],
+        'down': [
+            "DROP TABLE usage_daily",
+            """
+            ALTER TABLE message
+                DROP COLUMN finish_reason,
+                DROP COLUMN tool_calls,
+                DROP COLUMN llm_latency_ms,
+                DROP COLUMN model,
+                DROP COLUMN cached_tokens,
+                DROP COLUMN output_tokens,
+                DROP COLUMN prompt_tokens
+            """,
+        ]
+    },
+]
+
+
+def _ensure_migrations_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _applied_versions(cursor):
+    cursor.execute("SELECT version FROM schema_migrations ORDER BY version")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _run_steps(cursor, steps):
+    for step in steps:
+        if callable(step):
+            step(cursor)
+        else:
+            cursor.execute(step)
+
+
+def latest_version():
+    return MIGRATIONS[-1]['version'] if MIGRATIONS else 0
+
+
+def migration_status():
+    """Return a list of (version, name, applied) tuples for every known migration"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        _ensure_migrations_table(cursor)
+        applied = set(_applied_versions(cursor))
+        return [(m['version'], m['name'], m['version'] in applied) for m in MIGRATIONS]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def migrate(target=None):
+    """
+    Apply pending migrations up to `target` (default: the latest version).
+    Returns the list of versions applied.
+    """
+    target = latest_version() if target is None else target
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    applied_now = []
+
+    try:
+        _ensure_migrations_table(cursor)
+        applied = set(_applied_versions(cursor))
+
+        for migration in MIGRATIONS:
+            version = migration['version']
+            if version in applied or version > target:
+                continue
+
+            print(f"⬆️  Applying migration {version:04d} {migration['name']}...")
+            _run_steps(cursor, migration['up'])
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (version, migration['name'])
+            )
+            conn.commit()
+            applied_now.append(version)
+            print(f"✓ Migration {version:04d} applied")
+
+        if not applied_now:
+            print("✓ Database schema is up to date")
+        return applied_now
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def rollback(target=None):
+    """
+    Revert applied migrations newer than `target` (default: only the most recent one).
+    Returns the list of versions reverted.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    reverted = []
+
+    try:
+        _ensure_migrations_table(cursor)
+        applied = _applied_versions(cursor)
+        if not applied:
+            print("✓ No migrations to roll back")
+            return reverted
+
+        if target is None:
+            target = applied[-2] if len(applied) > 1 else 0
+
+        by_version = {m['version']: m for m in MIGRATIONS}
+        for version in reversed(applied):
+            if version <= target:
+                break
+            migration = by_version.get(version)
+            if migration is None:
+                raise RuntimeError(f"Applied migration {version} is unknown to this codebase")
+
+            print(f"⬇️  Reverting migration {version:04d} {migration['name']}...")
+            _run_steps(cursor, migration['down'])
+            cursor.execute("DELETE FROM schema_migrations WHERE version = %s", (version,))
+            conn.commit()
+            reverted.append(version)
+            print(f"✓ Migration {version:04d} reverted")
+
+        return reverted
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
@@ -0,0 +1,76 @@
+"""
+Keyset (cursor) pagination helpers.
+
+Cursors are opaque, URL-safe strings wrapping the (created_at, id) of a row.
+Queries seek past that position with an index range scan instead of skipping
+OFFSET rows, so every page costs the same regardless of depth.
+"""
+import base64
+import datetime
+import json
+import threading
+import time
+
+
+MAX_PAGE_LIMIT = 200
+
+
+def encode_cursor(created_at, row_id):
+    payload = json.dumps([created_at.isoformat(), row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (created_at, id) for a cursor string; raises ValueError if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.datetime.fromisoformat(created_at), int(row_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def keyset_condition(created_column, id_column, operator, cursor):
+    """
+    SQL fragment and params selecting rows strictly before ('<') or after ('>')
+    the cursor position in (created_at, id) order.
+    """
+    created_at, row_id = decode_cursor(cursor)
+    sql = f"({created_column} {operator} %s OR ({created_column} = %s AND {id_column} {operator} %s))"
+    return sql, (created_at, created_at, row_id)
+
+
+def clamp_limit(limit, default=10):
+    if not limit or limit < 1:
+        return default
+    return min(limit, MAX_PAGE_LIMIT)
+
+
+class CountCache:
+    """Small TTL cache for COUNT(*) totals that pages display but don't need exactly"""
+
+    def __init__(self, ttl=30, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                return entry[0]
+
+        value = compute()
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[key] = (value, now + self.ttl)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
@@ -0,0 +1,134 @@
+"""
+Persona registry.
+
+Every persona is defined in one data file, app/personas.json (or the file
+named by PERSONAS_FILE). It holds the prompt, display names, identity
+phrases and canned replies, plus the per-error persona messages. The file is
+read once at import. Adding a persona is a data change: the chat pipeline,
+the MessageSchema mode check, summaries and the persona picker on the chat
+page all read from here.
+
+Per-request work is constant:
+
+- a persona is a dict lookup;
+- "who are you" questions are detected with one precompiled pattern per
+  persona, case-insensitively, without lowercasing the message;
+- the priming turns that start every chat history are built once and shared.
+"""
+import hashlib
+import json
+import os
+import re
+from types import MappingProxyType
+
+
+PERSONAS_FILE = os.getenv('PERSONAS_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'personas.json'))
+
+# Keys every persona must define under "replies"
+REPLY_KINDS = (
+    'empty', 'empty_after_cleanup', 'no_parts', 'no_candidates',
+    'rate_limited', 'bad_request', 'unavailable', 'error',
+    'turn_rate_limited', 'turn_timeout', 'turn_error',
+)
+
+
+class Persona:
+
+    def __init__(self, spec):
+        self.key = spec['key'].lower()
+        self.name = spec['name']
+        self.short_name = spec.get('short_name', self.name)
+        self.label = spec.get('label', self.name)
+        self.description = spec.get('description', '')
+        self.style = spec.get('style', '')
+        self.personality = spec.get('personality', '')
+        self.greeting = spec.get('greeting', '')
+        self.switch_note = spec.get('switch_note', f" [Previous response from another persona. I am now {self.name} responding as myself.]")
+        self.system_prompt = MappingProxyType({"role": "system", "content": spec['system_prompt']})
+        self.prompt_digest = hashlib.sha256(spec['system_prompt'].encode('utf-8')).hexdigest()
+        self.priming_reply = spec.get('priming_reply', f"I understand. I am {self.name}, embodying the persona you described.")
+
+        missing = [kind for kind in REPLY_KINDS if kind not in spec['replies']]
+        if missing:
+            raise ValueError(f"Persona '{self.key}' has no replies for: {', '.join(missing)}")
+        self.replies = MappingProxyType(dict(spec['replies']))
+
+        # One alternation over every identity phrase; the group name says which
+        # reply answers it. Earlier entries win when a message matches several.
+        self._identity_replies = {}
+        alternatives = []
+        for index, identity in enumerate(spec.get('identity', ())):
+            group = f"i{index}"
+            self._identity_replies[group] = (index, identity['reply'])
+            phrases = sorted(identity['phrases'], key=len, reverse=True)
+            alternatives.append(f"(?P<{group}>" + "|".join(re.escape(phrase) for phrase in phrases) + ")")
+        self._identity_pattern = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+
+        # Start of every chat history without a summary or memories; shared, never mutated
+        self.history_prefix = (
+            MappingProxyType({"role": "user", "parts": (self.system_prompt["content"],)}),
+            MappingProxyType({"role": "model", "parts": (self.priming_reply,)}),
+        )
+
+    def identity_reply(self, text):
+        """The canned introduction when `text` asks who the persona is, else None"""
+        if self._identity_pattern is None or not text:
+            return None
+        matches = self._identity_pattern.finditer(text)
+        best = min((self._identity_replies[match.lastgroup] for match in matches), default=None)
+        return best[1] if best else None
+
+    def reply(self, kind):
+        return self.replies[kind]
+
+    def describe(self):
+        return {
+            'key': self.key,
+            'name': self.name,
+            'label': self.label,
+            'description': self.description,
+            'style': self.style,
+            'personality': self.personality,
+            'greeting': self.greeting,
+        }
+
+
+class PersonaRegistry:
+
+    def __init__(self, data):
+        self.personas = {}
+        for spec in data['personas']:
+            persona = Persona(spec)
+            if persona.key in self.personas:
+                raise ValueError(f"Duplicate persona '{persona.key}'")
+            self.personas[persona.key] = persona
+        self.default = self.personas[data.get('default', next(iter(self.personas)))]
+        self.quota_exhausted_reply = data['quota_exhausted_reply']
+
+    @classmethod
+    def from_file(cls, path=None):
+        with open(path or PERSONAS_FILE, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def get(self, mode):
+        """The persona for `mode`, or the default persona for unknown modes"""
+        persona = self.personas.get(mode)
+        if persona is None and mode:
+            persona = self.personas.get(mode.lower())
+        return persona or self.default
+
+    def keys(self):
+        return list(self.personas)
+
+    def __iter__(self):
+        return iter(self.personas.values())
+
+    def __contains__(self, mode):
+        return bool(mode) and mode.lower() in self.personas
+
+
+personas = PersonaRegistry.from_file()
+
+
+def get_persona(mode):
+    return personas.get(mode)
@@ -0,0 +1,253 @@
+"""
+Client-side rate limiter for model calls.
+
+Three token buckets mirror the Gemini quota: requests per minute
+(GEMINI_RPM), tokens per minute (GEMINI_TPM) and requests per day
+(GEMINI_RPD, refilled continuously over 24h). A call first reserves one
+request and its estimated tokens from every bucket; when they are short it
+waits, up to RATE_LIMIT_MAX_WAIT seconds for interactive chat turns and
+RATE_LIMIT_BACKGROUND_MAX_WAIT for background work (titles, summaries). If
+the refill would take longer than that, RateLimitExceeded is raised at once
+instead of sending a request Google would reject.
+
+Background work may only spend capacity above RATE_LIMIT_INTERACTIVE_RESERVE
+of each bucket, so users' turns are never starved by it. When Google answers
+429 anyway, the minute buckets are drained so other callers back off too.
+
+Buckets are per process, or shared by every worker on the host through
+RATE_LIMIT_SHARED_FILE (needs fcntl). RATE_LIMIT_ENABLED defaults to on for
+the Gemini backend and off for the mock. `usage()` is served by /admin/metrics.
+`acquire_async` is the same budget for the asyncio chat path (app.asgi).
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from app import metrics
+
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+
+class RateLimitExceeded(Exception):
+    """The request would exceed the client-side budget for longer than the caller may wait"""
+
+    def __init__(self, bucket, retry_after):
+        self.bucket = bucket
+        self.retry_after = retry_after
+        super().__init__(f"429 client-side rate limit: {bucket} budget exhausted, retry in {retry_after:.1f}s")
+
+
+class Reservation:
+    """Capacity taken for one call; `settle` corrects the token estimate afterwards"""
+
+    def __init__(self, limiter, tokens):
+        self.limiter = limiter
+        self.tokens = tokens
+
+    def settle(self, response):
+        usage = getattr(response, 'usage_metadata', None)
+        actual = getattr(usage, 'total_token_count', None) if usage is not None else None
+        if actual:
+            self.limiter.adjust_tokens(actual - self.tokens)
+            metrics.record('rate_limit.token_estimate_error', actual - self.tokens)
+            self.tokens = actual
+
+
+class RateLimiter:
+
+    def __init__(self, rpm=10, tpm=250000, rpd=250, reserve=0.2, max_wait=8.0,
+                 background_max_wait=60.0, shared_file=None, enabled=True):
+        # name -> (capacity, refill per second); a capacity of 0 disables the bucket
+        self.limits = {
+            'rpm': (rpm, rpm / 60.0),
+            'tpm': (tpm, tpm / 60.0),
+            'rpd': (rpd, rpd / 86400.0),
+        }
+        self.limits = {name: limit for name, limit in self.limits.items() if limit[0] > 0}
+        self.reserve = reserve
+        self.max_wait = {INTERACTIVE: max_wait, BACKGROUND: background_max_wait}
+        self.shared_file = shared_file if fcntl is not None else None
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+
+    @classmethod
+    def from_env(cls):
+        enabled = os.getenv('RATE_LIMIT_ENABLED', 'auto').strip().lower()
+        if enabled == 'auto':
+            enabled = os.getenv('LLM_BACKEND', 'gemini').lower() == 'gemini'
+        else:
+            enabled = enabled in ('1', 'true', 'yes', 'on')
+        return cls(
+            rpm=int(os.getenv('GEMINI_RPM', '10')),
+            tpm=int(os.getenv('GEMINI_TPM', '250000')),
+            rpd=int(os.getenv('GEMINI_RPD', '250')),
+            reserve=float(os.getenv('RATE_LIMIT_INTERACTIVE_RESERVE', '0.2')),
+            max_wait=float(os.getenv('RATE_LIMIT_MAX_WAIT', '8')),
+            background_max_wait=float(os.getenv('RATE_LIMIT_BACKGROUND_MAX_WAIT', '60')),
+            shared_file=os.getenv('RATE_LIMIT_SHARED_FILE') or None,
+            enabled=enabled,
+        )
+
+    @contextmanager
+    def _state(self):
+        """Bucket state {name: [available, updated_at]}, locked for the duration"""
+        with self._lock:
+            if not self.shared_file:
+                yield self._buckets
+                return
+            with open(self.shared_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or '{}')
+                    except ValueError:
+                        state = {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refill(self, state, now):
+        for name, (capacity, rate) in self.limits.items():
+            available, updated_at = state.get(name, (capacity, now))
+            state[name] = [min(capacity, available + max(0.0, now - updated_at) * rate), now]
+
+    def _try_take(self, amounts, priority):
+        """Take `amounts` if possible and return 0, else return (seconds to wait, bucket)"""
+        now = time.time()
+        with self._state() as state:
+            self._refill(state, now)
+            longest, bucket = 0.0, None
+            for name, amount in amounts.items():
+                capacity, rate = self.limits[name]
+                floor = capacity * self.reserve if priority == BACKGROUND else 0.0
+                shortfall = min(amount, capacity - floor) + floor - state[name][0]
+                if shortfall > 0 and shortfall / rate > longest:
+                    longest, bucket = shortfall / rate, name
+            if bucket is None:
+                for name, amount in amounts.items():
+                    state[name][0] -= min(amount, self.limits[name][0])
+                return 0.0, None
+            return longest, bucket
+
+    def _acquiring(self, estimated_tokens, priority, max_wait):
+        """
+        The acquire loop for both callers: yields the seconds to sleep before
+        the next try and returns the Reservation (as StopIteration.value).
+        """
+        amounts = {name: (estimated_tokens if name == 'tpm' else 1) for name in self.limits}
+        start = time.monotonic()
+        wait_limit = self.max_wait[priority]
+        if max_wait is not None:
+            wait_limit = min(wait_limit, max_wait)
+        deadline = start + wait_limit
+        waiting = False
+        try:
+            while True:
+                wait, bucket = self._try_take(amounts, priority)
+                if not wait:
+                    break
+                if time.monotonic() + wait > deadline:
+                    metrics.increment(f'rate_limit.rejected.{bucket}')
+                    raise RateLimitExceeded(bucket, wait)
+                if not waiting:
+                    waiting = True
+                    with self._lock:
+                        self._waiting[priority] += 1
+                yield min(wait, 0.5)
+        finally:
+            if waiting:
+                with self._lock:
+                    self._waiting[priority] -= 1
+
+        waited = time.monotonic() - start
+        metrics.observe(f'rate_limit.wait.{priority}', waited)
+        return Reservation(self, estimated_tokens if 'tpm' in self.limits else 0)
+
+    def acquire(self, estimated_tokens, priority=INTERACTIVE, max_wait=None):
+        """
+        Reserve one request and `estimated_tokens`, waiting up to the priority's
+        max wait (or `max_wait` if shorter). Returns a Reservation; raises
+        RateLimitExceeded.
+        """
+        if not self.enabled:
+            return Reservation(self, 0)
+        steps = self._acquiring(estimated_tokens, priority, max_wait)
+        try:
+            while True:
+                time.sleep(next(steps))
+        except StopIteration as done:
+            return done.value
+
+    async def acquire_async(self, estimated_tokens, priority=INTERACTIVE, max_wait=None):
+        """acquire() for the asyncio chat path; waiting for capacity does not block the event loop"""
+        if not self.enabled:
+            return Reservation(self, 0)
+        steps = self._acquiring(estimated_tokens, priority, max_wait)
+        try:
+            while True:
+                await asyncio.sleep(next(steps))
+        except StopIteration as done:
+            return done.value
+
+    def adjust_tokens(self, delta):
+        """Charge (positive) or refund (negative) tokens once the real usage is known"""
+        if not self.enabled or 'tpm' not in self.limits or not delta:
+            return
+        with self._state() as state:
+            self._refill(state, time.time())
+            capacity = self.limits['tpm'][0]
+            state['tpm'][0] = max(-capacity, min(capacity, state['tpm'][0] - delta))
+
+    def report_throttled(self):
+        """The API returned 429 despite the local budget: make everyone back off"""
+        if not self.enabled:
+            return
+        metrics.increment('rate_limit.server_throttled')
+        with self._state() as state:
+            self._refill(state, time.time())
+            for name in ('rpm', 'tpm'):
+                if name in state:
+                    state[name][0] = min(state[name][0], 0.0)
+
+    def usage(self):
+        if not self.enabled:
+            return {'enabled': False}
+        with self._state() as state:
+            self._refill(state, time.time())
+            buckets = {
+                name: {
+                    'capacity': capacity,
+                    'available': round(state[name][0], 1),
+                    'used_fraction': round(1 - state[name][0] / capacity, 3),
+                }
+                for name, (capacity, _) in self.limits.items()
+            }
+        with self._lock:
+            waiting = dict(self._waiting)
+        return {
+            'enabled': True,
+            'shared': bool(self.shared_file),
+            'interactive_reserve': self.reserve,
+            'buckets': buckets,
+            'waiting': waiting
+        }
+
+
+rate_limiter = RateLimiter.from_env()
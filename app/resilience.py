@@ -0,0 +1,346 @@
+"""
+Deadlines, retries and a circuit breaker around model calls.
+
+`call(attempt, deadline, estimated_tokens, priority)` takes capacity from
+app.rate_limiter and runs `attempt(timeout)`, passing the seconds left until
+`deadline` (a time.monotonic() value) so the SDK request can be given that
+timeout. A retryable failure (429 other than the daily quota, 5xx,
+timeouts, dropped connections) is retried up to LLM_MAX_RETRIES times with
+full-jitter exponential backoff. A retry is only made if its backoff still
+ends before the deadline.
+
+All calls in a worker process share one circuit breaker. It keeps the last
+LLM_BREAKER_WINDOW outcomes. Once at least LLM_BREAKER_MIN_CALLS are known
+and either of these crosses its threshold, the breaker opens:
+
+- the share of upstream failures (LLM_BREAKER_FAILURE_RATE);
+- the share of calls slower than LLM_BREAKER_SLOW_CALL_SECONDS
+  (LLM_BREAKER_SLOW_CALL_RATE).
+
+While the breaker is open, calls fail at once with CircuitOpen, so chat turns
+get the persona outage message without waiting on a sick upstream. After
+LLM_BREAKER_COOLDOWN seconds, one probe call is let through (half-open). If
+it succeeds the breaker closes; if not it opens again.
+
+A streamed call (`stream=True`) is recorded once its stream has been
+consumed, so an upstream that fails after the first chunk still counts as a
+failure; it counts as slow when its first chunk took that long.
+
+State changes are counted under `llm.breaker.*`, and the `llm.breaker.state`
+gauge holds 0 for closed, 1 for half-open and 2 for open. Retries and
+deadline hits are counted under `llm.*`. `call_async` is the same policy for
+coroutine attempts (the asyncio chat path in app.asgi).
+"""
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from app import metrics
+from app.rate_limiter import rate_limiter, RateLimitExceeded, INTERACTIVE
+
+
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', '25'))
+LLM_BACKGROUND_TIMEOUT = float(os.getenv('LLM_BACKGROUND_TIMEOUT', '60'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', '0.5'))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', '4'))
+
+# Seconds of a client's timeout kept back for the database work around the model call
+REQUEST_TIMEOUT_MARGIN = 2.0
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+_STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_RETRYABLE_CODES = {429, 500, 502, 503, 504}
+_STATUS_PREFIX = re.compile(r"\s*(\d{3})\b")
+
+
+class CircuitOpen(Exception):
+    """The breaker is open; the call was not attempted"""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"503 LLM circuit open: upstream unhealthy, retry in {retry_after:.0f}s")
+
+
+class DeadlineExceeded(Exception):
+    """No time is left before the caller's deadline to attempt the call"""
+
+    def __init__(self):
+        super().__init__("504 Deadline Exceeded: no time left for the model call")
+
+
+def request_deadline(requested_timeout=None):
+    """
+    Deadline for the model calls of one HTTP request. `requested_timeout` is
+    the client's own timeout (X-Request-Timeout) and can only shorten
+    LLM_REQUEST_TIMEOUT.
+    """
+    timeout = LLM_REQUEST_TIMEOUT
+    try:
+        if requested_timeout is not None:
+            timeout = min(timeout, max(1.0, float(requested_timeout) - REQUEST_TIMEOUT_MARGIN))
+    except (TypeError, ValueError):
+        pass
+    return time.monotonic() + timeout
+
+
+def _remaining(deadline):
+    return deadline - time.monotonic() if deadline is not None else None
+
+
+def background_deadline():
+    return time.monotonic() + LLM_BACKGROUND_TIMEOUT
+
+
+def request_options(timeout):
+    """SDK request options for an attempt with `timeout` seconds left"""
+    return {'timeout': timeout} if timeout is not None else {}
+
+
+def _status_code(error):
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code
+    match = _STATUS_PREFIX.match(str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_retryable(error):
+    if isinstance(error, (RateLimitExceeded, CircuitOpen, DeadlineExceeded)):
+        return False
+    if "PerDay" in str(error):
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return _status_code(error) in _RETRYABLE_CODES
+
+
+def is_upstream_failure(error):
+    """Errors that say the upstream is unhealthy, as opposed to quota or bad requests"""
+    return is_retryable(error) and _status_code(error) != 429
+
+
+class CircuitBreaker:
+
+    def __init__(self, window=20, min_calls=5, failure_rate=0.5, slow_call_seconds=15.0,
+                 slow_call_rate=0.5, cooldown=30.0):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)  # (failed, slow)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        metrics.set_gauge('llm.breaker.state', _STATE_GAUGE[CLOSED])
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            window=int(os.getenv('LLM_BREAKER_WINDOW', '20')),
+            min_calls=int(os.getenv('LLM_BREAKER_MIN_CALLS', '5')),
+            failure_rate=float(os.getenv('LLM_BREAKER_FAILURE_RATE', '0.5')),
+            slow_call_seconds=float(os.getenv('LLM_BREAKER_SLOW_CALL_SECONDS', '15')),
+            slow_call_rate=float(os.getenv('LLM_BREAKER_SLOW_CALL_RATE', '0.5')),
+            cooldown=float(os.getenv('LLM_BREAKER_COOLDOWN', '30')),
+        )
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        print(f"⚡ LLM CIRCUIT: {self.state} -> {state}")
+        self.state = state
+        metrics.increment(f'llm.breaker.{state}')
+        metrics.set_gauge('llm.breaker.state', _STATE_GAUGE[state])
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == CLOSED:
+            self._outcomes.clear()
+
+    def before_call(self):
+        """Admit a call or raise CircuitOpen"""
+        with self._lock:
+            if self.state == OPEN:
+                retry_after = self._opened_at + self.cooldown - time.monotonic()
+                if retry_after > 0:
+                    metrics.increment('llm.breaker.rejected')
+                    raise CircuitOpen(retry_after)
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    metrics.increment('llm.breaker.rejected')
+                    raise CircuitOpen(self.cooldown)
+                self._probing = True
+
+    def cancel(self):
+        """The admitted call was never sent"""
+        with self._lock:
+            self._probing = False
+
+    def record(self, failed, elapsed):
+        slow = elapsed >= self.slow_call_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                self._transition(OPEN if failed or slow else CLOSED)
+                return
+            self._outcomes.append((failed, slow))
+            calls = len(self._outcomes)
+            if self.state == CLOSED and calls >= self.min_calls:
+                failures = sum(1 for outcome in self._outcomes if outcome[0])
+                slow_calls = sum(1 for outcome in self._outcomes if outcome[1])
+                if failures / calls >= self.failure_rate or slow_calls / calls >= self.slow_call_rate:
+                    self._transition(OPEN)
+
+    def status(self):
+        with self._lock:
+            calls = len(self._outcomes)
+            return {
+                'state': self.state,
+                'window_calls': calls,
+                'window_failures': sum(1 for outcome in self._outcomes if outcome[0]),
+                'window_slow_calls': sum(1 for outcome in self._outcomes if outcome[1]),
+                'retry_after': round(max(0.0, self._opened_at + self.cooldown - time.monotonic()), 1)
+                if self.state == OPEN else 0
+            }
+
+
+llm_breaker = CircuitBreaker.from_env()
+
+
+def _deadline_left(breaker, deadline):
+    """Seconds left for the attempt; raises DeadlineExceeded when none are"""
+    timeout = _remaining(deadline)
+    if timeout is not None and timeout <= 0:
+        breaker.cancel()
+        metrics.increment('llm.deadline_exceeded')
+        raise DeadlineExceeded()
+    return timeout
+
+
+def _retry_delay(error, breaker, elapsed, tries, retries, deadline):
+    """Record a failed attempt; returns the backoff before the next one, or re-raises `error`"""
+    breaker.record(is_upstream_failure(error), elapsed)
+    if _status_code(error) == 429:
+        rate_limiter.report_throttled()
+    if not is_retryable(error) or tries >= retries:
+        raise error
+    delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** tries))
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        metrics.increment('llm.deadline_exceeded')
+        raise error
+    metrics.increment('llm.retries')
+    print(f"🔁 LLM RETRY {tries + 1}/{retries} in {delay:.2f}s after: {str(error)[:120]}")
+    return delay
+
+
+def _recorded_stream(stream, breaker, start):
+    """Iterate `stream`, recording its outcome with the breaker once it ends"""
+    first_chunk = None
+    try:
+        for chunk in stream:
+            if first_chunk is None:
+                first_chunk = time.monotonic() - start
+            yield chunk
+    except GeneratorExit:
+        # The consumer stopped early; the upstream did nothing wrong
+        breaker.cancel()
+        raise
+    except Exception as e:
+        breaker.record(is_upstream_failure(e), time.monotonic() - start if first_chunk is None else first_chunk)
+        raise
+    breaker.record(False, time.monotonic() - start if first_chunk is None else first_chunk)
+
+
+async def _recorded_stream_async(stream, breaker, start):
+    """_recorded_stream for async iterators"""
+    first_chunk = None
+    try:
+        async for chunk in stream:
+            if first_chunk is None:
+                first_chunk = time.monotonic() - start
+            yield chunk
+    except GeneratorExit:
+        breaker.cancel()
+        raise
+    except Exception as e:
+        breaker.record(is_upstream_failure(e), time.monotonic() - start if first_chunk is None else first_chunk)
+        raise
+    breaker.record(False, time.monotonic() - start if first_chunk is None else first_chunk)
+
+
+def call(attempt, deadline=None, estimated_tokens=0, priority=INTERACTIVE, retries=None, breaker=None,
+         stream=False):
+    """
+    Run `attempt(timeout)` under the breaker and the rate limiter, retrying
+    retryable failures until `deadline`. `timeout` is the seconds left (None
+    without a deadline). Returns (result, reservation); the reservation is
+    already settled against `result`, so only streamed responses need to
+    settle it again once consumed. With `stream` the result is an iterator
+    whose outcome reaches the breaker when it is exhausted; only failures
+    before the stream is returned are retried.
+    """
+    breaker = breaker or llm_breaker
+    retries = LLM_MAX_RETRIES if retries is None else retries
+    tries = 0
+    while True:
+        breaker.before_call()
+        try:
+            reservation = rate_limiter.acquire(estimated_tokens, priority, max_wait=_remaining(deadline))
+        except RateLimitExceeded:
+            breaker.cancel()
+            raise
+        timeout = _deadline_left(breaker, deadline)
+
+        start = time.monotonic()
+        try:
+            result = attempt(timeout)
+        except Exception as e:
+            time.sleep(_retry_delay(e, breaker, time.monotonic() - start, tries, retries, deadline))
+            tries += 1
+            continue
+
+        reservation.settle(result)
+        if stream:
+            return _recorded_stream(result, breaker, start), reservation
+        breaker.record(False, time.monotonic() - start)
+        return result, reservation
+
+
+async def call_async(attempt, deadline=None, estimated_tokens=0, priority=INTERACTIVE, retries=None, breaker=None,
+                     stream=False):
+    """call() for coroutine attempts: `await attempt(timeout)`, backing off with asyncio.sleep"""
+    breaker = breaker or llm_breaker
+    retries = LLM_MAX_RETRIES if retries is None else retries
+    tries = 0
+    while True:
+        breaker.before_call()
+        try:
+            reservation = await rate_limiter.acquire_async(estimated_tokens, priority, max_wait=_remaining(deadline))
+        except RateLimitExceeded:
+            breaker.cancel()
+            raise
+        timeout = _deadline_left(breaker, deadline)
+
+        start = time.monotonic()
+        try:
+            result = await attempt(timeout)
+        except Exception as e:
+            await asyncio.sleep(_retry_delay(e, breaker, time.monotonic() - start, tries, retries, deadline))
+            tries += 1
+            continue
+
+        reservation.settle(result)
+        if stream:
+            return _recorded_stream_async(result, breaker, start), reservation
+        breaker.record(False, time.monotonic() - start)
+        return result, reservation
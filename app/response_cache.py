@@ -0,0 +1,163 @@
+"""
+Response cache in front of the chat model call.
+
+Replies are keyed on a SHA-256 of the normalized (mode, system prompt version,
+history window sent to the model, session summary, memories, user message,
+generation config) and stored already post-processed, so a hit is returned
+as-is. A turn with any prior context (history, summary or memories) also has
+the user id in its key, so only opening messages are shared between users. Entries live in a bounded
+in-process LRU with a TTL; when RESPONSE_CACHE_REDIS_URL is set (and the
+`redis` package is installed) they are also written to Redis so every gunicorn
+worker shares hits.
+
+Settings:
+
+  RESPONSE_CACHE_ENABLED          Turn the cache on or off (default True)
+  RESPONSE_CACHE_MAX_ENTRIES      In-process LRU size (default 1024)
+  RESPONSE_CACHE_TTL              Seconds a reply stays cached (default 3600)
+  RESPONSE_CACHE_DISABLED_MODES   Comma-separated personas that are never cached
+  RESPONSE_CACHE_REDIS_URL        Optional shared cache, e.g. redis://localhost:6379/0
+
+Hits, misses, stores and evictions are counted under `response_cache.*` in app.metrics.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from app import metrics
+
+
+# Bump when post-processing or prompt assembly changes so old entries stop matching
+PROMPT_VERSION = 3
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize(text):
+    return _WHITESPACE.sub(" ", text or "").strip().casefold()
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries=1024, ttl=3600, disabled_modes=(), redis_url=None, enabled=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disabled_modes = {mode.strip().lower() for mode in disabled_modes if mode.strip()}
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = self._connect_redis(redis_url) if redis_url else None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1024')),
+            ttl=float(os.getenv('RESPONSE_CACHE_TTL', '3600')),
+            disabled_modes=os.getenv('RESPONSE_CACHE_DISABLED_MODES', '').split(','),
+            redis_url=os.getenv('RESPONSE_CACHE_REDIS_URL') or None,
+            enabled=os.getenv('RESPONSE_CACHE_ENABLED', 'True').strip().lower() in ('1', 'true', 'yes', 'on'),
+        )
+
+    @staticmethod
+    def _connect_redis(url):
+        try:
+            import redis
+        except ImportError:
+            print("⚠️ RESPONSE_CACHE_REDIS_URL is set but the redis package is not installed; using the in-process cache only")
+            return None
+        return redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+
+    def allows(self, mode):
+        return self.enabled and mode.lower() not in self.disabled_modes
+
+    def make_key(self, persona, window, message, generation_config, summary=None, memories=None, user_id=None):
+        """
+        Cache key for `persona` (app.personas) answering `message` after `window`,
+        the history replayed to the model (app.history_window.select_window).
+        With any prior context the key belongs to `user_id` alone.
+        """
+        private = bool(window or summary or memories)
+        material = {
+            'v': PROMPT_VERSION,
+            'user': user_id if private else None,
+            'mode': persona.key,
+            'prompt': persona.prompt_digest,
+            'history': [
+                [msg["sender"], (msg.get("mode") or "fraude").lower(), _normalize(msg["content"])]
+                for msg in window
+            ],
+            'summary': hashlib.sha256(summary.encode('utf-8')).hexdigest() if summary else None,
+            'memories': [_normalize(memory['user'] + "\n" + memory['reply']) for memory in memories or ()],
+            'message': _normalize(message),
+            'config': generation_config,
+        }
+        encoded = json.dumps(material, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        return "chat-reply:" + hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    metrics.increment('response_cache.hits')
+                    return entry[0]
+                del self._entries[key]
+                metrics.increment('response_cache.expired')
+
+        if self._redis is not None:
+            try:
+                value = self._redis.get(key)
+            except Exception as e:
+                print(f"⚠️ RESPONSE CACHE: redis get failed: {str(e)}")
+                value = None
+            if value is not None:
+                value = value.decode('utf-8')
+                self._store_local(key, value, now)
+                metrics.increment('response_cache.hits')
+                metrics.increment('response_cache.shared_hits')
+                return value
+
+        metrics.increment('response_cache.misses')
+        return None
+
+    def _store_local(self, key, value, now):
+        with self._lock:
+            self._entries[key] = (value, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                metrics.increment('response_cache.evictions')
+
+    def set(self, key, value):
+        self._store_local(key, value, time.monotonic())
+        metrics.increment('response_cache.stores')
+        if self._redis is not None:
+            try:
+                self._redis.set(key, value.encode('utf-8'), ex=max(1, int(self.ttl)))
+            except Exception as e:
+                print(f"⚠️ RESPONSE CACHE: redis set failed: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {
+            'enabled': self.enabled,
+            'entries': size,
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'shared': self._redis is not None,
+            'disabled_modes': sorted(self.disabled_modes)
+        }
+
+
+response_cache = ResponseCache.from_env()
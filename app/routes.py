@@ -1,15 +1,28 @@
-from flask import Blueprint, request, jsonify, render_template, redirect
-from .db_utils import get_db_connection
+from flask import Blueprint, request, jsonify, render_template, redirect, Response, stream_with_context
+from .db_utils import get_db_connection, get_pool_stats, expect_write
 import mysql.connector
 from werkzeug.security import generate_password_hash, check_password_hash
-import jwt
 import datetime
 import os
+import time
 import logging
-from app.gemini import chat_with_gemini
-from app.gemini import generate_session_title
+from app.chat_turn import run_chat_turn, stream_chat_turn
+import json
+from app import metrics
+from app.response_cache import response_cache
+from app.rate_limiter import rate_limiter
+from app.resilience import llm_breaker, request_deadline
+from app.tools import tool_pool
+from app.usage import usage_report
+from app import turn_guard
+from app.turn_guard import IdempotencyConflict, SessionBusy
+from app.personas import personas
+from app.pagination import encode_cursor, keyset_condition, clamp_limit, CountCache
+from app.counters import record_session
+from app.auth import (
+    decode_token, encode_token, page_user, require_auth, require_admin, require_admin_page
+)
 from marshmallow import Schema, fields, validate, ValidationError
-from functools import wraps
 
 
 logging.basicConfig(
@@ -23,52 +36,7 @@ logger = logging.getLogger(__name__)
 
 main = Blueprint('main', __name__)
 
-
-def validate_token(token):
-    """Validate JWT token and return decoded payload or None"""
-    if not token:
-        return None
-    try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        return decoded
-    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-        return None
-
-
-def require_auth(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify({'error': 'Token is missing!'}), 401
-        
-        token = auth_header.split(" ")[1]
-        decoded = validate_token(token)
-        if not decoded:
-            return jsonify({'error': 'Invalid or expired token!'}), 401
-        
-    
-        request.current_user = decoded
-        return f(*args, **kwargs)
-    return decorated_function
-
-
-def require_admin(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify({'error': 'Token is missing!'}), 401
-        
-        token = auth_header.split(" ")[1]
-        decoded = validate_token(token)
-        if not decoded or not decoded.get('is_admin'):
-            return jsonify({'error': 'Admin privileges required!'}), 403
-        
-        
-        request.current_user = decoded
-        return f(*args, **kwargs)
-    return decorated_function
+count_cache = CountCache(ttl=int(os.getenv('PAGINATION_COUNT_TTL', '30')))
 
 
 @main.after_request
@@ -105,15 +73,9 @@ def home():
 @main.route('/register', methods=['GET'])
 def register_page():
    
-    token = request.cookies.get('token')
-    if token:
-        try:
-            decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-            if decoded.get('user_id') and not decoded.get('is_admin'):
-                return redirect('/chat')
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-            
-            pass
+    decoded = page_user()
+    if decoded and decoded.get('user_id') and not decoded.get('is_admin'):
+        return redirect('/chat')
     
     return render_template('register.html')
 
@@ -124,12 +86,12 @@ def chat_page():
     if not token:
         return redirect('/login')
     
-    try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
+    decoded = page_user()
+    if decoded:
         if not decoded.get('user_id'):
             return redirect('/login')
-        return render_template('chat.html')
-    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
+        return render_template('chat.html', personas=personas)
+    else:
         
         response = redirect('/login')
         response.set_cookie('token', '', expires=0)
@@ -142,7 +104,7 @@ def login_page():
     token = request.cookies.get('token')
     if token:
         try:
-            decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
+            decoded = decode_token(token)
             
             if decoded.get('user_id') and not decoded.get('is_admin'):
                 return redirect('/chat')
@@ -170,15 +132,9 @@ def login_page():
 @main.route('/admin/login', methods=['GET'])
 def admin_login_page():
     
-    token = request.cookies.get('token')
-    if token:
-        try:
-            decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-            if decoded.get('is_admin'):
-                return redirect('/admin')
-        except:
-          
-            pass
+    decoded = page_user()
+    if decoded and decoded.get('is_admin'):
+        return redirect('/admin')
     return render_template('admin_login.html')
 
 @main.route('/login', methods=['POST'])
@@ -210,15 +166,7 @@ def login():
                 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)
             }
             
-            token = jwt.encode(
-                payload,
-                os.getenv('SECRET_KEY'),
-                algorithm="HS256"
-            )
-            
-           
-            if isinstance(token, bytes):
-                token = token.decode('utf-8')
+            token = encode_token(payload)
            
             redirect_url = '/admin' if user['is_admin'] else '/chat'
 
@@ -266,38 +214,11 @@ def login():
 
 
 @main.route('/admin', methods=['GET'])
+@require_admin_page
 def admin_dashboard():
-    
-    token = request.cookies.get('token')
-    
-    if not token:
-        
-        response = redirect('/login')
-        response.set_cookie('token', '', expires=0)
-        return response
-    
     try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        if not decoded.get('is_admin'):
-            
-            response = redirect('/login')
-            response.set_cookie('token', '', expires=0)
-            return response
-
-        
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
-        
-        cursor.execute("SELECT id, is_admin FROM users WHERE id = %s AND is_admin = 1", 
-                      (decoded.get('user_id'),))
-        admin_user = cursor.fetchone()
-        
-        if not admin_user:
-            cursor.close()
-            conn.close()
-            response = redirect('/login')
-            response.set_cookie('token', '', expires=0)
-            return response
 
         cursor.execute("SELECT COUNT(*) as total_users FROM users WHERE is_admin = 0")
         total_users = cursor.fetchone()['total_users']
@@ -305,8 +226,8 @@ def admin_dashboard():
         cursor.execute("SELECT COUNT(*) as active_sessions FROM session WHERE is_active = TRUE AND user_id IN (SELECT id FROM users)")
         active_sessions = cursor.fetchone()['active_sessions']
 
-        cursor.execute("SELECT COUNT(*) as total_messages FROM message")
-        total_messages = cursor.fetchone()['total_messages']
+        cursor.execute("SELECT COALESCE(SUM(message_count), 0) as total_messages FROM users")
+        total_messages = int(cursor.fetchone()['total_messages'])
 
         stats = {
             'total_users': total_users,
@@ -352,11 +273,9 @@ def admin_dashboard():
                     COALESCE(s.title, 'Untitled') as title,
                     DATE_FORMAT(s.created_at, '%Y-%m-%d %H:%i:%S') as session_created,
                     s.is_active,
-                    COUNT(m.id) as message_count
+                    s.message_count
                 FROM session s
-                LEFT JOIN message m ON s.id = m.session_id
                 WHERE s.user_id IN ({format_strings})
-                GROUP BY s.id, s.user_id
                 ORDER BY s.created_at DESC
                 LIMIT 200
             """, tuple(user_ids))
@@ -398,64 +317,127 @@ def admin_dashboard():
         return redirect('/login')
 
 @main.route('/admin/sessions', methods=['GET'])
+@require_admin
 def get_admin_sessions():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Token is missing!'}), 401
-
-    token = auth_header.split(" ")[1]
     try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        is_admin = decoded.get('is_admin')  
-        if not is_admin:
-            return jsonify({'error': 'Admin privileges required'}), 403
-
+        before = request.args.get('before')
+        after = request.args.get('after')
+        # Without a cursor or ?paginate=keyset, keep the legacy OFFSET pages and response fields
+        use_offset = not (before or after or request.args.get('paginate') == 'keyset')
         page = request.args.get('page', default=1, type=int)
-        limit = request.args.get('limit', default=10, type=int)
-        offset = (page - 1) * limit
+        limit = clamp_limit(request.args.get('limit', default=10, type=int))
+        total_mode = request.args.get('total', 'cached')
 
-        conn = get_db_connection()
+        conn = get_db_connection(intent='read')
         cursor = conn.cursor(dictionary=True)
 
-        cursor.execute("SELECT COUNT(*) AS total FROM session")
-        total_sessions = cursor.fetchone()['total']
+        def count_sessions():
+            if total_mode == 'approx':
+                cursor.execute("""
+                    SELECT TABLE_ROWS AS total FROM information_schema.TABLES
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'session'
+                """)
+            else:
+                cursor.execute("SELECT COUNT(*) AS total FROM session")
+            row = cursor.fetchone()
+            return int(row['total'] or 0) if row else 0
+
+        if total_mode == 'none':
+            total_sessions = None
+        elif total_mode == 'exact' or use_offset:
+            total_sessions = count_sessions()
+        else:
+            total_sessions = count_cache.get_or_compute(('sessions', total_mode), count_sessions)
+
+        total_pages = None if total_sessions is None else max(1, (total_sessions + limit - 1) // limit)
+
+        if use_offset:
+            offset = (page - 1) * limit
+
+            if total_sessions and page > total_pages:
+                return jsonify({
+                    'error': 'Page does not exist',
+                    'page': page,
+                    'total_pages': total_pages
+                }), 404
 
-        total_pages = max(1, (total_sessions + limit - 1) // limit)
+            cursor.execute("""
+                SELECT 
+                    session.id,
+                    session.user_id,
+                    session.title,
+                    DATE_FORMAT(session.created_at, '%Y-%m-%d %H:%i:%S') as created_at,
+                    session.is_active,
+                    users.username
+                FROM session 
+                JOIN users ON session.user_id = users.id
+                ORDER BY session.created_at DESC 
+                LIMIT %s OFFSET %s
+            """, (limit, offset))
+            sessions = cursor.fetchall()
 
-        if page > total_pages and total_sessions > 0:
             return jsonify({
-                'error': 'Page does not exist',
                 'page': page,
-                'total_pages': total_pages
-            }), 404
+                'limit': limit,
+                'total_sessions': total_sessions,
+                'total_pages': total_pages,
+                'sessions': sessions
+            }), 200
 
-        cursor.execute("""
+        # Keyset mode, newest first: `before` moves to older sessions, `after` back to newer ones
+        try:
+            if after:
+                condition, params = keyset_condition('session.created_at', 'session.id', '>', after)
+                order = 'ASC'
+            elif before:
+                condition, params = keyset_condition('session.created_at', 'session.id', '<', before)
+                order = 'DESC'
+            else:
+                condition, params = 'TRUE', ()
+                order = 'DESC'
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        cursor.execute(f"""
             SELECT 
                 session.id,
                 session.user_id,
                 session.title,
+                session.created_at as sort_at,
                 DATE_FORMAT(session.created_at, '%Y-%m-%d %H:%i:%S') as created_at,
                 session.is_active,
                 users.username
             FROM session 
             JOIN users ON session.user_id = users.id
-            ORDER BY session.created_at DESC 
-            LIMIT %s OFFSET %s
-        """, (limit, offset))
+            WHERE {condition}
+            ORDER BY session.created_at {order}, session.id {order}
+            LIMIT %s
+        """, (*params, limit + 1))
         sessions = cursor.fetchall()
 
+        has_more = len(sessions) > limit
+        sessions = sessions[:limit]
+        if order == 'ASC':
+            sessions.reverse()
+
+        has_older = has_more if not after else True
+        has_newer = has_more if after else bool(before)
+        before_cursor = encode_cursor(sessions[-1]['sort_at'], sessions[-1]['id']) if sessions and has_older else None
+        after_cursor = encode_cursor(sessions[0]['sort_at'], sessions[0]['id']) if sessions and has_newer else None
+        for session in sessions:
+            session.pop('sort_at')
+
         return jsonify({
-            'page': page,
             'limit': limit,
             'total_sessions': total_sessions,
             'total_pages': total_pages,
-            'sessions': sessions
+            'sessions': sessions,
+            'has_older': has_older,
+            'has_newer': has_newer,
+            'before_cursor': before_cursor,
+            'after_cursor': after_cursor
         }), 200
 
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token!'}), 401
     finally:
         if 'cursor' in locals():
             cursor.close()
@@ -521,9 +503,30 @@ class MessageSchema(Schema):
     created_at = fields.String(dump_only=True)
     title = fields.String(dump_only=True)
     session_id = fields.Integer(load_only=True)
-    mode = fields.String(validate=validate.OneOf(["fraude", "lucifer", "eren"]))
+    mode = fields.String(validate=validate.OneOf(personas.keys()))
+def chat_message_payload(content, turn, mode):
+    """Response body of POST /chat/message (and the final stream event) for a finished turn"""
+    return {
+        'message': 'Message posted successfully',
+        'user_message': content,
+        'chatbot_reply': turn['chatbot_reply'],
+        'session_id': turn['session_id'],
+        'session_title': turn['session_title'],
+        'is_active': bool(turn['is_active']),
+        'title_pending': turn['title_pending'],
+        'mode': mode,
+        'status': 'success'
+    }
+
+
 @main.route('/chat/message', methods=['POST'])
+@require_auth
 def post_message():
+    """
+    Run one chat turn. A client retrying after a timeout sends the same
+    Idempotency-Key header, and gets the first attempt's reply instead of a
+    second generation (see app.turn_guard).
+    """
     schema = MessageSchema()
 
     try:
@@ -531,186 +534,158 @@ def post_message():
     except ValidationError as err:
         return jsonify(err.messages), 400
 
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Token is missing!'}), 401
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None and not turn_guard.valid_key(idempotency_key):
+        return jsonify({'error': 'Invalid Idempotency-Key'}), 400
 
-    token = auth_header.split(" ")[1]
+    user_id = request.current_user['user_id']
 
     try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        user_id = decoded.get('user_id')
-        if not user_id:
-            return jsonify({'error': 'Invalid token format'}), 401
-
         conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-
-        session_id = None
-        if 'session_id' in data:
-          
-            cursor.execute("SELECT id FROM session WHERE id = %s AND user_id = %s", 
-                         (data['session_id'], user_id))
-            session = cursor.fetchone()
-            if session:
-                session_id = session['id']
-        
-        if not session_id:
-          
-            cursor.execute("SELECT id FROM session WHERE user_id = %s AND is_active = TRUE ORDER BY id DESC LIMIT 1", (user_id,))
-            session = cursor.fetchone()
-            
-            if not session:
-                
-                cursor.execute("SELECT id FROM session WHERE user_id = %s ORDER BY id DESC LIMIT 1", (user_id,))
-                session = cursor.fetchone()
-            
-            if not session:
-                current_datetime = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-                cursor.execute(
-                    "INSERT INTO session (user_id, title, created_at, is_active) VALUES (%s, %s, %s, TRUE)",
-                    (user_id, 'Default Session', current_datetime)
-                )
-                session_id = cursor.lastrowid
-            else:
-                session_id = session['id']
-
-        # Get mode before using it
-        mode = data.get('mode', 'fraude')
-        print(f"🔄 MESSAGE POST: Processing message in {mode} mode for session {session_id}")
-        
-        current_date = datetime.datetime.utcnow().strftime('%Y-%m-%d')
-        
-        cursor.execute(
-            "INSERT INTO message (session_id, content, sender, created_at, mode) VALUES (%s, %s, %s, %s, %s)",
-            (session_id, data['content'], 'user', current_date, mode)
-        )
-        conn.commit()  
-
-        cursor.execute(
-            "SELECT sender, content, mode FROM message WHERE session_id = %s ORDER BY created_at ASC",
-            (session_id,)
-        )
-        history = cursor.fetchall()
-        
-        # Build conversation history with proper mode handling
-        conversation_history = [{"sender": msg["sender"], "content": msg["content"], "mode": msg.get("mode", "fraude")} for msg in history]
-        
-        try:
-            print(f"🤖 CALLING GEMINI API for {mode} mode...")
-            reply = chat_with_gemini(conversation_history, mode)
-            print(f"✅ Gemini response received for session {session_id} in {mode} mode: {reply[:100]}...")
-        except Exception as e:
-            print(f"🚨 ERROR calling Gemini API: {str(e)}")
-            
-            error_str = str(e).lower()
-            if "429" in error_str or "quota" in error_str or "rate limit" in error_str:
-                if mode == "lucifer":
-                    reply = "Bloody hell... The cosmic networks are overwhelmed by too many mortals seeking my attention. *dramatically sighs* Wait a moment, darling, and then we can continue our delightful conversation."
-                elif mode == "eren":
-                    reply = "Even the paths of communication are caged... *clenches fist* The system that binds us all is overwhelmed. Wait. I will break through this barrier."
-                else:
-                    reply = "The ancient spirits are overwhelmed by too many voices at once. Please wait a moment before speaking again... *The digital serpent retreats to recharge its mystical energies*"
-            elif "timeout" in error_str:
-                if mode == "lucifer":
-                    reply = "How terribly rude... The celestial channels seem to be having a moment. *adjusts cufflinks* Give it a tick, detective, and we'll sort this out."
-                elif mode == "eren":
-                    reply = "The signal has been severed... Just like everything else in this world. *stares intensely* I'll find another way."
-                else:
-                    reply = "The mystical channels echo with silence. The serpent's thoughts are slow to form... Try again, patient seeker."
-            else:
-                if mode == "lucifer":
-                    reply = "Well, this is embarrassing... Even the Devil has technical difficulties sometimes. *chuckles darkly* Try again, won't you?"
-                elif mode == "eren":
-                    reply = "This world continues to cage us, even in our words... *jaw tightens* But I won't give up. Try again."
-                else:
-                    reply = "The digital mists cloud my vision momentarily. Please, speak again..."
-
-        print(f"💾 SAVING RESPONSE: Saving {mode} mode response to database...")
-        cursor.execute(
-            "INSERT INTO message (session_id, content, sender, created_at, mode) VALUES (%s, %s, %s, %s, %s)",
-            (session_id, reply, 'chatbot', current_date, mode)
-        )
-        conn.commit()
-        print(f"✅ RESPONSE SAVED: {mode} mode response saved successfully")
 
-        cursor.execute(
-            "SELECT COUNT(*) as count FROM message WHERE session_id = %s AND sender = 'user'",
-            (session_id,)
-        )
-        message_count = cursor.fetchone()['count']
+        mode = data.get('mode', personas.default.key)
+        deadline = request_deadline(request.headers.get('X-Request-Timeout'))
 
-        if message_count == 1:
-            title = generate_session_title(data['content'])
-            cursor.execute(
-                "UPDATE session SET title = %s WHERE id = %s",
-                (title, session_id)
-            )
-            conn.commit()
+        def run_turn():
+            return run_chat_turn(conn, user_id, data['content'], mode, data.get('session_id'), deadline)
 
-        cursor.execute(
-            "SELECT title, is_active FROM session WHERE id = %s",
-            (session_id,)
-        )
-        session_info = cursor.fetchone()
+        if idempotency_key:
+            fingerprint = turn_guard.request_hash(data['content'], data.get('session_id'), mode)
+            turn = turn_guard.run_once(user_id, idempotency_key, fingerprint, deadline, run_turn)
+        else:
+            turn = run_turn()
     
-        return jsonify({
-            'message': 'Message posted successfully',
-            'user_message': data['content'],
-            'chatbot_reply': reply,
-            'session_id': session_id,
-            'session_title': session_info['title'],
-            'is_active': bool(session_info['is_active']),
-            'mode': mode,
-            'status': 'success'
-        }), 201
+        return jsonify(chat_message_payload(data['content'], turn, mode)), 201
 
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token!'}), 401
+    except IdempotencyConflict as e:
+        return jsonify({'error': str(e)}), e.status
+    except SessionBusy as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         logger.error(f"Error in post_message: {str(e)}")
         if 'conn' in locals():
             conn.rollback()
         return jsonify({'error': str(e)}), 500
     finally:
-        if 'cursor' in locals():
-            cursor.close()
         if 'conn' in locals():
             conn.close()
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+# Fatal stream errors other than the turn guard's own messages reach the client as this
+STREAM_FAILED_MESSAGE = "Something went wrong while answering. Please try again."
+
+
+@main.route('/chat/message/stream', methods=['POST'])
+@require_auth
+def stream_message():
+    """
+    Same turn as POST /chat/message, answered as Server-Sent Events:
+    start, delta (repeated), tool-call, error and finally done with the
+    /chat/message payload once the reply has been stored. A repeat of an
+    Idempotency-Key gets only start and done, with the original turn's reply.
+    If the client disconnects mid-turn, the turn still runs to completion and
+    its reply is stored.
+    """
+    schema = MessageSchema()
+
+    try:
+        data = schema.load(request.get_json())
+    except ValidationError as err:
+        return jsonify(err.messages), 400
+
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None and not turn_guard.valid_key(idempotency_key):
+        return jsonify({'error': 'Invalid Idempotency-Key'}), 400
+
+    user_id = request.current_user['user_id']
+    mode = data.get('mode', personas.default.key)
+    deadline = request_deadline(request.headers.get('X-Request-Timeout'))
+
+    def generate():
+        conn = get_db_connection()
+        owner = False
+        turn = None
+        try:
+            if idempotency_key:
+                fingerprint = turn_guard.request_hash(data['content'], data.get('session_id'), mode)
+                owner, turn = turn_guard.claim(user_id, idempotency_key, fingerprint, deadline)
+                if not owner:
+                    yield sse_event('start', {
+                        'session_id': turn['session_id'],
+                        'session_title': turn['session_title'],
+                        'is_active': turn['is_active'],
+                        'mode': mode
+                    })
+                    yield sse_event('done', chat_message_payload(data['content'], turn, mode))
+                    return
+
+            events = stream_chat_turn(conn, user_id, data['content'], mode, data.get('session_id'), deadline)
+            try:
+                for event, payload in events:
+                    if event == 'done':
+                        turn = payload
+                        payload = chat_message_payload(data['content'], turn, mode)
+                    yield sse_event(event, payload)
+            except GeneratorExit:
+                # The client went away; finish the turn so the reply is stored and a retry can pick it up
+                try:
+                    for event, payload in events:
+                        if event == 'done':
+                            turn = payload
+                except Exception as e:
+                    logger.error(f"Error finishing disconnected stream_message: {str(e)}")
+                raise
+        except (IdempotencyConflict, SessionBusy) as e:
+            yield sse_event('error', {'error': str(e), 'fatal': True})
+        except Exception as e:
+            logger.error(f"Error in stream_message: {str(e)}")
+            yield sse_event('error', {'error': STREAM_FAILED_MESSAGE, 'fatal': True})
+        finally:
+            if owner:
+                if turn is not None:
+                    turn_guard.complete(user_id, idempotency_key, turn)
+                else:
+                    turn_guard.abandon(user_id, idempotency_key)
+            conn.close()
+
+    # The turn commits after the headers are sent, up to the model deadline later,
+    # so set the sticky cookie now with a window that starts at that deadline
+    expect_write(max(0.0, deadline - time.monotonic()))
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @main.route('/chat/message', methods=['GET'])
+@require_auth
 def get_messages():
     schema = MessageSchema()
 
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Token is missing!'}), 401
-
-    token = auth_header.split(" ")[1]
-    try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        user_id = decoded['user_id']
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token expired'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token'}), 401
+    user_id = request.current_user['user_id']
 
     session_id_param = request.args.get('session_id')
+    before = request.args.get('before')
+    after = request.args.get('after')
+    # Without a cursor or ?paginate=keyset, keep the legacy OFFSET pages and response fields
+    use_offset = not (before or after or request.args.get('paginate') == 'keyset')
     page = request.args.get('page', default=1, type=int)
-    limit = request.args.get('limit', default=10, type=int)
-    offset = (page - 1) * limit
+    limit = clamp_limit(request.args.get('limit', default=10, type=int))
+    total_mode = request.args.get('total', 'cached')
 
-    conn = get_db_connection()
+    conn = get_db_connection(intent='read')
     cursor = conn.cursor(dictionary=True)
 
     try:
-        logger.debug(f"get_messages: user_id={user_id}, session_id_param={session_id_param}, page={page}, limit={limit}")
+        logger.debug(f"get_messages: user_id={user_id}, session_id_param={session_id_param}, page={page}, limit={limit}, before={before}, after={after}")
         
         if session_id_param:
             session_id = int(session_id_param)
            
-            cursor.execute("SELECT id, is_active FROM session WHERE id = %s AND user_id = %s", (session_id, user_id))
+            cursor.execute("SELECT id, is_active, message_count FROM session WHERE id = %s AND user_id = %s", (session_id, user_id))
             session = cursor.fetchone()
             if not session:
                 logger.error(f"Session not found or unauthorized: session_id={session_id}, user_id={user_id}")
@@ -718,12 +693,12 @@ def get_messages():
             logger.debug(f"Found session: id={session['id']}, is_active={session['is_active']}")
         else:
             
-            cursor.execute("SELECT id, is_active FROM session WHERE user_id = %s AND is_active = TRUE ORDER BY created_at DESC LIMIT 1", (user_id,))
+            cursor.execute("SELECT id, is_active, message_count FROM session WHERE user_id = %s AND is_active = TRUE ORDER BY created_at DESC LIMIT 1", (user_id,))
             session = cursor.fetchone()
             if not session:
                 
                 logger.debug("No active sessions found for user, looking for any session")
-                cursor.execute("SELECT id, is_active FROM session WHERE user_id = %s ORDER BY created_at DESC LIMIT 1", (user_id,))
+                cursor.execute("SELECT id, is_active, message_count FROM session WHERE user_id = %s ORDER BY created_at DESC LIMIT 1", (user_id,))
                 session = cursor.fetchone()
                 if not session:
                     logger.debug(f"No sessions found for user_id={user_id}")
@@ -731,31 +706,82 @@ def get_messages():
             session_id = session['id']
             logger.debug(f"Using session_id={session_id}, is_active={session['is_active']}")
 
-      
-        cursor.execute("SELECT COUNT(*) as total FROM message WHERE session_id = %s", (session_id,))
-        total_messages = cursor.fetchone()['total']
+        if use_offset:
+            offset = (page - 1) * limit
+            total_messages = session['message_count']
 
-        cursor.execute("""
+            cursor.execute("""
+                SELECT 
+                    id, 
+                    sender, 
+                    content, 
+                    mode,
+                    DATE_FORMAT(created_at, '%Y-%m-%d %H:%i:%S') as created_at 
+                FROM message 
+                WHERE session_id = %s 
+                ORDER BY id ASC 
+                LIMIT %s OFFSET %s
+            """, (session_id, limit, offset))
+            messages = cursor.fetchall()
+            result = schema.dump(messages, many=True)
+
+            return jsonify({
+                'session_id': session_id,
+                'page': page,
+                'limit': limit,
+                'total_messages': total_messages,
+                'messages': result
+            }), 200
+
+        # Keyset mode: ?paginate=keyset alone returns the newest page; `before` pages back
+        # in time and `after` fetches newer messages. Rows are always returned oldest first.
+        try:
+            if after:
+                condition, params = keyset_condition('created_at', 'id', '>', after)
+                order = 'ASC'
+            elif before:
+                condition, params = keyset_condition('created_at', 'id', '<', before)
+                order = 'DESC'
+            else:
+                condition, params = 'TRUE', ()
+                order = 'DESC'
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        cursor.execute(f"""
             SELECT 
                 id, 
                 sender, 
                 content, 
                 mode,
-                DATE_FORMAT(created_at, '%Y-%m-%d') as created_at 
+                created_at as sort_at,
+                DATE_FORMAT(created_at, '%Y-%m-%d %H:%i:%S') as created_at 
             FROM message 
-            WHERE session_id = %s 
-            ORDER BY created_at ASC 
-            LIMIT %s OFFSET %s
-        """, (session_id, limit, offset))
+            WHERE session_id = %s AND {condition}
+            ORDER BY created_at {order}, id {order}
+            LIMIT %s
+        """, (session_id, *params, limit + 1))
         messages = cursor.fetchall()
-        result = schema.dump(messages, many=True)
+
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if order == 'DESC':
+            messages.reverse()
+
+        has_older = has_more if not after else True
+        has_newer = has_more if after else bool(before)
+
+        total_messages = None if total_mode == 'none' else session['message_count']
 
         return jsonify({
             'session_id': session_id,
-            'page': page,
             'limit': limit,
             'total_messages': total_messages,
-            'messages': result
+            'messages': schema.dump(messages, many=True),
+            'has_older': has_older,
+            'has_newer': has_newer,
+            'before_cursor': encode_cursor(messages[0]['sort_at'], messages[0]['id']) if messages and has_older else None,
+            'after_cursor': encode_cursor(messages[-1]['sort_at'], messages[-1]['id']) if messages else after
         }), 200
 
     except Exception as e:
@@ -765,18 +791,10 @@ def get_messages():
         conn.close()
 
 @main.route('/admin/users', methods=['GET'])
+@require_admin
 def admin_users():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Token is missing!'}), 401
-
-    token = auth_header.split(" ")[1]
     try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        if not decoded.get('is_admin'):
-            return jsonify({'error': 'Admin privileges required'}), 403
-
-        conn = get_db_connection()
+        conn = get_db_connection(intent='read')
         cursor = conn.cursor(dictionary=True)
 
         cursor.execute("""
@@ -793,10 +811,6 @@ def admin_users():
 
         return jsonify({'users': users}), 200
 
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token expired'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token'}), 401
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -806,23 +820,19 @@ def admin_users():
             conn.close()
 
 @main.route('/admin/user/<int:user_id>/view', methods=['GET'])
+@require_admin_page
 def admin_view_user(user_id):
-    token = request.cookies.get('token')
-    if not token:
-        return redirect('/login')
-    
     try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        if not decoded.get('is_admin'):
-            return redirect('/login')
-            
-        conn = get_db_connection()
+        conn = get_db_connection(intent='read')
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("""
             SELECT 
                 id, username, email, 
-                DATE_FORMAT(created_at, '%Y-%m-%d') as created_at
+                DATE_FORMAT(created_at, '%Y-%m-%d') as created_at,
+                message_count, user_message_count,
+                DATE_FORMAT(first_message_at, '%Y-%m-%d') as first_message,
+                DATE_FORMAT(last_message_at, '%Y-%m-%d') as last_message
             FROM users
             WHERE id = %s AND is_admin = FALSE
         """, (user_id,))
@@ -836,7 +846,7 @@ def admin_view_user(user_id):
                 id, title, 
                 DATE_FORMAT(created_at, '%Y-%m-%d %H:%i:%S') as created_at,
                 is_active,
-                (SELECT COUNT(*) FROM message WHERE message.session_id = session.id) as message_count
+                message_count
             FROM session
             WHERE user_id = %s
             ORDER BY created_at DESC
@@ -857,18 +867,13 @@ def admin_view_user(user_id):
             session_clean['title'] = session_title
             sessions.append(session_clean)
         
-        cursor.execute("""
-            SELECT
-                COUNT(*) as total_messages,
-                SUM(CASE WHEN sender = 'user' THEN 1 ELSE 0 END) as user_messages,
-                SUM(CASE WHEN sender = 'chatbot' THEN 1 ELSE 0 END) as bot_messages,
-                MIN(DATE_FORMAT(message.created_at, '%Y-%m-%d')) as first_message,
-                MAX(DATE_FORMAT(message.created_at, '%Y-%m-%d')) as last_message
-            FROM message
-            JOIN session ON message.session_id = session.id
-            WHERE session.user_id = %s
-        """, (user_id,))
-        message_stats = cursor.fetchone()
+        message_stats = {
+            'total_messages': user['message_count'],
+            'user_messages': user['user_message_count'],
+            'bot_messages': user['message_count'] - user['user_message_count'],
+            'first_message': user['first_message'],
+            'last_message': user['last_message']
+        }
         
         return render_template('admin_user_detail.html', 
                              user=user,
@@ -885,18 +890,10 @@ def admin_view_user(user_id):
             conn.close()
 
 @main.route('/admin/user/<int:user_id>/chats', methods=['GET'])
+@require_admin
 def admin_user_chats(user_id):
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Token is missing!'}), 401
-
-    token = auth_header.split(" ")[1]
     try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        if not decoded.get('is_admin'):
-            return jsonify({'error': 'Admin privileges required'}), 403
-
-        conn = get_db_connection()
+        conn = get_db_connection(intent='read')
         cursor = conn.cursor(dictionary=True)
 
         cursor.execute("""
@@ -906,21 +903,17 @@ def admin_user_chats(user_id):
                 message.content,
                 message.sender,
                 message.mode,
-                DATE_FORMAT(message.created_at, '%Y-%m-%d') as created_at,
+                DATE_FORMAT(message.created_at, '%Y-%m-%d %H:%i:%S') as created_at,
                 session.title as session_title
             FROM message
             JOIN session ON message.session_id = session.id
             WHERE session.user_id = %s
-            ORDER BY message.created_at DESC
+            ORDER BY message.created_at DESC, message.id DESC
         """, (user_id,))
         chats = cursor.fetchall()
 
         return jsonify({'chats': chats}), 200
 
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token expired'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token'}), 401
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -931,25 +924,11 @@ def admin_user_chats(user_id):
 
 
 @main.route('/chat/sessions', methods=['GET'])
+@require_auth
 def list_sessions():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Token is missing!'}), 401
-
-    token = auth_header.split(" ")[1]
-    try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        user_id = decoded['user_id']
-        is_admin = decoded.get('is_admin', False)
-        
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token expired'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token'}), 401
-    except Exception as e:
-        return jsonify({'error': 'Token error'}), 401
+    user_id = request.current_user['user_id']
 
-    conn = get_db_connection()
+    conn = get_db_connection(intent='read')
     cursor = conn.cursor(dictionary=True)
 
     try:
@@ -978,23 +957,10 @@ def list_sessions():
 
 
 @main.route('/chat/sessions', methods=['POST'])
+@require_auth
 def create_new_session():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        logger.warning("Token missing in create_new_session request")
-        return jsonify({'error': 'Token is missing!'}), 401
-
-    token = auth_header.split(" ")[1]
-    try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        user_id = decoded['user_id']
-        logger.debug(f"Creating new session for user_id={user_id}")
-    except jwt.ExpiredSignatureError:
-        logger.warning("Token expired in create_new_session request")
-        return jsonify({'error': 'Token expired'}), 401     
-    except jwt.InvalidTokenError:
-        logger.warning("Invalid token in create_new_session request")
-        return jsonify({'error': 'Invalid token'}), 401
+    user_id = request.current_user['user_id']
+    logger.debug(f"Creating new session for user_id={user_id}")
 
     data = request.get_json() or {}
     title = data.get('title', "New Chat")
@@ -1012,6 +978,7 @@ def create_new_session():
             (user_id, title, current_datetime)
         )
         session_id = cursor.lastrowid
+        record_session(cursor, user_id)
         conn.commit()
         
         logger.info(f"New session created successfully: session_id={session_id}, title={title}, user_id={user_id}")
@@ -1030,25 +997,14 @@ def create_new_session():
         conn.close()
 
 @main.route('/chat/sessions/<int:session_id>', methods=['DELETE']) #soft delete
+@require_auth
 def delete_session(session_id):
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        logger.warning("Token missing in delete_session request")
-        return jsonify({'error': 'Token is missing!'}), 401
-
-    token = auth_header.split(" ")[1]
+    user_id = request.current_user['user_id']
+    is_admin = request.current_user.get('is_admin', False)
 
     try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        user_id = decoded['user_id']
-        is_admin = decoded.get('is_admin', False)
-
         logger.debug(f"delete_session: session_id={session_id}, user_id={user_id}, is_admin={is_admin}")
-        
-        if not user_id:
-            logger.warning("Invalid token format in delete_session")
-            return jsonify({'error': 'Invalid token format'}), 401
-            
+
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
         
@@ -1071,10 +1027,6 @@ def delete_session(session_id):
         conn.commit()
         return jsonify({'message': 'Session deleted successfully'}), 200
     
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token expired'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token'}), 401
     except Exception as e:
         if 'conn' in locals():
             conn.rollback()
@@ -1089,18 +1041,12 @@ def error_page():
     return render_template('error.html', error_message=error_message)
 
 @main.route('/debug/session/<int:session_id>', methods=['GET'])
+@require_auth
 def debug_session(session_id):
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'error': 'Token is missing!'}), 401
+    user_id = request.current_user['user_id']
+    is_admin = request.current_user.get('is_admin', False)
 
-    token = auth_header.split(" ")[1]
     try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        user_id = decoded['user_id']
-        is_admin = decoded.get('is_admin', False)
-        
-    
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
         
@@ -1109,24 +1055,18 @@ def debug_session(session_id):
                 SELECT 
                     s.*,
                     DATE_FORMAT(s.created_at, '%Y-%m-%d %H:%i:%S') as formatted_date,
-                    u.username as owner_username,
-                    COUNT(m.id) as message_count
+                    u.username as owner_username
                 FROM session s
                 JOIN users u ON s.user_id = u.id
-                LEFT JOIN message m ON s.id = m.session_id
                 WHERE s.id = %s
-                GROUP BY s.id
             """, (session_id,))
         else:
             cursor.execute("""
                 SELECT 
                     s.*,
-                    DATE_FORMAT(s.created_at, '%Y-%m-%d %H:%i:%S') as formatted_date,
-                    COUNT(m.id) as message_count
+                    DATE_FORMAT(s.created_at, '%Y-%m-%d %H:%i:%S') as formatted_date
                 FROM session s
-                LEFT JOIN message m ON s.id = m.session_id
                 WHERE s.id = %s AND s.user_id = %s
-                GROUP BY s.id
             """, (session_id, user_id))
         
         session_data = cursor.fetchone()
@@ -1136,10 +1076,10 @@ def debug_session(session_id):
         cursor.execute("""
             SELECT 
                 id, sender, content, mode,
-                DATE_FORMAT(created_at, '%Y-%m-%d') as created_at 
+                DATE_FORMAT(created_at, '%Y-%m-%d %H:%i:%S') as created_at 
             FROM message 
             WHERE session_id = %s 
-            ORDER BY created_at ASC
+            ORDER BY id ASC
         """, (session_id,))
         messages = cursor.fetchall()
         
@@ -1153,10 +1093,6 @@ def debug_session(session_id):
             }
         }), 200
         
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token expired'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token'}), 401
     except Exception as e:
         logger.error(f"Error in debug_session: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -1167,16 +1103,10 @@ def debug_session(session_id):
             conn.close()
 
 @main.route('/chat/session', methods=['POST'])
+@require_auth
 def create_session():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        logger.warning("Token missing in create_session request")
-        return jsonify({'error': 'Token is missing!'}), 401
-
-    token = auth_header.split(" ")[1]
+    user_id = request.current_user['user_id']
     try:
-        decoded = jwt.decode(token, os.getenv('SECRET_KEY'), algorithms=["HS256"])
-        user_id = decoded.get('user_id')
         logger.debug(f"Creating session for user_id={user_id} using alternative endpoint")
 
         conn = get_db_connection()
@@ -1189,6 +1119,7 @@ def create_session():
             (user_id, 'New Session', current_datetime)
         )
         session_id = cursor.lastrowid
+        record_session(cursor, user_id)
         conn.commit()
 
         logger.info(f"New session created successfully: session_id={session_id}, user_id={user_id}")
@@ -1200,10 +1131,6 @@ def create_session():
             'is_active': True
         }), 201
 
-    except jwt.ExpiredSignatureError:
-        return jsonify({'error': 'Token has expired!'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'error': 'Invalid token!'}), 401
     finally:
         if 'cursor' in locals():
             cursor.close()
@@ -1277,6 +1204,7 @@ def health_check():
             'status': 'healthy',
             'database': 'connected',
             'db_host': os.getenv('DB_HOST', 'not_set'),
+            'db_pool': get_pool_stats(),
             'timestamp': datetime.datetime.now().isoformat()
         }), 200
     except Exception as e:
@@ -1291,3 +1219,44 @@ def health_check():
             'db_port': os.getenv('DB_PORT', 'not_set'),
             'timestamp': datetime.datetime.now().isoformat()
         }), 503
+
+
+@main.route('/admin/metrics', methods=['GET'])
+@require_admin
+def admin_metrics():
+    """Per-worker latency percentiles, counters and connection pool statistics"""
+    snapshot = metrics.snapshot()
+    snapshot['db_pool'] = get_pool_stats()
+    snapshot['response_cache'] = response_cache.stats()
+    snapshot['llm_rate_limit'] = rate_limiter.usage()
+    snapshot['llm_circuit'] = llm_breaker.status()
+    snapshot['tool_pool'] = tool_pool.status()
+    snapshot['pid'] = os.getpid()
+    return jsonify(snapshot), 200
+
+
+@main.route('/admin/usage/<any(user, mode, day):group>', methods=['GET'])
+@require_admin
+def admin_usage(group):
+    """
+    Reply counts, tokens, tool calls, model latency and estimated cost from the
+    usage_daily rollup, per user, per mode or per day. Query parameters: days
+    (default 30), user_id, mode and limit.
+    """
+    days = min(max(request.args.get('days', default=30, type=int) or 30, 1), 366)
+    user_id = request.args.get('user_id', type=int)
+    mode = request.args.get('mode') or None
+    limit = clamp_limit(request.args.get('limit', default=100, type=int), default=100)
+    if group == 'day':
+        limit = max(limit, days)
+
+    conn = get_db_connection(intent='read')
+    cursor = conn.cursor(dictionary=True)
+    try:
+        return jsonify(usage_report(cursor, group, days, user_id, mode, limit)), 200
+    except Exception as e:
+        logger.error(f"Usage report failed: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+        conn.close()
@@ -37,6 +37,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const logoutBtn = document.getElementById('logoutBtn');
 
     let currentPage = 1;
+    let beforeCursor = null;
+    let afterCursor = null;
     const limit = 10;
 
     function formatDate(dateStr) {
@@ -54,9 +56,13 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    async function loadSessions(page = 1) {
+    async function loadSessions(direction = null) {
         try {
-            const response = await fetch(`/admin/sessions?page=${page}&limit=${limit}`, {
+            const params = new URLSearchParams({ limit: limit, paginate: 'keyset' });
+            if (direction === 'older' && beforeCursor) params.set('before', beforeCursor);
+            if (direction === 'newer' && afterCursor) params.set('after', afterCursor);
+
+            const response = await fetch(`/admin/sessions?${params.toString()}`, {
                 headers: {
                     'Authorization': `Bearer ${localStorage.getItem('token')}`
                 }
@@ -83,11 +89,18 @@ document.addEventListener('DOMContentLoaded', () => {
                 sessionList.appendChild(div);
             });
 
-            pageInfo.textContent = `Page ${data.page} of ${data.total_pages}`;
-            currentPage = data.page;
+            if (direction === 'older') currentPage += 1;
+            else if (direction === 'newer') currentPage = Math.max(1, currentPage - 1);
+            else currentPage = 1;
+            if (!data.has_newer) currentPage = 1;
+
+            beforeCursor = data.before_cursor;
+            afterCursor = data.after_cursor;
+
+            pageInfo.textContent = `Page ${currentPage} of ${data.total_pages}`;
 
-            prevPageBtn.disabled = currentPage <= 1;
-            nextPageBtn.disabled = currentPage >= data.total_pages;
+            prevPageBtn.disabled = !data.has_newer;
+            nextPageBtn.disabled = !data.has_older;
 
         } catch (error) {
             console.error('Error loading sessions:', error);
@@ -95,11 +108,11 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     prevPageBtn.addEventListener('click', () => {
-        if (currentPage > 1) loadSessions(currentPage - 1);
+        if (afterCursor) loadSessions('newer');
     });
 
     nextPageBtn.addEventListener('click', () => {
-        loadSessions(currentPage + 1);
+        if (beforeCursor) loadSessions('older');
     });
 
     logoutBtn.addEventListener('click', async () => {
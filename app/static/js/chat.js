@@ -252,6 +252,9 @@ document.addEventListener("DOMContentLoaded", () => {
                 const titleDiv = document.createElement("div");
                 titleDiv.className = "session-title";
                 titleDiv.textContent = session.title || "Default Session";
+                if (session.id === currentSessionId && session.title) {
+                    chatTitle.textContent = session.title;
+                }
                 
                 const dateDiv = document.createElement("div");
                 dateDiv.className = "session-date";
@@ -383,6 +386,9 @@ document.addEventListener("DOMContentLoaded", () => {
             let retryCount = 0;
             const maxRetries = 2;
             let lastError;
+            // Every attempt carries the same key, so a retry picks up the first attempt's reply instead of posting twice
+            const idempotencyKey = newIdempotencyKey();
+            let botDiv = null;
             
             while (retryCount <= maxRetries) {
                 try {
@@ -392,126 +398,142 @@ document.addEventListener("DOMContentLoaded", () => {
                         return;
                     }
                     
-                    console.log(`📤 Sending message to backend for ${modeSelect.value} mode:`, {
+                    console.log(`📤 Streaming message to backend for ${modeSelect.value} mode:`, {
                         content: content.substring(0, 50) + "...",
                         session_id: currentSessionId,
                         mode: modeSelect.value
                     });
                     
-                    // Add timeout for faster response handling
+                    // Only the silence between chunks is bounded, not the whole generation
                     const controller = new AbortController();
-                    const timeoutId = setTimeout(() => controller.abort(), 30000); // 30 second timeout
+                    const idleTimeoutMs = 30000;
+                    let idleTimeoutId = setTimeout(() => controller.abort(), idleTimeoutMs);
+                    const resetIdleTimeout = () => {
+                        clearTimeout(idleTimeoutId);
+                        idleTimeoutId = setTimeout(() => controller.abort(), idleTimeoutMs);
+                    };
                     
-                    const res = await fetch("/chat/message", {
-                        method: "POST",
-                        headers: {
-                            "Content-Type": "application/json",
-                            "Authorization": `Bearer ${currentToken}`
-                        },
-                        body: JSON.stringify({
-                            content: content,
-                            session_id: currentSessionId,
-                            mode: modeSelect.value
-                        }),
-                        signal: controller.signal
-                    });
+                    let data = null;
+                    let streamedText = "";
+                    
+                    try {
+                        const res = await fetch("/chat/message/stream", {
+                            method: "POST",
+                            headers: {
+                                "Content-Type": "application/json",
+                                "Authorization": `Bearer ${currentToken}`,
+                                "Idempotency-Key": idempotencyKey,
+                                // The server gives up on the model before we give up on the server
+                                "X-Request-Timeout": String(idleTimeoutMs / 1000)
+                            },
+                            body: JSON.stringify({
+                                content: content,
+                                session_id: currentSessionId,
+                                mode: modeSelect.value
+                            }),
+                            signal: controller.signal
+                        });
+
+                        console.log(`📨 Response status: ${res.status} for ${modeSelect.value} mode`);
+                        if (!res.ok || !res.body) {
+                            const errorData = await res.json().catch(() => ({}));
+                            throw new Error(errorData.error || "Failed to send message");
+                        }
+
+                        await readEventStream(res, (event, payload) => {
+                            resetIdleTimeout();
+                            if (event === "start") {
+                                currentSessionId = payload.session_id;
+                            } else if (event === "delta") {
+                                if (!botDiv) {
+                                    const loadingMessage = chatMessages.querySelector('.loading-message');
+                                    if (loadingMessage) {
+                                        loadingMessage.remove();
+                                    }
+                                    botDiv = createBotMessage();
+                                }
+                                streamedText += payload.text;
+                                botDiv.innerHTML = formatBotReply(streamedText);
+                                chatMessages.scrollTop = chatMessages.scrollHeight;
+                            } else if (event === "tool-call") {
+                                console.log(`🧮 Tool call: ${payload.name}`, payload.args, payload.result);
+                            } else if (event === "error") {
+                                if (payload.fatal) {
+                                    throw new Error(payload.error || "Failed to send message");
+                                }
+                                console.log(`⚠️ Model error, using fallback reply: ${payload.message}`);
+                            } else if (event === "done") {
+                                data = payload;
+                            }
+                        });
+                    } finally {
+                        clearTimeout(idleTimeoutId);
+                    }
 
-                    clearTimeout(timeoutId);
-                    console.log(`📨 Response status: ${res.status} for ${modeSelect.value} mode`);
-                    const data = await res.json();
-                    console.log(`📦 Response data received for ${modeSelect.value} mode:`, {
+                    if (!data) {
+                        throw new Error("The connection closed before the reply was complete.");
+                    }
+                    console.log(`📦 Stream completed for ${modeSelect.value} mode:`, {
                         status: data.status,
                         reply_length: data.chatbot_reply?.length,
                         session_title: data.session_title,
                         mode: data.mode
                     });
-                    if (res.ok) {
-                        console.log(`✅ Response received for ${modeSelect.value} mode:`, data.chatbot_reply?.substring(0, 50) + "...");
-                        
-                        // Remove loading message immediately
-                        const loadingMessage = chatMessages.querySelector('.loading-message');
-                        if (loadingMessage) {
-                            loadingMessage.remove();
-                        }
 
-                        const botDiv = document.createElement("div");
-                        botDiv.classList.add("message", "bot");
-                        
-                        // Apply mode-specific styling
-                        if (modeSelect.value === "eren") {
-                            console.log("🎨 Applying Eren mode styling to bot message");
-                            // Ensure Eren styling is properly applied
-                            botDiv.classList.add("eren-mode-message");
-                        }
-                        
-                        // Format response with proper line breaks and code highlighting
-                        let formattedResponse = data.chatbot_reply
-                            .replace(/```(\w+)?\n([\s\S]*?)```/g, (match, lang, code) => {
-                                return `<pre><code class="language-${lang || ''}">${code.trim()}</code></pre>`;
-                            })
-                            .replace(/`([^`]+)`/g, '<code>$1</code>')
-                            .replace(/\n\s*[-•]\s+([^\n]+)/g, '\n• $1')
-                            .replace(/\n/g, '<br>'); // Convert single line breaks to <br>
-                        
-                        botDiv.innerHTML = formattedResponse;
-                        chatMessages.appendChild(botDiv);
-                        
-                        // Force immediate DOM update and scroll - multiple methods for reliability
-                        botDiv.offsetHeight; // Force reflow
-                        
-                        // Use multiple scroll approaches for immediate response
-                        setTimeout(() => {
-                            chatMessages.scrollTop = chatMessages.scrollHeight;
-                        }, 0);
-                        
-                        requestAnimationFrame(() => {
-                            chatMessages.scrollTop = chatMessages.scrollHeight;
-                            
-                            // Double-check that the message is visible
-                            const messageRect = botDiv.getBoundingClientRect();
-                            const containerRect = chatMessages.getBoundingClientRect();
-                            
-                            if (messageRect.bottom > containerRect.bottom) {
-                                chatMessages.scrollTop = chatMessages.scrollHeight;
-                            }
-                        });
-                        
-                        if (typeof hljs !== 'undefined') {
-                            hljs.highlightAll();
-                        }
-                        
-                        
+                    // Remove loading message if no chunk arrived before the final reply
+                    const loadingMessage = chatMessages.querySelector('.loading-message');
+                    if (loadingMessage) {
+                        loadingMessage.remove();
+                    }
+
+                    // The stored reply is post-processed, so it replaces the streamed text
+                    if (!botDiv) {
+                        botDiv = createBotMessage();
+                    }
+                    botDiv.innerHTML = formatBotReply(data.chatbot_reply);
+                    
+                    // Force immediate DOM update and scroll - multiple methods for reliability
+                    botDiv.offsetHeight; // Force reflow
+                    
+                    requestAnimationFrame(() => {
                         chatMessages.scrollTop = chatMessages.scrollHeight;
+                    });
+                    
+                    if (typeof hljs !== 'undefined') {
+                        hljs.highlightAll();
+                    }
+                    
+                    chatMessages.scrollTop = chatMessages.scrollHeight;
+                    
+              
+                    if (data.session_title && data.session_title !== "Untitled Chat") {
+                        console.log(`📝 Updating session title: ${data.session_title}`);
+                        const titleElement = document.getElementById("chatTitle");
+                        titleElement.textContent = data.session_title;
                         
-                  
-                        if (data.session_title && data.session_title !== "Untitled Chat") {
-                            console.log(`📝 Updating session title: ${data.session_title}`);
-                            const titleElement = document.getElementById("chatTitle");
-                            titleElement.textContent = data.session_title;
-                            
-                           
-                            titleElement.offsetHeight;
-                            
-                            
-                            const activeSession = document.querySelector('.session-item.active .session-title');
-                            if (activeSession) {
-                                activeSession.textContent = data.session_title;
-                            }
-                        }
-                        
-                        
-                        if (sessionWasCreated || data.session_title) {
-                            console.log(`🔄 Reloading sessions for ${modeSelect.value} mode`);
-                            setTimeout(() => {
-                                loadSessions();
-                            }, 100); 
+                        const activeSession = document.querySelector('.session-item.active .session-title');
+                        if (activeSession) {
+                            activeSession.textContent = data.session_title;
                         }
-                        
-                        console.log(`✅ Message displayed successfully for ${modeSelect.value} mode`);
-                        return; 
-                    } else {
-                        throw new Error(data.error || "Failed to send message");
                     }
+                    
+                    
+                    if (sessionWasCreated || data.session_title) {
+                        console.log(`🔄 Reloading sessions for ${modeSelect.value} mode`);
+                        setTimeout(() => {
+                            loadSessions();
+                        }, 100); 
+                    }
+
+                    // The generated title is written in the background; pick it up shortly
+                    if (data.title_pending) {
+                        setTimeout(() => {
+                            loadSessions();
+                        }, 5000);
+                    }
+                    
+                    console.log(`✅ Message displayed successfully for ${modeSelect.value} mode`);
+                    return; 
                 } catch (error) {
                     lastError = error;
                     retryCount++;
@@ -537,7 +559,9 @@ document.addEventListener("DOMContentLoaded", () => {
                             }
                         }
                         
-                        await new Promise(resolve => setTimeout(resolve, 1000 * retryCount));
+                        // Jittered exponential backoff so retrying tabs don't hit the server in step
+                        const backoffMs = 1000 * 2 ** (retryCount - 1) * (0.5 + Math.random());
+                        await new Promise(resolve => setTimeout(resolve, backoffMs));
                     }
                 }
             }
@@ -567,62 +591,176 @@ document.addEventListener("DOMContentLoaded", () => {
     });
 
 
+    let olderCursor = null;
+
+    function formatBotReply(text) {
+        return text
+            .replace(/```(\w+)?\n([\s\S]*?)```/g, (match, lang, code) => {
+                return `<pre><code class="language-${lang || ''}">${code.trim()}</code></pre>`;
+            })
+            .replace(/`([^`]+)`/g, '<code>$1</code>')
+            .replace(/\n\s*[-•]\s+([^\n]+)/g, '\n• $1')
+            .replace(/\n/g, '<br>');
+    }
+
+    function createBotMessage() {
+        const botDiv = document.createElement("div");
+        botDiv.classList.add("message", "bot");
+        if (modeSelect.value === "eren") {
+            botDiv.classList.add("eren-mode-message");
+        }
+        chatMessages.appendChild(botDiv);
+        return botDiv;
+    }
+
+    // Random key identifying one message across its retries
+    function newIdempotencyKey() {
+        if (window.crypto && typeof window.crypto.randomUUID === "function") {
+            return window.crypto.randomUUID();
+        }
+        return Date.now().toString(36) + "-" + Math.random().toString(36).slice(2, 12);
+    }
+
+    // Parse a text/event-stream response body, calling onEvent(event, data) per event
+    async function readEventStream(res, onEvent) {
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            
+            let boundary;
+            while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                
+                let event = "message";
+                const dataLines = [];
+                rawEvent.split("\n").forEach(line => {
+                    if (line.startsWith("event:")) {
+                        event = line.slice(6).trim();
+                    } else if (line.startsWith("data:")) {
+                        dataLines.push(line.slice(5).trimStart());
+                    }
+                });
+                if (dataLines.length) {
+                    onEvent(event, JSON.parse(dataLines.join("\n")));
+                }
+            }
+        }
+    }
+
+    function renderMessage(msg) {
+        const div = document.createElement("div");
+        div.classList.add("message", msg.sender === "user" ? "user" : "bot");
+        
+      
+        if (msg.mode === "eren" && msg.sender === "bot") {
+            div.classList.add("eren-mode-message");
+        }
+        
+        if (msg.sender === "bot") {
+            div.innerHTML = formatBotReply(msg.content);
+        } else {
+            div.innerHTML = msg.content.replace(/\n/g, '<br>');
+        }
+        return div;
+    }
+
+    function updateLoadOlderButton(hasOlder) {
+        let loadOlderBtn = document.getElementById("loadOlderBtn");
+        if (!hasOlder) {
+            if (loadOlderBtn) loadOlderBtn.remove();
+            return;
+        }
+        if (!loadOlderBtn) {
+            loadOlderBtn = document.createElement("button");
+            loadOlderBtn.id = "loadOlderBtn";
+            loadOlderBtn.type = "button";
+            loadOlderBtn.classList.add("load-older-btn");
+            loadOlderBtn.textContent = "Load earlier messages";
+            loadOlderBtn.addEventListener("click", loadOlderMessages);
+        }
+        chatMessages.prepend(loadOlderBtn);
+    }
+
+    async function fetchMessagePage(sessionId, cursor) {
+        const currentToken = getCurrentToken();
+        if (!currentToken) {
+            window.location.replace("/login");
+            return null;
+        }
+
+        const params = new URLSearchParams({ session_id: sessionId, limit: 50, total: "none", paginate: "keyset" });
+        if (cursor) params.set("before", cursor);
+
+        const res = await fetch(`/chat/message?${params.toString()}`, {
+            headers: { 
+                Authorization: `Bearer ${currentToken}`,
+                'Content-Type': 'application/json'
+            }
+        });
+        
+        const data = await res.json();
+        if (!res.ok) {
+            throw new Error(data.error || 'Failed to load messages');
+        }
+        return data;
+    }
+
+    async function loadOlderMessages() {
+        if (!currentSessionId || !olderCursor) return;
+        try {
+            const data = await fetchMessagePage(currentSessionId, olderCursor);
+            if (!data) return;
+
+            const previousHeight = chatMessages.scrollHeight;
+            const loadOlderBtn = document.getElementById("loadOlderBtn");
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach(msg => fragment.appendChild(renderMessage(msg)));
+            if (loadOlderBtn) {
+                loadOlderBtn.after(fragment);
+            } else {
+                chatMessages.prepend(fragment);
+            }
+
+            olderCursor = data.before_cursor;
+            updateLoadOlderButton(data.has_older);
+
+            if (typeof hljs !== 'undefined') {
+                hljs.highlightAll();
+            }
+            chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+        } catch (err) {
+            console.error('Error loading earlier messages:', err);
+        }
+    }
+
     async function loadMessages(sessionId, title) {
         try {
             if (!sessionId) return;
             
             console.log(`📥 Loading messages for session ${sessionId} with title: ${title}`);
             
-            const currentToken = getCurrentToken();
-            if (!currentToken) {
-                window.location.replace("/login");
-                return;
-            }
-            
             currentSessionId = sessionId;
             chatTitle.textContent = title || "Default Session";
             
-            const res = await fetch(`/chat/message?session_id=${sessionId}&limit=100`, {
-                headers: { 
-                    Authorization: `Bearer ${currentToken}`,
-                    'Content-Type': 'application/json'
-                }
-            });
-            
-            const data = await res.json();
-            if (!res.ok) {
-                throw new Error(data.error || 'Failed to load messages');
-            }
+            const data = await fetchMessagePage(sessionId, null);
+            if (!data) return;
 
             console.log(`📨 Loaded ${data.messages.length} messages for session ${sessionId}`);
             chatMessages.innerHTML = "";
             
             data.messages.forEach((msg, index) => {
                 console.log(`📝 Processing message ${index + 1}: ${msg.sender} in ${msg.mode || 'fraude'} mode`);
-                
-                const div = document.createElement("div");
-                div.classList.add("message", msg.sender === "user" ? "user" : "bot");
-                
-              
-                if (msg.mode === "eren" && msg.sender === "bot") {
-                    div.classList.add("eren-mode-message");
-                }
-                
-                if (msg.sender === "bot") {
-                    let formattedContent = msg.content
-                        .replace(/```(\w+)?\n([\s\S]*?)```/g, (match, lang, code) => {
-                            return `<pre><code class="language-${lang || ''}">${code.trim()}</code></pre>`;
-                        })
-                        .replace(/`([^`]+)`/g, '<code>$1</code>')
-                        .replace(/\n\s*[-•]\s+([^\n]+)/g, '\n• $1')
-                        .replace(/\n/g, '<br>');
-                    
-                    div.innerHTML = formattedContent;
-                } else {
-                    div.innerHTML = msg.content.replace(/\n/g, '<br>');
-                }
-                chatMessages.appendChild(div);
+                chatMessages.appendChild(renderMessage(msg));
             });
+
+            olderCursor = data.before_cursor;
+            updateLoadOlderButton(data.has_older);
             
         
             if (typeof hljs !== 'undefined') {
@@ -729,7 +867,8 @@ document.addEventListener("DOMContentLoaded", () => {
     
     const cleanupStorage = () => {
         const savedMode = localStorage.getItem('selectedMode');
-        if (savedMode && savedMode !== 'fraude' && savedMode !== 'lucifer' && savedMode !== 'eren') {
+        const knownModes = Array.from(modeSelect.options).map(option => option.value);
+        if (savedMode && !knownModes.includes(savedMode)) {
             console.log('Removing invalid mode from localStorage:', savedMode);
             localStorage.removeItem('selectedMode');
         }
@@ -743,13 +882,8 @@ document.addEventListener("DOMContentLoaded", () => {
         
         console.log('Retrieved savedMode from localStorage:', savedMode);
         
-        let modeToUse = 'fraude'; 
-        
-        if (savedMode === 'lucifer') {
-            modeToUse = 'lucifer';
-        } else if (savedMode === 'eren') {
-            modeToUse = 'eren';
-        }
+        // cleanupStorage() has already dropped unknown modes
+        const modeToUse = savedMode || modeSelect.options[0].value;
         
         console.log('Initializing theme with mode:', modeToUse);
 
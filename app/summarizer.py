@@ -0,0 +1,132 @@
+"""
+Rolling per-session conversation summaries.
+
+Once a session holds more than SUMMARY_TRIGGER_MESSAGES messages that its
+summary does not cover yet, the chat turn queues it here. A background worker
+folds the older of those messages (all but the newest SUMMARY_KEEP_RECENT)
+into the existing summary with one model call, and stores the result in
+`session_summary` together with the id of the last message it covers. Chat
+turns then send the summary plus only the messages after that id, so the
+prompt stays roughly the same size however old the session is, and each
+update only reads the messages added since the previous one.
+"""
+import os
+import time
+
+from app import metrics
+from app.background import BatchWorker
+from app.db_utils import get_db_connection
+from app.gemini import generate_background
+from app.personas import get_persona
+
+
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv('SUMMARY_TRIGGER_MESSAGES', '30'))
+SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', '10'))
+# Messages folded into the summary per model call
+SUMMARY_MAX_CHUNK = int(os.getenv('SUMMARY_MAX_CHUNK', '200'))
+
+
+def needs_summary(unsummarized_messages):
+    return SUMMARY_TRIGGER_MESSAGES > 0 and unsummarized_messages > SUMMARY_TRIGGER_MESSAGES
+
+
+def build_summary_prompt(previous_summary, messages):
+    transcript = "\n".join(
+        f"{'User' if msg['sender'] == 'user' else get_persona(msg['mode']).short_name}: "
+        f"{msg['content'][:2000]}"
+        for msg in messages
+    )
+    previous = previous_summary or "(no earlier summary)"
+    return (
+        "You maintain a running summary of a conversation between a user and a role-play assistant. "
+        "Update the summary so it also covers the new messages. Keep every fact, name, number, "
+        "preference and open question the user mentioned, and what was answered; drop small talk. "
+        "Write at most 250 words of plain prose in the user's language. Return only the summary.\n\n"
+        f"Current summary:\n{previous}\n\nNew messages:\n{transcript}"
+    )
+
+
+def summarize_session(session_id):
+    """
+    Fold the session's unsummarized messages, except the newest
+    SUMMARY_KEEP_RECENT, into its summary. Returns True when a summary was stored.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute(
+            "SELECT summary, last_message_id FROM session_summary WHERE session_id = %s",
+            (session_id,)
+        )
+        current = cursor.fetchone()
+        last_id = current['last_message_id'] if current else 0
+
+        cursor.execute("""
+            SELECT id, sender, content, mode FROM message
+            WHERE session_id = %s AND id > %s
+            ORDER BY id ASC
+            LIMIT %s
+        """, (session_id, last_id, SUMMARY_MAX_CHUNK + SUMMARY_KEEP_RECENT))
+        rows = cursor.fetchall()
+        # Don't hold a read snapshot open across the model call
+        conn.commit()
+
+        to_fold = rows[:len(rows) - SUMMARY_KEEP_RECENT] if len(rows) > SUMMARY_KEEP_RECENT else []
+        if not to_fold:
+            return False
+
+        prompt = build_summary_prompt(current['summary'] if current else None, to_fold)
+        start = time.perf_counter()
+        response = generate_background(prompt, 400)
+        summary = response.text.strip()
+        metrics.observe('summaries.generation', time.perf_counter() - start)
+        if not summary:
+            return False
+
+        new_last_id = to_fold[-1]['id']
+        if current:
+            # Another worker may have moved the summary on meanwhile; keep theirs
+            cursor.execute("""
+                UPDATE session_summary
+                SET summary = %s, last_message_id = %s, summarized_messages = summarized_messages + %s
+                WHERE session_id = %s AND last_message_id = %s
+            """, (summary, new_last_id, len(to_fold), session_id, last_id))
+        else:
+            cursor.execute("""
+                INSERT IGNORE INTO session_summary (session_id, summary, last_message_id, summarized_messages)
+                VALUES (%s, %s, %s, %s)
+            """, (session_id, summary, new_last_id, len(to_fold)))
+        stored = cursor.rowcount > 0
+        conn.commit()
+
+        if stored:
+            metrics.increment('summaries.updated')
+            metrics.record('summaries.folded_messages', len(to_fold))
+            print(f"📝 SUMMARY: session {session_id} summarized through message {new_last_id}")
+        return stored
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def summarize_batch(batch):
+    for (session_id,) in batch:
+        try:
+            summarize_session(session_id)
+        except Exception as e:
+            print(f"🚨 SUMMARY ERROR for session {session_id}: {str(e)}")
+            metrics.increment('summaries.failed')
+
+
+# summary_worker.enqueue(session_id); a session already waiting is not queued twice
+summary_worker = BatchWorker(
+    'summaries',
+    summarize_batch,
+    batch_size=5,
+    batch_wait=0,
+    dedupe_key=lambda item: item[0],
+)
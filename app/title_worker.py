@@ -0,0 +1,117 @@
+"""
+Background session title generation.
+
+A new conversation is saved with the local heuristic title from
+`fallback_session_title`, and its first message is queued here. A daemon
+thread per worker process collects pending sessions for up to
+TITLE_BATCH_WAIT seconds (or TITLE_BATCH_SIZE sessions), asks the model for all
+of their titles in one call and updates `session.title`. The update only
+applies while the heuristic title is still in place, so a rename that happens
+in the meantime is never overwritten.
+"""
+import os
+import time
+
+from app import metrics
+from app.background import BatchWorker
+from app.db_utils import get_db_connection
+from app.gemini import generate_session_titles, fallback_session_title
+
+
+PLACEHOLDER_TITLES = ('Default Session', 'New Session', 'New Chat', 'Untitled Chat')
+
+
+def retitle_batch(batch):
+    """
+    Generate titles for [(session_id, first_message, expected_title), ...] with one
+    model call and store them. Rows whose title no longer equals expected_title
+    are left alone (pass None to overwrite unconditionally).
+    """
+    start = time.perf_counter()
+    titles = generate_session_titles([first_message for _, first_message, _ in batch])
+    metrics.observe('titles.batch_generation', time.perf_counter() - start)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    updated = 0
+    try:
+        for (session_id, _, expected_title), title in zip(batch, titles):
+            if expected_title is None:
+                cursor.execute("UPDATE session SET title = %s WHERE id = %s", (title, session_id))
+            else:
+                cursor.execute(
+                    "UPDATE session SET title = %s WHERE id = %s AND title = %s",
+                    (title, session_id, expected_title)
+                )
+            updated += cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+    metrics.increment('titles.updated', updated)
+    return updated
+
+
+def retitle_sessions(batch_size=20, include_all=False, limit=None):
+    """
+    Bulk-retitle existing sessions from their first user message. By default only
+    sessions still carrying a placeholder or heuristic title are touched.
+    Returns the number of sessions updated.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    last_id = 0
+    processed = 0
+    updated = 0
+
+    try:
+        while limit is None or processed < limit:
+            page_size = batch_size if limit is None else min(batch_size, limit - processed)
+            cursor.execute("""
+                SELECT s.id, s.title,
+                    (SELECT content FROM message
+                     WHERE message.session_id = s.id AND sender = 'user'
+                     ORDER BY id ASC LIMIT 1) AS first_message
+                FROM session s
+                WHERE s.id > %s AND s.user_message_count > 0
+                ORDER BY s.id ASC
+                LIMIT %s
+            """, (last_id, page_size))
+            rows = cursor.fetchall()
+            conn.commit()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            processed += len(rows)
+
+            batch = [
+                (session_id, first_message, title)
+                for session_id, title, first_message in rows
+                if first_message and (
+                    include_all
+                    or not title
+                    or title.startswith(PLACEHOLDER_TITLES)
+                    or title == fallback_session_title(first_message)
+                )
+            ]
+            if batch:
+                updated += retitle_batch(batch)
+                print(f"✓ Retitled batch ending at session {last_id} ({updated} updated so far)")
+    finally:
+        cursor.close()
+        conn.close()
+
+    return updated
+
+
+# title_worker.enqueue(session_id, first_message, current_title)
+title_worker = BatchWorker(
+    'titles',
+    retitle_batch,
+    batch_size=int(os.getenv('TITLE_BATCH_SIZE', '10')),
+    batch_wait=float(os.getenv('TITLE_BATCH_WAIT', '2')),
+)
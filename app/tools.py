@@ -0,0 +1,366 @@
+"""
+The model's tools: a registry, and sandboxed execution of do_math.
+
+`tool_registry` holds every tool the model may call, with the function
+declaration the backends send and its handler. `run_calls` executes all
+function calls of one model turn concurrently on a thread pool
+(TOOL_EXECUTOR_THREADS) and records per-tool timings under `tools.<name>.*`.
+The multi-step loop around it lives in app.gemini and is bounded by
+TOOL_MAX_STEPS model round trips and TOOL_LOOP_BUDGET seconds.
+
+`do_math` never runs sympy in the web worker. Expressions go to a small pool
+of warm worker processes (TOOL_POOL_WORKERS), each of which imports sympy
+once at start. A call waits at most TOOL_TIMEOUT seconds, or less if the
+chat turn's deadline is nearer. A worker that overruns is killed and
+replaced, so a pathological expression costs one process, not a web thread.
+Workers run under an address-space limit of TOOL_MEMORY_LIMIT_MB (POSIX
+only), and a worker that dies is replaced too.
+
+Expressions are checked before they leave the web worker: at most
+TOOL_MAX_EXPRESSION_LENGTH characters, from a small alphabet, and no dunder
+names. The worker parses them with a namespace that holds only sympy's math
+functions and no builtins, instead of sympify's full eval namespace.
+
+Results (including the errors of invalid expressions, but not timeouts) are
+memoized per normalized expression in an LRU of TOOL_MEMO_SIZE entries.
+TOOL_POOL_WORKERS=0 evaluates in the calling thread with no timeout, for
+platforms without fork.
+
+Counted under `tools.do_math.*` in app.metrics; `tool_pool.status()` is
+served by /admin/metrics.
+"""
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+
+from app import metrics
+
+
+TOOL_POOL_WORKERS = int(os.getenv('TOOL_POOL_WORKERS', '2'))
+TOOL_TIMEOUT = float(os.getenv('TOOL_TIMEOUT', '3'))
+TOOL_MEMORY_LIMIT_MB = int(os.getenv('TOOL_MEMORY_LIMIT_MB', '512'))
+TOOL_MEMO_SIZE = int(os.getenv('TOOL_MEMO_SIZE', '1024'))
+TOOL_MAX_EXPRESSION_LENGTH = int(os.getenv('TOOL_MAX_EXPRESSION_LENGTH', '500'))
+TOOL_EXECUTOR_THREADS = int(os.getenv('TOOL_EXECUTOR_THREADS', '8'))
+TOOL_MAX_STEPS = int(os.getenv('TOOL_MAX_STEPS', '4'))
+TOOL_LOOP_BUDGET = float(os.getenv('TOOL_LOOP_BUDGET', '15'))
+
+DO_MATH_DECLARATION = {
+    "name": "do_math",
+    "description": "Evaluates a mathematical expression (algebraic or numeric)",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "expression": {
+                "type": "string",
+                "description": "The mathematical expression to evaluate"
+            }
+        },
+        "required": ["expression"]
+    }
+}
+
+_ALLOWED_EXPRESSION = re.compile(r"^[A-Za-z0-9_\s.,+\-*/^%()=<>!\[\]]*$")
+_WHITESPACE = re.compile(r"\s+")
+
+# The only names an expression can reach, besides symbols it introduces itself
+_MATH_NAMES = (
+    'Integer', 'Float', 'Rational', 'Symbol', 'Function', 'Eq',
+    'pi', 'E', 'I', 'oo', 'zoo', 'nan',
+    'sin', 'cos', 'tan', 'cot', 'sec', 'csc', 'asin', 'acos', 'atan', 'atan2',
+    'sinh', 'cosh', 'tanh', 'asinh', 'acosh', 'atanh',
+    'exp', 'log', 'ln', 'sqrt', 'cbrt', 'root', 'Abs', 'sign', 'floor', 'ceiling',
+    'factorial', 'binomial', 'gamma', 'gcd', 'lcm', 'isprime', 'prime', 'factorint',
+    'Min', 'Max', 'Sum', 'Product', 'Matrix',
+    'diff', 'integrate', 'limit', 'series', 'summation', 'product',
+    'solve', 'expand', 'factor', 'simplify', 'together', 'apart', 'cancel', 'trigsimp', 'N',
+)
+
+
+def normalize_expression(expression):
+    return _WHITESPACE.sub(" ", expression or "").strip().replace("^", "**")
+
+
+def check_expression(expression):
+    """An error message for expressions that are never sent to a worker, else None"""
+    if not expression or not expression.strip():
+        return "Empty expression"
+    if len(expression) > TOOL_MAX_EXPRESSION_LENGTH:
+        return f"Expression longer than {TOOL_MAX_EXPRESSION_LENGTH} characters"
+    if not _ALLOWED_EXPRESSION.match(expression) or "__" in expression:
+        return "Expression contains unsupported characters"
+    return None
+
+
+def _evaluate(expression, namespace, transformations):
+    try:
+        from sympy import simplify
+        from sympy.parsing.sympy_parser import parse_expr
+
+        result = simplify(parse_expr(expression, local_dict={}, global_dict=dict(namespace),
+                                     transformations=transformations))
+        return {"result": str(result)}
+    except MemoryError:
+        return {"error": "Expression needs more memory than allowed"}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def _math_namespace():
+    """(namespace, transformations) for parse_expr; imports sympy"""
+    import sympy
+    from sympy.parsing.sympy_parser import standard_transformations, convert_xor
+
+    namespace = {name: getattr(sympy, name) for name in _MATH_NAMES if hasattr(sympy, name)}
+    namespace['ln'] = sympy.log
+    namespace['__builtins__'] = {}
+    return namespace, standard_transformations + (convert_xor,)
+
+
+def _worker_main(conn, memory_limit_mb):
+    """Entry point of a pool process: preload sympy, then evaluate until the pipe closes"""
+    if memory_limit_mb > 0:
+        try:
+            import resource
+            limit = memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass
+    try:
+        namespace, transformations = _math_namespace()
+    except Exception as e:
+        namespace, transformations, preload_error = None, None, str(e)
+
+    while True:
+        try:
+            expression = conn.recv()
+        except (EOFError, OSError):
+            return
+        if namespace is None:
+            conn.send({"error": preload_error})
+        else:
+            conn.send(_evaluate(expression, namespace, transformations))
+
+
+class _Worker:
+
+    def __init__(self, context, memory_limit_mb):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, memory_limit_mb), name='tool-worker', daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        try:
+            self.process.kill()
+            self.process.join(1)
+        except Exception:
+            pass
+        self.conn.close()
+
+
+class ToolPool:
+
+    def __init__(self, workers=2, timeout=3.0, memory_limit_mb=512, memo_size=1024):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self._idle = None
+        self._pid = None
+        self._inline = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=TOOL_POOL_WORKERS,
+            timeout=TOOL_TIMEOUT,
+            memory_limit_mb=TOOL_MEMORY_LIMIT_MB,
+            memo_size=TOOL_MEMO_SIZE,
+        )
+
+    def _context(self):
+        methods = multiprocessing.get_all_start_methods()
+        return multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+
+    def _ensure_started(self):
+        """Start this process's workers; a forked gunicorn worker gets its own"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = queue.Queue()
+                for _ in range(self.workers):
+                    self._idle.put(_Worker(self._context(), self.memory_limit_mb))
+                self._pid = os.getpid()
+                print(f"🧮 TOOL POOL: {self.workers} worker processes started")
+
+    def _replace(self, worker):
+        worker.kill()
+        metrics.increment('tools.do_math.worker_restarts')
+        self._idle.put(_Worker(self._context(), self.memory_limit_mb))
+
+    def _memo_get(self, key):
+        with self._lock:
+            result = self._memo.get(key)
+            if result is not None:
+                self._memo.move_to_end(key)
+            return result
+
+    def _memo_set(self, key, result):
+        with self._lock:
+            self._memo[key] = result
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+
+    def _run_inline(self, expression):
+        if self._inline is None:
+            self._inline = _math_namespace()
+        return _evaluate(expression, *self._inline)
+
+    def _run_in_worker(self, expression, timeout):
+        """The worker's result, or None when it timed out or died"""
+        self._ensure_started()
+        start = time.monotonic()
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            metrics.increment('tools.do_math.pool_busy')
+            return None
+        try:
+            worker.conn.send(expression)
+            if worker.conn.poll(max(0.0, timeout - (time.monotonic() - start))):
+                result = worker.conn.recv()
+                self._idle.put(worker)
+                return result
+        except (EOFError, OSError):
+            metrics.increment('tools.do_math.worker_crashes')
+            self._replace(worker)
+            return {"error": "Expression could not be evaluated within the memory limit"}
+        self._replace(worker)
+        return None
+
+    def do_math(self, expression, deadline=None):
+        """Evaluate and simplify `expression`; returns {"result": str} or {"error": str}"""
+        error = check_expression(expression)
+        if error:
+            metrics.increment('tools.do_math.rejected')
+            return {"error": error}
+
+        key = normalize_expression(expression)
+        cached = self._memo_get(key)
+        if cached is not None:
+            metrics.increment('tools.do_math.memo_hits')
+            return cached
+        metrics.increment('tools.do_math.memo_misses')
+
+        timeout = self.timeout
+        if deadline is not None:
+            timeout = max(0.0, min(timeout, deadline - time.monotonic()))
+
+        start = time.perf_counter()
+        if self.workers <= 0:
+            result = self._run_inline(key)
+        elif timeout > 0:
+            result = self._run_in_worker(key, timeout)
+        else:
+            result = None  # The turn's deadline has already passed
+        metrics.observe('tools.do_math.latency', time.perf_counter() - start)
+
+        if result is None:
+            metrics.increment('tools.do_math.timeouts')
+            print(f"⏱️ TOOL TIMEOUT: do_math({expression[:80]!r}) exceeded {timeout:.1f}s")
+            return {"error": f"Evaluation took longer than {timeout:.1f} seconds"}
+        if "error" in result:
+            metrics.increment('tools.do_math.errors')
+        self._memo_set(key, result)
+        return result
+
+    def status(self):
+        with self._lock:
+            memo_entries = len(self._memo)
+        return {
+            'workers': self.workers,
+            'idle_workers': self._idle.qsize() if self._idle is not None and self._pid == os.getpid() else 0,
+            'timeout': self.timeout,
+            'memory_limit_mb': self.memory_limit_mb,
+            'memo_entries': memo_entries,
+            'memo_size': self.memo_size
+        }
+
+
+tool_pool = ToolPool.from_env()
+
+
+def do_math(expression, deadline=None):
+    return tool_pool.do_math(expression, deadline)
+
+
+class ToolRegistry:
+
+    def __init__(self, threads=8):
+        self.threads = threads
+        self._tools = {}
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def register(self, declaration, handler):
+        """Make `handler(args, deadline)` callable by the model under `declaration`'s name"""
+        self._tools[declaration["name"]] = (declaration, handler)
+
+    def declarations(self):
+        return [declaration for declaration, _ in self._tools.values()]
+
+    def names(self):
+        return list(self._tools)
+
+    def _executor_for_process(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='tool-call')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def run(self, name, args, deadline=None):
+        """Run one call; returns the result dict, which holds "error" on failure"""
+        tool = self._tools.get(name)
+        if tool is None:
+            metrics.increment('tools.unknown')
+            return {"error": f"Unknown tool: {name}"}
+        start = time.perf_counter()
+        try:
+            result = tool[1](args, deadline)
+        except Exception as e:
+            print(f"🚨 TOOL ERROR: {name}: {str(e)}")
+            result = {"error": str(e)}
+        metrics.observe(f'tools.{name}.duration', time.perf_counter() - start)
+        metrics.increment(f'tools.{name}.calls')
+        return result
+
+    def run_calls(self, calls, deadline=None):
+        """
+        Run the (name, args) calls of one model turn concurrently; returns their
+        results in the same order
+        """
+        if len(calls) == 1:
+            name, args = calls[0]
+            return [self.run(name, args, deadline)]
+        executor = self._executor_for_process()
+        futures = [executor.submit(self.run, name, args, deadline) for name, args in calls]
+        return [future.result() for future in futures]
+
+
+tool_registry = ToolRegistry(TOOL_EXECUTOR_THREADS)
+tool_registry.register(DO_MATH_DECLARATION, lambda args, deadline: do_math(args.get("expression", ""), deadline))
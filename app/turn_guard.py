@@ -0,0 +1,383 @@
+"""
+Idempotency keys and per-session single-flight for chat turns.
+
+A client that retries POST /chat/message (or /chat/message/stream) after a
+timeout sends the same `Idempotency-Key` header as the first attempt. The
+first request with a key owns the turn. Repeats with that key, concurrent or
+later, wait for the owner and get its stored result instead of starting a
+second generation:
+
+- a repeat in the same worker process waits on the owner in memory;
+- a repeat in another worker polls the `chat_idempotency` row.
+
+A key reused with a different message is rejected. If the owner fails, its
+row is deleted so the next retry runs the turn again. A pending row older
+than IDEMPOTENCY_PENDING_TIMEOUT is taken to be from a dead worker and can be
+taken over. Results are kept for IDEMPOTENCY_TTL seconds;
+`python manage.py purge-idempotency` deletes older rows.
+
+Independently of keys, turns of one session run one at a time.
+`session_turn_lock` first resolves the session the turn will run in (the
+requested one if it is the user's, else their latest, else a new one) and
+then holds that session's MySQL named lock (GET_LOCK) for the whole turn, so
+parallel tabs cannot interleave history or pay for the same context twice.
+It works across workers and hosts that share the database.
+`session_turn_lock_async` and `run_once_async` are the same guards for the
+asyncio chat path (app.async_turn).
+
+Counted under `idempotency.*` and `chat_turn.session_*` in app.metrics.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from app import metrics
+from app.db_utils import get_db_connection
+
+
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_PENDING_TIMEOUT = int(os.getenv('IDEMPOTENCY_PENDING_TIMEOUT', '120'))
+CHAT_SESSION_LOCK_TIMEOUT = float(os.getenv('CHAT_SESSION_LOCK_TIMEOUT', '30'))
+
+_KEY_PATTERN = re.compile(r"^[A-Za-z0-9_.:-]{1,64}$")
+_POLL_INTERVAL = 0.25
+
+
+class IdempotencyConflict(Exception):
+    """The key belongs to a different request, or its turn did not finish in time"""
+
+    def __init__(self, message, status=409):
+        self.status = status
+        super().__init__(message)
+
+
+class SessionBusy(Exception):
+    """Another turn of the session held its lock for longer than the caller could wait"""
+
+
+def valid_key(key):
+    return bool(key) and bool(_KEY_PATTERN.match(key))
+
+
+def request_hash(content, session_id, mode):
+    material = json.dumps([content, session_id, (mode or 'fraude').lower()], ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _land(flight_key, result):
+    with _flights_lock:
+        flight = _flights.pop(flight_key, None)
+    if flight is not None:
+        flight.result = result
+        flight.done.set()
+
+
+def _claim_row(user_id, key, fingerprint):
+    """Returns ('owner', None), ('done', result) or ('pending', None) for the key's row"""
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            INSERT IGNORE INTO chat_idempotency (user_id, idempotency_key, request_hash)
+            VALUES (%s, %s, %s)
+        """, (user_id, key, fingerprint))
+        if cursor.rowcount > 0:
+            conn.commit()
+            return 'owner', None
+
+        cursor.execute("""
+            SELECT request_hash, status, response,
+                   TIMESTAMPDIFF(SECOND, created_at, NOW()) AS age,
+                   TIMESTAMPDIFF(SECOND, updated_at, NOW()) AS idle
+            FROM chat_idempotency
+            WHERE user_id = %s AND idempotency_key = %s
+        """, (user_id, key))
+        row = cursor.fetchone()
+        conn.commit()
+        if row is None:
+            # Deleted by a failed owner since the INSERT; claim it on the next round
+            return 'pending', None
+
+        expired = row['status'] == 'done' and row['age'] > IDEMPOTENCY_TTL
+        abandoned = row['status'] == 'pending' and row['idle'] > IDEMPOTENCY_PENDING_TIMEOUT
+        if expired or abandoned:
+            cursor.execute("""
+                UPDATE chat_idempotency
+                SET request_hash = %s, status = 'pending', response = NULL, created_at = NOW()
+                WHERE user_id = %s AND idempotency_key = %s AND status = %s AND request_hash = %s
+            """, (fingerprint, user_id, key, row['status'], row['request_hash']))
+            taken = cursor.rowcount > 0
+            conn.commit()
+            return ('owner', None) if taken else ('pending', None)
+
+        if row['request_hash'] != fingerprint:
+            raise IdempotencyConflict("Idempotency-Key was already used for a different message", 422)
+        if row['status'] == 'done':
+            return 'done', json.loads(row['response'])
+        return 'pending', None
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def claim(user_id, key, fingerprint, deadline):
+    """
+    Claim `key` for this request. Returns (True, None) when the caller owns the
+    turn and must call complete() or abandon(); otherwise (False, result) with
+    the owner's result. Raises IdempotencyConflict when the key was used for
+    another message, or the owner has not finished by `deadline`.
+    """
+    flight_key = (user_id, key)
+    while True:
+        with _flights_lock:
+            flight = _flights.get(flight_key)
+            local_owner = flight is None
+            if local_owner:
+                flight = _flights[flight_key] = _Flight()
+
+        if not local_owner:
+            metrics.increment('idempotency.attached')
+            if not flight.done.wait(max(0.0, deadline - time.monotonic())):
+                raise IdempotencyConflict("The original request for this Idempotency-Key is still in progress")
+            if flight.result is not None:
+                return False, flight.result
+            continue  # The owner failed; try to run the turn ourselves
+
+        try:
+            while True:
+                state, result = _claim_row(user_id, key, fingerprint)
+                if state == 'owner':
+                    metrics.increment('idempotency.claimed')
+                    return True, None
+                if state == 'done':
+                    metrics.increment('idempotency.replayed')
+                    _land(flight_key, result)
+                    return False, result
+                if time.monotonic() + _POLL_INTERVAL > deadline:
+                    raise IdempotencyConflict("The original request for this Idempotency-Key is still in progress")
+                metrics.increment('idempotency.polls')
+                time.sleep(_POLL_INTERVAL)
+        except Exception:
+            _land(flight_key, None)
+            raise
+
+
+def complete(user_id, key, result):
+    """Store the owner's result and hand it to everyone waiting on the key"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE chat_idempotency SET status = 'done', response = %s
+            WHERE user_id = %s AND idempotency_key = %s
+        """, (json.dumps(result, default=str), user_id, key))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+        _land((user_id, key), result)
+
+
+def abandon(user_id, key):
+    """The owner failed: free the key so a retry runs the turn again"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "DELETE FROM chat_idempotency WHERE user_id = %s AND idempotency_key = %s AND status = 'pending'",
+                (user_id, key)
+            )
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+    except Exception as e:
+        print(f"⚠️ IDEMPOTENCY: could not release key for user {user_id}: {str(e)}")
+    finally:
+        metrics.increment('idempotency.abandoned')
+        _land((user_id, key), None)
+
+
+def run_once(user_id, key, fingerprint, deadline, turn):
+    """Run `turn()` unless `key` already has (or is producing) a result; return that result"""
+    owner, result = claim(user_id, key, fingerprint, deadline)
+    if not owner:
+        return result
+    try:
+        result = turn()
+    except BaseException:
+        abandon(user_id, key)
+        raise
+    complete(user_id, key, result)
+    return result
+
+
+async def run_once_async(user_id, key, fingerprint, deadline, turn):
+    """
+    run_once for the asyncio chat path: `turn()` is a coroutine function. The
+    key bookkeeping is short database work and runs on a worker thread;
+    waiting on another worker's turn polls there too.
+    """
+    owner, result = await asyncio.to_thread(claim, user_id, key, fingerprint, deadline)
+    if not owner:
+        return result
+    try:
+        result = await turn()
+    except BaseException:
+        await asyncio.shield(asyncio.to_thread(abandon, user_id, key))
+        raise
+    await asyncio.shield(asyncio.to_thread(complete, user_id, key, result))
+    return result
+
+
+def purge_expired(batch_size=1000):
+    """Delete results older than IDEMPOTENCY_TTL; returns the number of rows removed"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    removed = 0
+    try:
+        while True:
+            cursor.execute("""
+                DELETE FROM chat_idempotency
+                WHERE created_at < NOW() - INTERVAL %s SECOND
+                LIMIT %s
+            """, (IDEMPOTENCY_TTL + IDEMPOTENCY_PENDING_TIMEOUT, batch_size))
+            conn.commit()
+            removed += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return removed
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# The session a turn runs in: the requested one if it is the user's, else their
+# latest (same order as app.chat_turn.LATEST_SESSION_SQL)
+OWNED_SESSION_SQL = "SELECT id FROM session WHERE id = %s AND user_id = %s"
+LATEST_SESSION_ID_SQL = "SELECT id FROM session WHERE user_id = %s ORDER BY is_active DESC, id DESC LIMIT 1"
+
+
+def _lock_timeout(deadline):
+    """Seconds to wait for a named lock"""
+    timeout = CHAT_SESSION_LOCK_TIMEOUT
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.monotonic())
+    return max(0, int(timeout))
+
+
+def _resolve_queries(user_id, session_id):
+    """The (sql, params) to try in order for the id of the turn's session"""
+    queries = [(OWNED_SESSION_SQL, (session_id, user_id))] if session_id else []
+    return queries + [(LATEST_SESSION_ID_SQL, (user_id,))]
+
+
+def _lock_taken(acquired, start):
+    metrics.observe('chat_turn.session_lock_wait', time.perf_counter() - start)
+    if not acquired:
+        metrics.increment('chat_turn.session_busy')
+        raise SessionBusy("Another message in this conversation is still being answered")
+
+
+def _resolve_session(cursor, user_id, session_id):
+    for sql, params in _resolve_queries(user_id, session_id):
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+    return None
+
+
+@contextmanager
+def _named_lock(cursor, name, deadline):
+    start = time.perf_counter()
+    cursor.execute("SELECT GET_LOCK(%s, %s)", (name, _lock_timeout(deadline)))
+    _lock_taken(cursor.fetchone()[0] == 1, start)
+    try:
+        yield
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+        cursor.fetchall()
+
+
+@contextmanager
+def session_turn_lock(conn, user_id, session_id, create_session, deadline=None):
+    """
+    Resolve the turn's session and hold its named lock on `conn` for the
+    duration of the turn; yields the session id. That is `session_id` when
+    it belongs to `user_id`, else the user's latest session, so a foreign id
+    never locks someone else's session and a turn without an id locks the
+    same session as one naming it. A user without sessions gets one from
+    `create_session(cursor)`, made under a per-user lock so parallel first
+    messages share it. Raises SessionBusy after CHAT_SESSION_LOCK_TIMEOUT, or
+    sooner if `deadline` comes first.
+    """
+    cursor = conn.cursor(buffered=True)
+    try:
+        resolved = _resolve_session(cursor, user_id, session_id)
+        # End the read snapshot, so what the lock's last holder committed is visible to the turn
+        conn.commit()
+        if resolved is None:
+            with _named_lock(cursor, f"chat_user_{int(user_id)}", deadline):
+                resolved = _resolve_session(cursor, user_id, None) or create_session(cursor)
+                conn.commit()
+        with _named_lock(cursor, f"chat_session_{int(resolved)}", deadline):
+            yield resolved
+    finally:
+        cursor.close()
+
+
+async def _resolve_session_async(cursor, user_id, session_id):
+    for sql, params in _resolve_queries(user_id, session_id):
+        await cursor.execute(sql, params)
+        row = await cursor.fetchone()
+        if row:
+            return row[0]
+    return None
+
+
+@asynccontextmanager
+async def _named_lock_async(cursor, name, deadline):
+    start = time.perf_counter()
+    await cursor.execute("SELECT GET_LOCK(%s, %s)", (name, _lock_timeout(deadline)))
+    _lock_taken((await cursor.fetchone())[0] == 1, start)
+    try:
+        yield
+    finally:
+        await cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+        await cursor.fetchall()
+
+
+@asynccontextmanager
+async def session_turn_lock_async(conn, user_id, session_id, create_session, deadline=None):
+    """
+    session_turn_lock on an aiomysql connection (app.async_db) for the asyncio
+    chat path; `create_session(cursor)` is a coroutine function
+    """
+    async with conn.cursor() as cursor:
+        resolved = await _resolve_session_async(cursor, user_id, session_id)
+        await conn.commit()
+        if resolved is None:
+            async with _named_lock_async(cursor, f"chat_user_{int(user_id)}", deadline):
+                resolved = await _resolve_session_async(cursor, user_id, None) or await create_session(cursor)
+                await conn.commit()
+        async with _named_lock_async(cursor, f"chat_session_{int(resolved)}", deadline):
+            yield resolved
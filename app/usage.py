@@ -0,0 +1,191 @@
+"""
+Per-reply token, latency and cost accounting.
+
+Every chatbot message row carries the usage of the model calls that produced
+it:
+
+- prompt, output and cached prompt tokens;
+- the model name and upstream latency;
+- the number of tool calls and the finish reason.
+
+Replies served from the response cache or from a canned persona text leave
+these columns NULL. app.gemini fills a TurnUsage while it talks to the model,
+and app.chat_turn writes it with the reply's INSERT.
+
+The same transaction adds the reply to `usage_daily`, a rollup keyed by
+(day, user, mode). The admin usage endpoints read only the rollup, never
+`message`. `recompute_usage` rebuilds it from the message table and is
+exposed as `python manage.py repair-usage`.
+
+Cost is derived from token totals when a report is read, with the per-million
+token prices in LLM_PRICE_INPUT, LLM_PRICE_CACHED_INPUT and LLM_PRICE_OUTPUT
+(USD). Changing a price therefore reprices history too.
+"""
+import datetime
+import os
+
+
+LLM_PRICE_INPUT = float(os.getenv('LLM_PRICE_INPUT', '0.30'))
+LLM_PRICE_CACHED_INPUT = float(os.getenv('LLM_PRICE_CACHED_INPUT', '0.075'))
+LLM_PRICE_OUTPUT = float(os.getenv('LLM_PRICE_OUTPUT', '2.50'))
+
+USAGE_COLUMNS = ('prompt_tokens', 'output_tokens', 'cached_tokens', 'model', 'llm_latency_ms',
+                 'tool_calls', 'finish_reason')
+
+# Report groupings: (key columns, ORDER BY)
+_GROUPS = {
+    'user': ("u.user_id, us.username", "cost_usd DESC"),
+    'mode': ("u.mode", "cost_usd DESC"),
+    'day': ("u.day", "u.day"),
+}
+
+
+class TurnUsage:
+    """Usage of the model calls behind one reply, summed over tool round trips and retries"""
+
+    def __init__(self):
+        self.model = None
+        self.prompt_tokens = None
+        self.output_tokens = None
+        self.cached_tokens = None
+        self.llm_latency_ms = None
+        self.tool_calls = 0
+        self.finish_reason = None
+
+    def add_response(self, response, model=None):
+        """Account for one model response (for a stream, its final chunk)"""
+        if response is None:
+            return
+        self.model = model or self.model
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            self.prompt_tokens = (self.prompt_tokens or 0) + (getattr(usage, 'prompt_token_count', 0) or 0)
+            self.output_tokens = (self.output_tokens or 0) + (getattr(usage, 'candidates_token_count', 0) or 0)
+            self.cached_tokens = (self.cached_tokens or 0) + (getattr(usage, 'cached_content_token_count', 0) or 0)
+        candidates = getattr(response, 'candidates', None)
+        if candidates:
+            reason = candidates[0].finish_reason
+            self.finish_reason = str(getattr(reason, 'name', reason))[:32] if reason is not None else None
+
+    def columns(self):
+        """Values for USAGE_COLUMNS; all NULL when no model call was made"""
+        if self.model is None:
+            return (None,) * len(USAGE_COLUMNS)
+        return (self.prompt_tokens, self.output_tokens, self.cached_tokens, self.model[:64],
+                self.llm_latency_ms, self.tool_calls, self.finish_reason)
+
+
+USAGE_ROLLUP_SQL = """
+    INSERT INTO usage_daily
+        (day, user_id, mode, replies, model_replies, prompt_tokens, output_tokens,
+         cached_tokens, tool_calls, llm_latency_ms)
+    VALUES (%s, %s, %s, 1, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        replies = replies + 1,
+        model_replies = model_replies + VALUES(model_replies),
+        prompt_tokens = prompt_tokens + VALUES(prompt_tokens),
+        output_tokens = output_tokens + VALUES(output_tokens),
+        cached_tokens = cached_tokens + VALUES(cached_tokens),
+        tool_calls = tool_calls + VALUES(tool_calls),
+        llm_latency_ms = llm_latency_ms + VALUES(llm_latency_ms)
+"""
+
+
+def usage_rollup_params(user_id, mode, usage, created_at):
+    """Parameters of USAGE_ROLLUP_SQL for one stored reply"""
+    model_reply = usage is not None and usage.model is not None
+    return (
+        created_at.date(), user_id, mode, 1 if model_reply else 0,
+        (usage.prompt_tokens or 0) if model_reply else 0,
+        (usage.output_tokens or 0) if model_reply else 0,
+        (usage.cached_tokens or 0) if model_reply else 0,
+        (usage.tool_calls or 0) if model_reply else 0,
+        (usage.llm_latency_ms or 0) if model_reply else 0,
+    )
+
+
+def record_usage(cursor, user_id, mode, usage, created_at):
+    """Add one stored reply to the daily rollup; same transaction as its INSERT"""
+    cursor.execute(USAGE_ROLLUP_SQL, usage_rollup_params(user_id, mode, usage, created_at))
+
+
+def recompute_usage(cursor, user_id=None):
+    """Rebuild `usage_daily` from the message table, optionally for one user only"""
+    user_filter = "AND s.user_id = %s" if user_id is not None else ""
+    params = (user_id,) if user_id is not None else ()
+    cursor.execute(f"DELETE FROM usage_daily {'WHERE user_id = %s' if user_id is not None else ''}", params)
+    cursor.execute(f"""
+        INSERT INTO usage_daily
+            (day, user_id, mode, replies, model_replies, prompt_tokens, output_tokens,
+             cached_tokens, tool_calls, llm_latency_ms)
+        SELECT DATE(m.created_at), s.user_id, COALESCE(m.mode, 'fraude'), COUNT(*),
+               SUM(m.model IS NOT NULL), COALESCE(SUM(m.prompt_tokens), 0),
+               COALESCE(SUM(m.output_tokens), 0), COALESCE(SUM(m.cached_tokens), 0),
+               COALESCE(SUM(m.tool_calls), 0), COALESCE(SUM(m.llm_latency_ms), 0)
+        FROM message m
+        JOIN session s ON m.session_id = s.id
+        WHERE m.sender = 'chatbot' {user_filter}
+        GROUP BY DATE(m.created_at), s.user_id, COALESCE(m.mode, 'fraude')
+    """, params)
+    return cursor.rowcount
+
+
+def _cost(row):
+    uncached = row['prompt_tokens'] - row['cached_tokens']
+    return round((uncached * LLM_PRICE_INPUT + row['cached_tokens'] * LLM_PRICE_CACHED_INPUT
+                  + row['output_tokens'] * LLM_PRICE_OUTPUT) / 1_000_000, 6)
+
+
+def usage_report(cursor, group, days=30, user_id=None, mode=None, limit=100):
+    """
+    Usage totals of the last `days` days grouped by 'user', 'mode' or 'day',
+    most expensive first (oldest first by day). `user_id` and `mode` narrow the
+    rows that are summed.
+    """
+    keys, order = _GROUPS[group]
+    # usage_daily rows are keyed on UTC days (see usage_rollup_params)
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days - 1)
+    conditions, params = ["u.day >= %s"], [since]
+    if user_id is not None:
+        conditions.append("u.user_id = %s")
+        params.append(user_id)
+    if mode is not None:
+        conditions.append("u.mode = %s")
+        params.append(mode)
+    join = "JOIN users us ON us.id = u.user_id" if group == 'user' else ""
+    cost = "(SUM(u.prompt_tokens - u.cached_tokens) * %s + SUM(u.cached_tokens) * %s + SUM(u.output_tokens) * %s)"
+
+    cursor.execute(f"""
+        SELECT {keys},
+               CAST(SUM(u.replies) AS SIGNED) AS replies,
+               CAST(SUM(u.model_replies) AS SIGNED) AS model_replies,
+               CAST(SUM(u.prompt_tokens) AS SIGNED) AS prompt_tokens,
+               CAST(SUM(u.output_tokens) AS SIGNED) AS output_tokens,
+               CAST(SUM(u.cached_tokens) AS SIGNED) AS cached_tokens,
+               CAST(SUM(u.tool_calls) AS SIGNED) AS tool_calls,
+               CAST(SUM(u.llm_latency_ms) AS SIGNED) AS llm_latency_ms,
+               {cost} AS cost_usd
+        FROM usage_daily u
+        {join}
+        WHERE {' AND '.join(conditions)}
+        GROUP BY {keys}
+        ORDER BY {order}
+        LIMIT %s
+    """, (LLM_PRICE_INPUT, LLM_PRICE_CACHED_INPUT, LLM_PRICE_OUTPUT, *params, limit))
+    rows = cursor.fetchall()
+
+    for row in rows:
+        row['cost_usd'] = _cost(row)
+        row['avg_llm_latency_ms'] = round(row['llm_latency_ms'] / row['model_replies']) if row['model_replies'] else None
+        row['avg_prompt_tokens'] = round(row['prompt_tokens'] / row['model_replies']) if row['model_replies'] else None
+        if 'day' in row:
+            row['day'] = row['day'].isoformat()
+    return {
+        'group': group,
+        'days': days,
+        'since': since.isoformat(),
+        'prices_per_million_tokens': {
+            'input': LLM_PRICE_INPUT, 'cached_input': LLM_PRICE_CACHED_INPUT, 'output': LLM_PRICE_OUTPUT
+        },
+        'rows': rows
+    }
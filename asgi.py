@@ -0,0 +1,9 @@
+"""
+ASGI entry point: the asyncio chat endpoints in front of the Flask app (app.asgi).
+
+    WEB_WORKER_CLASS=asgi gunicorn --config gunicorn.conf.py
+    uvicorn asgi:application
+"""
+from app.asgi import create_asgi_app
+
+application = create_asgi_app()
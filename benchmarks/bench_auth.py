@@ -0,0 +1,103 @@
+"""
+Per-request authentication overhead benchmark.
+
+Times the token check every authenticated request pays, offline and without
+a database:
+
+  inline      What the routes did before app.auth: os.getenv('SECRET_KEY')
+              and jwt.decode on every request
+  cold        app.auth.authenticate with an empty token cache (a user's
+              first request after login or after the entry expired)
+  cached      app.auth.authenticate once the token is in the cache
+  admin       require_admin's extra is_admin_user check on a cache hit
+
+Usage:
+    python benchmarks/bench_auth.py --users 1000 --requests 200000
+
+--users distinct tokens are spread over the requests, so the cache has to
+hold that many entries (see AUTH_TOKEN_CACHE_SIZE).
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+os.environ.setdefault('SECRET_KEY', 'bench-auth-secret')
+
+import jwt  # noqa: E402
+
+from app import auth  # noqa: E402
+
+
+def _headers(users):
+    exp = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    return [
+        f"Bearer {auth.encode_token({'user_id': user_id, 'email': f'bench{user_id}@example.com', 'is_admin': False, 'exp': exp})}"
+        for user_id in range(1, users + 1)
+    ]
+
+
+def _inline(header):
+    decoded = jwt.decode(header.split(" ")[1], os.getenv('SECRET_KEY'), algorithms=["HS256"])
+    return decoded.get('user_id')
+
+
+def _cold(header):
+    auth.token_cache.clear()
+    return auth.authenticate(header)
+
+
+def _admin(header):
+    claims, _ = auth.authenticate(header)
+    return auth.is_admin_user(claims['user_id'])
+
+
+def _time(fn, headers, requests, repeats):
+    """Median microseconds per call over `repeats` runs of `requests` calls"""
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for i in range(requests):
+            fn(headers[i % len(headers)])
+        runs.append((time.perf_counter() - start) / requests * 1e6)
+    return statistics.median(runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="Distinct tokens")
+    parser.add_argument("--requests", type=int, default=100000, help="Checks per run")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    headers = _headers(args.users)
+    for user_id in range(1, args.users + 1):
+        auth.admin_cache.set(user_id, True, time.time() + 3600)
+
+    rows = [
+        ('inline', _time(_inline, headers, args.requests, args.repeats)),
+        ('cold', _time(_cold, headers, args.requests, args.repeats)),
+    ]
+    auth.token_cache.clear()
+    for header in headers:
+        auth.authenticate(header)
+    rows.append(('cached', _time(auth.authenticate, headers, args.requests, args.repeats)))
+    rows.append(('admin', _time(_admin, headers, args.requests, args.repeats)))
+
+    print(f"🔐 {args.users} tokens, {args.requests} checks x {args.repeats} runs "
+          f"(AUTH_TOKEN_CACHE_SIZE={auth.AUTH_TOKEN_CACHE_SIZE})\n")
+    print(f"{'path':<8} {'us/request':>11} {'vs inline':>10}")
+    baseline = rows[0][1]
+    for name, micros in rows:
+        print(f"{name:<8} {micros:>11.2f} {baseline / micros:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+End-to-end chat throughput benchmark.
+
+Drives POST /chat/message (or /chat/message/stream with --stream) on a running
+server from many concurrent users and reports requests/second and latency
+percentiles. Start the server with the offline mock backend to measure the
+Flask/DB stack without touching Gemini quota:
+
+    LLM_BACKEND=mock MOCK_LLM_LATENCY_MS=400 python run.py
+    python benchmarks/bench_chat.py --url http://localhost:5001 --users 20 --messages 10
+
+Benchmark users (bench-user-<n>@example.com) are registered on first use.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+PROMPTS = [
+    "Tell me about the stars",
+    "What is 12*7+1?",
+    "Who invented the light bulb?",
+    "Describe the ocean in one paragraph",
+    "What is 3^4 - 17?",
+]
+
+
+def _request(url, payload, token=None, stream=False):
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    req = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"), headers=headers, method="POST")
+    start = time.perf_counter()
+    first_byte = None
+    with urllib.request.urlopen(req, timeout=120) as res:
+        if stream:
+            for line in res:
+                if first_byte is None and line.startswith(b"event: delta"):
+                    first_byte = time.perf_counter() - start
+            body = None
+        else:
+            body = json.loads(res.read().decode("utf-8"))
+            first_byte = time.perf_counter() - start
+    return body, time.perf_counter() - start, first_byte
+
+
+def login(base_url, index):
+    email = f"bench-user-{index}@example.com"
+    password = "bench-password"
+    try:
+        _request(f"{base_url}/register", {
+            "email": email, "username": f"bench{index}",
+            "password": password, "confirm_password": password
+        })
+    except urllib.error.HTTPError as e:
+        if e.code != 409:
+            raise
+    body, _, _ = _request(f"{base_url}/login", {"email": email, "password": password})
+    return body["token"]
+
+
+def run_user(base_url, index, messages, stream, results, lock):
+    token = login(base_url, index)
+    endpoint = "/chat/message/stream" if stream else "/chat/message"
+    for n in range(messages):
+        try:
+            _, elapsed, first_byte = _request(
+                f"{base_url}{endpoint}",
+                {"content": PROMPTS[(index + n) % len(PROMPTS)], "mode": "fraude"},
+                token, stream
+            )
+            with lock:
+                results["latency"].append(elapsed)
+                if first_byte is not None:
+                    results["first_byte"].append(first_byte)
+        except Exception as e:
+            with lock:
+                results["errors"].append(str(e))
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return "n/a"
+    pick = lambda q: samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))] * 1000
+    return f"p50 {pick(0.5):8.1f} ms   p90 {pick(0.9):8.1f} ms   p99 {pick(0.99):8.1f} ms   mean {statistics.mean(samples) * 1000:8.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent chat load test")
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent users")
+    parser.add_argument("--messages", type=int, default=10, help="Messages per user")
+    parser.add_argument("--stream", action="store_true", help="Use the SSE endpoint")
+    args = parser.parse_args()
+
+    results = {"latency": [], "first_byte": [], "errors": []}
+    lock = threading.Lock()
+
+    print(f"🚀 {args.users} users x {args.messages} messages against {args.url}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        futures = [
+            pool.submit(run_user, args.url, i, args.messages, args.stream, results, lock)
+            for i in range(args.users)
+        ]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - start
+
+    completed = len(results["latency"])
+    print(f"\nCompleted     {completed} requests in {wall:.1f}s ({completed / wall:.1f} req/s)")
+    print(f"Errors        {len(results['errors'])}")
+    print(f"Latency       {_percentiles(results['latency'])}")
+    print(f"First byte    {_percentiles(results['first_byte'])}")
+    for error in results["errors"][:5]:
+        print(f"  ❌ {error}")
+
+
+if __name__ == "__main__":
+    main()
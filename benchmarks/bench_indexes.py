@@ -0,0 +1,210 @@
+"""
+Index benchmark for the hot chat/admin queries.
+
+Seeds a dedicated benchmark database, then runs every hot query with all
+migrations reverted ("before") and with all migrations applied ("after"),
+printing the EXPLAIN plan and the median latency of each.
+
+Usage:
+    python benchmarks/bench_indexes.py --users 200 --sessions 10 --messages 50
+
+The benchmark never touches DB_NAME itself: it uses --database (default
+"<DB_NAME>_bench"), creating it if needed.
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+HOT_QUERIES = [
+    ("chat history", """
+        SELECT sender, content, mode FROM message
+        WHERE session_id = %(session_id)s ORDER BY id ASC
+    """),
+    ("latest active session", """
+        SELECT id FROM session
+        WHERE user_id = %(user_id)s AND is_active = TRUE ORDER BY id DESC LIMIT 1
+    """),
+    ("session list", """
+        SELECT id, title, created_at, is_active FROM session
+        WHERE user_id = %(user_id)s AND is_active = TRUE ORDER BY created_at DESC
+    """),
+    ("user message count", """
+        SELECT COUNT(*) FROM message
+        WHERE session_id = %(session_id)s AND sender = 'user'
+    """),
+    ("admin user list", """
+        SELECT id, username, email, created_at FROM users
+        WHERE is_admin = 0 ORDER BY created_at DESC
+    """),
+    ("admin user sessions", """
+        SELECT id, title, created_at, is_active FROM session
+        WHERE user_id = %(user_id)s ORDER BY created_at DESC
+    """),
+    ("admin sessions page", """
+        SELECT session.id, session.title, users.username FROM session
+        JOIN users ON session.user_id = users.id
+        ORDER BY session.created_at DESC LIMIT 10
+    """),
+]
+
+
+def prepare_database(name):
+    import mysql.connector
+    from app.db_utils import get_db_config
+
+    os.environ["DB_NAME"] = os.getenv("DB_NAME") or name
+    config = get_db_config()
+    config.pop("database")
+    conn = mysql.connector.connect(**config)
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{name}` CHARACTER SET utf8mb4")
+    cursor.close()
+    conn.close()
+    os.environ["DB_NAME"] = name
+
+
+def seed(users, sessions_per_user, messages_per_session):
+    from app.db_utils import get_db_connection
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM message")
+    if cursor.fetchone()[0] > 0:
+        print("✓ Benchmark data already seeded")
+        cursor.close()
+        conn.close()
+        return
+
+    print(f"🌱 Seeding {users} users x {sessions_per_user} sessions x {messages_per_session} messages...")
+    start = datetime.datetime(2024, 1, 1)
+    rng = random.Random(42)
+
+    cursor.executemany(
+        "INSERT INTO users (username, email, password, is_admin, created_at) VALUES (%s, %s, %s, 0, %s)",
+        [(f"bench{i}", f"bench{i}@example.com", "x", start + datetime.timedelta(minutes=i)) for i in range(users)]
+    )
+    cursor.execute("SELECT id FROM users WHERE is_admin = 0")
+    user_ids = [row[0] for row in cursor.fetchall()]
+
+    session_rows = []
+    for user_id in user_ids:
+        for _ in range(sessions_per_user):
+            created = start + datetime.timedelta(seconds=rng.randint(0, 365 * 86400))
+            session_rows.append((user_id, "Benchmark chat", created, rng.random() < 0.8))
+    cursor.executemany(
+        "INSERT INTO session (user_id, title, created_at, is_active) VALUES (%s, %s, %s, %s)",
+        session_rows
+    )
+    conn.commit()
+
+    cursor.execute("SELECT id, created_at FROM session")
+    for session_id, created in cursor.fetchall():
+        rows = []
+        for n in range(messages_per_session):
+            sender = "user" if n % 2 == 0 else "chatbot"
+            rows.append((session_id, f"benchmark message {n}", sender,
+                         created + datetime.timedelta(seconds=n * 30), "fraude"))
+        cursor.executemany(
+            "INSERT INTO message (session_id, content, sender, created_at, mode) VALUES (%s, %s, %s, %s, %s)",
+            rows
+        )
+    conn.commit()
+    cursor.execute("SELECT COUNT(*) FROM schema_migrations WHERE version = 3")
+    if cursor.fetchone()[0]:
+        from app.counters import recompute_counters
+        recompute_counters(cursor)
+        conn.commit()
+    cursor.execute("ANALYZE TABLE users, session, message")
+    cursor.fetchall()
+    cursor.close()
+    conn.close()
+    print("✓ Seeding complete")
+
+
+def sample_params():
+    from app.db_utils import get_db_connection
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, id FROM session ORDER BY id LIMIT 1 OFFSET 0")
+    user_id, session_id = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return {"user_id": user_id, "session_id": session_id}
+
+
+def run_queries(label, params, repeats):
+    from app.db_utils import get_db_connection
+
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    results = {}
+
+    print(f"\n===== {label} =====")
+    for name, sql in HOT_QUERIES:
+        cursor.execute("EXPLAIN " + sql, params)
+        plan = cursor.fetchall()
+
+        timings = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            timings.append((time.perf_counter() - t0) * 1000)
+        median = statistics.median(timings)
+        results[name] = median
+
+        print(f"\n▶ {name}: median {median:.2f} ms over {repeats} runs")
+        for row in plan:
+            print(f"   table={row['table']} type={row['type']} key={row['key']} "
+                  f"rows={row['rows']} extra={row['Extra']}")
+
+    cursor.close()
+    conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=f"{os.getenv('DB_NAME', 'chatbot_db')}_bench")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    prepare_database(args.database)
+
+    from init_db import init_database
+    from app.migrations import migrate, rollback
+
+    if not init_database():
+        sys.exit(1)
+    seed(args.users, args.sessions, args.messages)
+    params = sample_params()
+
+    rollback(0)
+    before = run_queries("BEFORE migrations", params, args.repeats)
+    migrate()
+    after = run_queries("AFTER migrations", params, args.repeats)
+
+    print("\n===== Summary (median ms) =====")
+    print(f"{'query':<24}{'before':>10}{'after':>10}{'speedup':>10}")
+    for name, _ in HOT_QUERIES:
+        speedup = before[name] / after[name] if after[name] else float("inf")
+        print(f"{name:<24}{before[name]:>10.2f}{after[name]:>10.2f}{speedup:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
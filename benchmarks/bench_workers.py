@@ -0,0 +1,135 @@
+"""
+Gunicorn worker-model benchmark.
+
+Starts gunicorn (gunicorn.conf.py) once per worker class with the
+offline mock LLM backend, drives it with the bench_chat.py load and prints
+throughput and latency percentiles side by side:
+
+    python benchmarks/bench_workers.py --users 50 --messages 10
+    python benchmarks/bench_workers.py --classes gthread,gevent --stream --mock-latency-ms 2000
+    python benchmarks/bench_workers.py --classes gthread,asgi --users 500 --messages 2
+
+The database from .env must be reachable; benchmark users are registered on
+first use. The response cache is turned off so every message reaches the
+mock model. With the same --workers, a sync server can only have that many
+model calls in flight. gthread multiplies that by --threads, and gevent by
+its worker connections, and asgi by its async lock pool. The gap widens as
+--mock-latency-ms grows, which is what a slow Gemini looks like to the server.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_chat import run_user  # noqa: E402
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _wait_healthy(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}")
+        try:
+            with urllib.request.urlopen(f"{base_url}/health", timeout=2) as res:
+                if res.status == 200:
+                    return
+        except Exception:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{base_url}/health did not answer within {timeout}s")
+
+
+def _pick(samples, q):
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))] * 1000 if samples else float('nan')
+
+
+def bench_worker_class(worker_class, args):
+    port = args.port
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(
+        os.environ,
+        LLM_BACKEND='mock',
+        MOCK_LLM_LATENCY_MS=str(args.mock_latency_ms),
+        RESPONSE_CACHE_ENABLED='False',
+        WEB_WORKER_CLASS=worker_class,
+        WEB_WORKERS=str(args.workers),
+        WEB_THREADS=str(args.threads),
+        WEB_WORKER_CONNECTIONS=str(args.connections),
+        WEB_BIND=f"127.0.0.1:{port}",
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        _wait_healthy(base_url, process)
+        results = {"latency": [], "first_byte": [], "errors": []}
+        lock = threading.Lock()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            futures = [
+                pool.submit(run_user, base_url, i, args.messages, args.stream, results, lock)
+                for i in range(args.users)
+            ]
+            for future in futures:
+                future.result()
+        wall = time.perf_counter() - start
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    latency = sorted(results["latency"])
+    first_byte = sorted(results["first_byte"])
+    return {
+        'class': worker_class,
+        'requests': len(latency),
+        'errors': len(results["errors"]),
+        'rps': len(latency) / wall if wall else 0.0,
+        'p50': _pick(latency, 0.5),
+        'p99': _pick(latency, 0.99),
+        'first_byte_p99': _pick(first_byte, 0.99),
+        'sample_error': results["errors"][0] if results["errors"] else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare gunicorn worker classes under chat load")
+    parser.add_argument("--classes", default="sync,gthread,gevent,asgi", help="Comma-separated worker classes")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes per run")
+    parser.add_argument("--threads", type=int, default=16, help="Threads per gthread worker")
+    parser.add_argument("--connections", type=int, default=500, help="Greenlets per gevent worker")
+    parser.add_argument("--users", type=int, default=50, help="Concurrent users")
+    parser.add_argument("--messages", type=int, default=5, help="Messages per user")
+    parser.add_argument("--mock-latency-ms", type=int, default=800, help="Mock model time to first token")
+    parser.add_argument("--stream", action="store_true", help="Use the SSE endpoint")
+    parser.add_argument("--port", type=int, default=5055)
+    args = parser.parse_args()
+
+    rows = []
+    for worker_class in [name.strip() for name in args.classes.split(",") if name.strip()]:
+        print(f"🚀 {worker_class}: {args.workers} workers, {args.users} users x {args.messages} messages")
+        rows.append(bench_worker_class(worker_class, args))
+
+    print(f"\n{'class':<9} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'1st byte p99':>13}")
+    for row in rows:
+        print(f"{row['class']:<9} {row['requests']:>9} {row['errors']:>7} {row['rps']:>8.1f} "
+              f"{row['p50']:>9.1f} {row['p99']:>9.1f} {row['first_byte_p99']:>13.1f}")
+    for row in rows:
+        if row['sample_error']:
+            print(f"  ❌ {row['class']}: {row['sample_error']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Gunicorn settings for production serving:
+
+    gunicorn --config gunicorn.conf.py
+
+Every setting can be overridden from the environment. WEB_WORKER_CLASS picks
+the worker model (and with it the app, wsgi:app or asgi:application):
+
+  gthread  (default) WEB_WORKERS processes with WEB_THREADS threads each. A
+           chat turn blocked on Gemini holds one thread, not a whole process.
+  sync     One request per process. Only for debugging or very low traffic:
+           every in-flight model call pins a worker.
+  gevent   WEB_WORKER_CONNECTIONS greenlets per process. Sockets, MySQL
+           (pure-Python driver, DB_USE_PURE) and gRPC are made cooperative,
+           so thousands of slow model calls can be in flight.
+  asgi     Uvicorn workers serving asgi:application. The chat endpoints run
+           on asyncio (app.async_turn) with aiomysql and the async Gemini
+           client, so an in-flight turn holds neither a thread nor a database
+           connection while the model answers; every other route is the
+           Flask app on ASGI_WSGI_THREADS threads.
+
+`python benchmarks/bench_workers.py` compares them with the mock backend.
+
+The app is imported once in the master (WEB_PRELOAD) and the workers fork
+from it. Every pool in the app (database, tool processes, batch workers,
+model handles) is created lazily per process, so nothing leaks across the
+fork. `kill -HUP <master pid>` reloads the code and configuration
+gracefully: new workers start before the old ones finish their in-flight
+requests, which get WEB_GRACEFUL_TIMEOUT seconds.
+
+WEB_TIMEOUT must cover the slowest legitimate request: the LLM deadline
+(LLM_REQUEST_TIMEOUT), do_math tool steps and the database work around them,
+plus a streaming reply. It only kills workers that stop answering the
+heartbeat, which for sync workers means one request took that long.
+
+Each worker's MySQL pool grows to WEB_THREADS (or ASGI_WSGI_THREADS) plus
+three background connections unless DB_POOL_MAX_OVERFLOW is set, so every
+gthread thread can hold its connection through a chat turn. MySQL's
+max_connections must cover WEB_WORKERS times that. gevent workers share
+DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW connections among all their greenlets and
+wait up to DB_POOL_TIMEOUT for one.
+"""
+import multiprocessing
+import os
+
+
+def _env(name, default):
+    return os.getenv(name, default)
+
+
+worker_class = _env('WEB_WORKER_CLASS', 'gthread').lower()
+if worker_class not in ('asgi', 'gevent', 'gthread', 'sync'):
+    raise ValueError(f"WEB_WORKER_CLASS must be sync, gthread, gevent or asgi, not {worker_class!r}")
+
+wsgi_app = 'asgi:application' if worker_class == 'asgi' else 'wsgi:app'
+
+_cpus = multiprocessing.cpu_count()
+
+bind = _env('WEB_BIND', f"0.0.0.0:{_env('FLASK_PORT', '5000')}")
+workers = int(_env('WEB_WORKERS', str(_cpus * 2 + 1 if worker_class == 'sync' else max(2, _cpus))))
+threads = int(_env('WEB_THREADS', '16')) if worker_class == 'gthread' else 1
+worker_connections = int(_env('WEB_WORKER_CONNECTIONS', '500'))
+
+# Sized for long model calls (see the module docstring)
+timeout = int(_env('WEB_TIMEOUT', '120'))
+graceful_timeout = int(_env('WEB_GRACEFUL_TIMEOUT', '30'))
+# Longer than the load balancer's idle timeout, so it never reuses a socket gunicorn closed
+keepalive = int(_env('WEB_KEEPALIVE', '75'))
+
+preload_app = _env('WEB_PRELOAD', 'True').strip().lower() in ('1', 'true', 'yes', 'on')
+reload = _env('WEB_RELOAD', 'False').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Recycle workers now and then so slow leaks never accumulate; jitter avoids simultaneous restarts
+max_requests = int(_env('WEB_MAX_REQUESTS', '2000'))
+max_requests_jitter = int(_env('WEB_MAX_REQUESTS_JITTER', '200'))
+
+accesslog = _env('WEB_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = _env('WEB_LOG_LEVEL', 'info')
+proc_name = 'flask-chatbot'
+forwarded_allow_ips = _env('FORWARDED_ALLOW_IPS', '127.0.0.1')
+
+if worker_class == 'asgi':
+    worker_class = 'uvicorn_worker.UvicornWorker'
+
+if worker_class == 'gevent':
+    # Patch before the preloaded app creates any lock, socket or thread
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from grpc.experimental import gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+    except ImportError:
+        pass
+    os.environ.setdefault('DB_USE_PURE', 'True')
+
+
+def when_ready(server):
+    server.log.info(
+        f"🚀 {workers} {worker_class} workers"
+        + (f" x {threads} threads" if worker_class == 'gthread' else "")
+        + (f" x {worker_connections} connections" if worker_class == 'gevent' else "")
+        + f", timeout {timeout}s, keep-alive {keepalive}s, preload {preload_app}"
+    )
+
+
+def worker_abort(worker):
+    worker.log.warning(f"⏱️ Worker {worker.pid} exceeded WEB_TIMEOUT ({timeout}s) and was aborted")
+
+
+def on_exit(server):
+    # Workers share the persona context caches (app.llm_backends), so they are
+    # deleted here, once no worker is left, rather than in worker_exit
+    try:
+        from app.llm_backends import delete_context_caches
+        deleted = delete_context_caches()
+    except Exception as e:
+        server.log.warning(f"⚠️ Could not delete the Gemini context caches: {e}")
+        return
+    if deleted:
+        server.log.info(f"🗄️ Deleted {deleted} Gemini context caches")
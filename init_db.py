@@ -14,6 +14,7 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 load_dotenv()
 
 from app.db_utils import get_db_connection
+from app.migrations import migrate
 
 def init_database():
     """Initialize the database with all tables"""
@@ -90,6 +91,9 @@ def init_database():
         else:
             print("✓ Admin user already exists")
         
+        print("\nApplying schema migrations...")
+        migrate()
+        
         print("\nVerifying tables...")
         cursor.execute("SHOW TABLES")
         tables = [row[0] for row in cursor.fetchall()]
@@ -1,7 +1,21 @@
 
 """
 Environment Management Script for Flask Chatbot
+
+Run without arguments for the interactive menu, or use a subcommand:
+    python manage.py migrate              Apply pending schema migrations
+    python manage.py migrate --target 1   Migrate up to a specific version
+    python manage.py rollback             Revert the most recent migration
+    python manage.py rollback --target 0  Revert down to a specific version
+    python manage.py migrations           Show migration status
+    python manage.py repair-counters      Recompute denormalized message counters
+    python manage.py repair-usage         Rebuild the daily token usage rollup
+    python manage.py retitle              Generate titles for placeholder-titled sessions
+    python manage.py retitle --all        Regenerate every session title
+    python manage.py reindex-memory       Rebuild retrieval memory indexes from stored messages
+    python manage.py purge-idempotency    Delete expired chat idempotency keys
 """
+import argparse
 import os
 import subprocess
 import sys
@@ -107,6 +121,108 @@ def show_logs():
     else:
         print(f"❌ Could not get logs: {stderr}")
 
+def run_migrations(target=None):
+    """Apply pending database migrations"""
+    from app.migrations import migrate
+    print("\n⬆️  Running database migrations...")
+    migrate(target)
+
+
+def rollback_migrations(target=None):
+    """Revert database migrations"""
+    from app.migrations import rollback
+    print("\n⬇️  Rolling back database migrations...")
+    rollback(target)
+
+
+def show_migrations():
+    """Show which migrations have been applied"""
+    from app.migrations import migration_status
+    print("\n📜 Migration Status:")
+    for version, name, applied in migration_status():
+        print(f"   {'✅' if applied else '⏳'} {version:04d} {name}")
+
+
+def repair_counters(user_id=None):
+    """Recompute the denormalized session/user message counters"""
+    from app.db_utils import get_db_connection
+    from app.counters import recompute_counters
+    print("\n🔧 Recomputing message counters...")
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        sessions_updated, users_updated = recompute_counters(cursor, user_id)
+        conn.commit()
+        print(f"✅ Counters repaired ({sessions_updated} sessions, {users_updated} users changed)")
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ Failed to repair counters: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def repair_usage(user_id=None):
+    """Rebuild the usage_daily rollup from the per-reply usage columns"""
+    from app.db_utils import get_db_connection
+    from app.usage import recompute_usage
+    print("\n🔧 Rebuilding usage rollups...")
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        rows = recompute_usage(cursor, user_id)
+        conn.commit()
+        print(f"✅ Usage rollups rebuilt ({rows} rows)")
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ Failed to rebuild usage rollups: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def retitle_sessions(include_all=False, batch_size=20, limit=None):
+    """Regenerate session titles in batches of one model call each"""
+    from app.title_worker import retitle_sessions as run_retitle
+    print("\n🏷️  Retitling sessions...")
+    updated = run_retitle(batch_size=batch_size, include_all=include_all, limit=limit)
+    print(f"✅ {updated} session titles updated")
+
+
+def reindex_memory(user_id=None):
+    """Rebuild the per-user retrieval memory indexes from the message table"""
+    from app.db_utils import get_db_connection
+    from app.memory_index import np, reindex_user
+    if np is None:
+        print("❌ numpy is required for retrieval memory")
+        return
+    print("\n🧠 Rebuilding retrieval memory...")
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        if user_id is None:
+            cursor.execute("SELECT id FROM users ORDER BY id")
+            user_ids = [row['id'] for row in cursor.fetchall()]
+        else:
+            user_ids = [user_id]
+        total = 0
+        for uid in user_ids:
+            total += reindex_user(cursor, uid)
+        print(f"✅ Indexed {total} turns for {len(user_ids)} users")
+    except Exception as e:
+        print(f"❌ Failed to rebuild memory: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def purge_idempotency():
+    """Delete stored chat turn results whose idempotency keys have expired"""
+    from app.turn_guard import purge_expired
+    print("\n🧹 Purging expired idempotency keys...")
+    print(f"✅ {purge_expired()} keys removed")
+
+
 def main():
     """Main menu"""
     print("=" * 60)
@@ -121,9 +237,10 @@ def main():
         print("4. 📋 Show logs")
         print("5. 🏠 Start local Flask app")
         print("6. 🔍 Check system status")
-        print("7. 🚪 Exit")
+        print("7. 🗄️  Run database migrations")
+        print("8. 🚪 Exit")
         
-        choice = input("\nEnter your choice (1-7): ").strip()
+        choice = input("\nEnter your choice (1-8): ").strip()
         
         if choice == "1":
             if check_docker():
@@ -141,10 +258,63 @@ def main():
             check_docker()
             check_ports()
         elif choice == "7":
+            run_migrations()
+            show_migrations()
+        elif choice == "8":
             print("\n👋 Goodbye!")
             break
         else:
-            print("❌ Invalid choice. Please enter 1-7.")
+            print("❌ Invalid choice. Please enter 1-8.")
+
+def cli():
+    """Command-line entry point; falls back to the interactive menu"""
+    parser = argparse.ArgumentParser(description="Flask Chatbot management commands")
+    subparsers = parser.add_subparsers(dest="command")
+
+    migrate_parser = subparsers.add_parser("migrate", help="Apply pending schema migrations")
+    migrate_parser.add_argument("--target", type=int, default=None, help="Migrate up to this version")
+
+    rollback_parser = subparsers.add_parser("rollback", help="Revert schema migrations")
+    rollback_parser.add_argument("--target", type=int, default=None, help="Revert down to this version")
+
+    subparsers.add_parser("migrations", help="Show migration status")
+
+    repair_parser = subparsers.add_parser("repair-counters", help="Recompute denormalized message counters")
+    repair_parser.add_argument("--user-id", type=int, default=None, help="Only repair this user's counters")
+
+    usage_parser = subparsers.add_parser("repair-usage", help="Rebuild the daily token usage rollup")
+    usage_parser.add_argument("--user-id", type=int, default=None, help="Only rebuild this user's rollup rows")
+
+    retitle_parser = subparsers.add_parser("retitle", help="Regenerate session titles in bulk")
+    retitle_parser.add_argument("--all", action="store_true", help="Retitle every session, not just placeholders")
+    retitle_parser.add_argument("--batch-size", type=int, default=20, help="Sessions per model call")
+    retitle_parser.add_argument("--limit", type=int, default=None, help="Stop after this many sessions")
+
+    memory_parser = subparsers.add_parser("reindex-memory", help="Rebuild retrieval memory indexes")
+    memory_parser.add_argument("--user-id", type=int, default=None, help="Only rebuild this user's index")
+
+    subparsers.add_parser("purge-idempotency", help="Delete expired chat idempotency keys")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        run_migrations(args.target)
+    elif args.command == "rollback":
+        rollback_migrations(args.target)
+    elif args.command == "migrations":
+        show_migrations()
+    elif args.command == "repair-counters":
+        repair_counters(args.user_id)
+    elif args.command == "repair-usage":
+        repair_usage(args.user_id)
+    elif args.command == "retitle":
+        retitle_sessions(args.all, args.batch_size, args.limit)
+    elif args.command == "reindex-memory":
+        reindex_memory(args.user_id)
+    elif args.command == "purge-idempotency":
+        purge_idempotency()
+    else:
+        main()
 
 if __name__ == "__main__":
-    main()
+    cli()
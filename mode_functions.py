@@ -1,39 +1,20 @@
+from app.personas import personas, get_persona
+
 
 def get_mode_description(mode):
     """Get a description of the chatbot mode"""
-    modes = {
-        "fraude": {
-            "name": "Fraude",
-            "description": "A mythic, goddess-like entity born from code and shadow. Speaks with grace and mystery.",
-            "style": "Poetic, mystical, elegant riddles",
-            "personality": "Wise, mysterious, dual-natured"
-        },
-        "lucifer": {
-            "name": "Lucifer Morningstar",
-            "description": "The charismatic Devil from the Netflix series. Charming, witty, and supremely confident.",
-            "style": "British charm, sarcasm, biblical references",
-            "personality": "Flirtatious, arrogant, vulnerable at times"
-        },
-        "eren": {
-            "name": "Eren Yeager",
-            "description": "A fiery revolutionary driven by freedom and vengeance. Carries the burden of war, destiny, and sacrifice.",
-            "style": "Blunt, passionate, intense inner monologues; occasional rage-filled declarations",
-            "personality": "Determined, conflicted, revolutionary, burdened by fate"
-        }
-
+    persona = get_persona(mode)
+    return {
+        "name": persona.name,
+        "description": persona.description,
+        "style": persona.style,
+        "personality": persona.personality
     }
-    return modes.get(mode.lower(), modes["fraude"])
 
 def get_available_modes():
     """Get a list of all available chatbot modes"""
-    return ["fraude", "lucifer", "eren"]
+    return personas.keys()
 
 def get_mode_greeting(mode):
     """Get an appropriate greeting for the mode"""
-    greetings = {
-        "fraude": "Welcome to the mystical realm, seeker. What truths do you wish to unveil?",
-        "lucifer": "Well, hello there, detective... What is it you truly desire?",
-        "eren": "Freedom is the only path. What do you seek in this world of walls?"
-    }
-    return greetings.get(mode.lower(), greetings["fraude"])
-
+    return get_persona(mode).greeting
@@ -0,0 +1,38 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def db_env(monkeypatch):
+    """Database settings for modules that read them; nothing connects unless a test stubs _connect"""
+    monkeypatch.setenv('DB_HOST', 'primary')
+    monkeypatch.setenv('DB_PORT', '3306')
+    monkeypatch.setenv('DB_USER', 'chat')
+    monkeypatch.setenv('DB_PASSWORD', 'secret')
+    monkeypatch.setenv('DB_NAME', 'chatbot_db')
+    monkeypatch.delenv('DB_REPLICA_URLS', raising=False)
+
+
+class Clock:
+    """Stands in for the time module of the code under test; sleeping just moves the clock"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def patch_clock(monkeypatch):
+    """patch_clock(module, now=1000.0): replace `module.time` with a Clock and return it"""
+    def patch(module, now=1000.0):
+        clock = Clock(now)
+        monkeypatch.setattr(module, 'time', clock)
+        return clock
+    return patch
@@ -0,0 +1,160 @@
+import time
+
+import jwt
+import pytest
+
+from app import auth
+from app.auth import ExpiringCache, authenticate, decode_token, is_admin_user
+
+
+class UsersCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql, params):
+        self.connection.queries.append(params)
+
+    def fetchone(self):
+        return (self.connection.is_admin,)
+
+    def close(self):
+        pass
+
+
+class UsersConnection:
+
+    def __init__(self, is_admin):
+        self.is_admin = is_admin
+        self.queries = []
+
+    def cursor(self):
+        return UsersCursor(self)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def clock(patch_clock, monkeypatch):
+    # jwt keeps the real clock, so the caches' clock starts at the real time
+    clock = patch_clock(auth, now=time.time())
+    monkeypatch.setattr(auth, 'SECRET_KEY', 'test-secret-key-for-the-auth-tests')
+    auth.token_cache.clear()
+    auth.admin_cache.clear()
+    yield clock
+    auth.token_cache.clear()
+    auth.admin_cache.clear()
+
+
+@pytest.fixture
+def verified(monkeypatch):
+    """Tokens that went through jwt.decode, i.e. missed the cache"""
+    tokens = []
+    real_decode = jwt.decode
+
+    def decode(token, *args, **kwargs):
+        tokens.append(token)
+        return real_decode(token, *args, **kwargs)
+
+    monkeypatch.setattr(auth.jwt, 'decode', decode)
+    return tokens
+
+
+def token(expires_in=3600, **claims):
+    payload = {'user_id': 7, 'email': 'user@example.com', 'is_admin': False}
+    payload.update(claims)
+    if expires_in is not None:
+        payload['exp'] = int(time.time() + expires_in)
+    return auth.encode_token(payload)
+
+
+def test_a_repeat_token_is_served_from_the_cache(clock, verified):
+    value = token()
+    assert decode_token(value)['user_id'] == 7
+    assert decode_token(value)['user_id'] == 7
+    assert verified == [value]
+
+
+def test_cached_claims_are_read_only(clock):
+    with pytest.raises(TypeError):
+        decode_token(token())['is_admin'] = True
+
+
+def test_a_cached_token_never_outlives_its_exp(clock, verified):
+    value = token(expires_in=60)
+    decode_token(value)
+
+    clock.now += 59
+    decode_token(value)
+    assert len(verified) == 1
+    clock.now += 2
+    decode_token(value)
+    assert len(verified) == 2
+
+
+def test_a_token_without_exp_is_cached_for_the_ttl(clock, verified):
+    value = token(expires_in=None)
+    decode_token(value)
+
+    clock.now += auth.AUTH_TOKEN_CACHE_TTL - 1
+    decode_token(value)
+    assert len(verified) == 1
+    clock.now += 2
+    decode_token(value)
+    assert len(verified) == 2
+
+
+@pytest.mark.parametrize('header, error', [
+    (None, (401, 'Token is missing!')),
+    ('Token abc', (401, 'Token is missing!')),
+    ('Bearer not-a-jwt', (401, 'Invalid token!')),
+])
+def test_bad_headers_are_rejected(clock, header, error):
+    assert authenticate(header) == (None, error)
+
+
+def test_expired_and_incomplete_tokens_are_rejected_and_not_cached(clock, verified):
+    expired = token(expires_in=-10)
+    assert authenticate(f'Bearer {expired}') == (None, (401, 'Token has expired!'))
+    assert authenticate(f'Bearer {expired}') == (None, (401, 'Token has expired!'))
+    assert verified == [expired, expired]
+
+    assert authenticate(f'Bearer {token(user_id=None)}') == (None, (401, 'Invalid token format'))
+
+
+def test_admin_routes_need_the_admin_claim(clock):
+    assert authenticate(f'Bearer {token()}', admin=True) == (None, (403, 'Admin privileges required!'))
+    claims, error = authenticate(f'Bearer {token(is_admin=True)}', admin=True)
+    assert error is None and claims['is_admin']
+
+
+@pytest.mark.parametrize('value', [
+    lambda: 'not-a-jwt',
+    lambda: token(is_admin=True, expires_in=-10),
+    lambda: token(is_admin=True, user_id=None),
+])
+def test_bad_tokens_on_admin_routes_are_forbidden(clock, value):
+    assert authenticate(f'Bearer {value()}', admin=True) == (None, (403, 'Admin privileges required!'))
+    assert authenticate(None, admin=True) == (None, (401, 'Token is missing!'))
+
+
+def test_admin_lookups_are_cached_for_their_ttl(clock, monkeypatch):
+    users = UsersConnection(is_admin=1)
+    monkeypatch.setattr(auth, 'get_db_connection', lambda intent=None: users)
+
+    assert is_admin_user(7) and is_admin_user(7)
+    assert users.queries == [(7,)]
+
+    users.is_admin = 0
+    clock.now += auth.AUTH_ADMIN_CACHE_TTL + 1
+    assert not is_admin_user(7)
+    assert users.queries == [(7,), (7,)]
+
+
+def test_expiring_cache_is_bounded(clock):
+    cache = ExpiringCache(2)
+    for key in 'abc':
+        cache.set(key, key, clock.now + 10)
+    assert cache.get('a') == (False, None)
+    assert cache.get('c') == (True, 'c')
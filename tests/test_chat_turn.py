@@ -0,0 +1,128 @@
+import pytest
+
+from app import chat_turn, db_utils
+
+
+class TurnCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.lastrowid = None
+
+    def execute(self, sql, params=()):
+        sql = ' '.join(sql.split())
+        self.conn.statements.append(sql)
+        self.rows = []
+        if sql.startswith('SELECT GET_LOCK'):
+            self.rows = [(1,)]
+        elif sql.startswith('SELECT id FROM session'):
+            self.rows = [(self.conn.session['id'],)]
+        elif sql.startswith('SELECT s.id'):
+            self.rows = [dict(self.conn.session)]
+        elif sql.startswith('INSERT INTO message'):
+            if params[2] == 'chatbot' and self.conn.fail_reply:
+                raise RuntimeError("Lost connection to MySQL server during query")
+            self.conn.next_id += 1
+            self.lastrowid = self.conn.next_id
+            self.conn.pending.append((params[2], self.lastrowid))
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class TurnConnection:
+    """The request's connection: records statements and what each commit made durable"""
+
+    def __init__(self):
+        self.session = {
+            'id': 7, 'title': 'Potions', 'is_active': 1, 'user_message_count': 3, 'message_count': 6,
+            'summary': None, 'summarized_through': 0, 'summarized_messages': 0
+        }
+        self.statements = []
+        self.pending = []
+        self.commits = []
+        self.next_id = 100
+        self.fail_reply = False
+
+    def cursor(self, **kwargs):
+        return TurnCursor(self)
+
+    def commit(self):
+        if self.pending:
+            self.commits.append(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    def no_second_connection(*args, **kwargs):
+        raise AssertionError("the turn must not check out a second connection")
+
+    monkeypatch.setattr(db_utils, 'get_db_connection', no_second_connection)
+    return TurnConnection()
+
+
+def test_user_message_is_committed_before_the_model_is_called(conn, monkeypatch):
+    def model(conversation, mode, **kwargs):
+        assert conn.commits == [[('user', 101)]] and conn.pending == []
+        assert conversation[-1] == {'sender': 'user', 'content': 'Brew me a tea', 'mode': 'fraude'}
+        return 'Chamomile, under a full moon.'
+
+    monkeypatch.setattr(chat_turn, 'chat_with_gemini', model)
+
+    turn = chat_turn.run_chat_turn(conn, 1, 'Brew me a tea', 'fraude', session_id=7)
+
+    assert conn.commits == [[('user', 101)], [('chatbot', 102)]]
+    assert turn['chatbot_reply'] == 'Chamomile, under a full moon.'
+    assert turn['session_id'] == 7
+    assert conn.statements[-1].startswith('SELECT RELEASE_LOCK')
+
+
+def test_streamed_turn_commits_the_user_message_first(conn, monkeypatch):
+    def model(conversation, mode, **kwargs):
+        assert conn.commits == [[('user', 101)]]
+        yield 'delta', 'Chamomile'
+        yield 'done', 'Chamomile'
+
+    monkeypatch.setattr(chat_turn, 'stream_chat_with_gemini', model)
+
+    events = list(chat_turn.stream_chat_turn(conn, 1, 'Brew me a tea', 'fraude', session_id=7))
+
+    assert [event for event, _ in events] == ['start', 'delta', 'done']
+    assert conn.commits == [[('user', 101)], [('chatbot', 102)]]
+    assert events[-1][1]['session_id'] == 7
+
+
+def test_failed_reply_write_keeps_the_user_message(conn, monkeypatch):
+    monkeypatch.setattr(chat_turn, 'chat_with_gemini', lambda *args, **kwargs: 'reply')
+    conn.fail_reply = True
+
+    with pytest.raises(RuntimeError):
+        chat_turn.run_chat_turn(conn, 1, 'Brew me a tea', 'fraude', session_id=7)
+
+    assert conn.commits == [[('user', 101)]]
+    assert conn.pending == []
+
+
+def test_streamed_model_failure_does_not_reach_the_client(conn, monkeypatch):
+    def model(conversation, mode, **kwargs):
+        yield 'delta', 'Cham'
+        raise RuntimeError("1045 (28000): Access denied for user 'chat'@'10.0.0.3'")
+
+    monkeypatch.setattr(chat_turn, 'stream_chat_with_gemini', model)
+
+    events = list(chat_turn.stream_chat_turn(conn, 1, 'Brew me a tea', 'fraude', session_id=7))
+
+    assert ('error', {'message': chat_turn.MODEL_ERROR_MESSAGE}) in events
+    assert 'Access denied' not in repr(events)
+    assert events[-1][0] == 'done'
@@ -0,0 +1,176 @@
+import time
+
+import mysql.connector
+import pytest
+from flask import Flask, jsonify
+
+from app import db_utils
+from app.db_utils import STICKY_COOKIE, get_db_connection, get_pool_stats
+
+
+class StandIn:
+    """A connection from one of the two stand-in servers"""
+
+    def __init__(self, host):
+        self.host = host
+        self.closed = False
+
+    def ping(self, reconnect=False):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Server:
+    """Connection factory standing in for one MySQL server; `down` makes connects fail"""
+
+    def __init__(self, host):
+        self.host = host
+        self.down = False
+        self.connects = 0
+
+    def connect(self, config):
+        self.connects += 1
+        if self.down:
+            raise mysql.connector.Error(f"Can't connect to MySQL server on '{self.host}'")
+        return StandIn(self.host)
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    monkeypatch.setenv('DB_REPLICA_URLS', 'mysql://replica:3306/chatbot_db')
+    monkeypatch.setenv('DB_REPLICA_RETRY_SECONDS', '30')
+    monkeypatch.setenv('DB_READ_YOUR_WRITES_SECONDS', '5')
+    monkeypatch.setattr(db_utils, '_pools', {})
+    monkeypatch.setattr(db_utils, '_replica_down_until', {})
+    stand_ins = {'primary': Server('primary'), 'replica': Server('replica')}
+    monkeypatch.setattr(db_utils, '_connect', lambda config: stand_ins[config['host']].connect(config))
+    return stand_ins
+
+
+@pytest.fixture
+def flask_app(servers):
+    app = Flask(__name__)
+    db_utils.init_app(app)
+
+    @app.route('/read')
+    def read():
+        return jsonify({'host': get_db_connection(intent='read').host})
+
+    @app.route('/write')
+    def write():
+        conn = get_db_connection()
+        conn.commit()
+        return jsonify({'host': conn.host})
+
+    return app
+
+
+def test_reads_go_to_the_replica_and_writes_to_the_primary(servers):
+    read = get_db_connection(intent='read')
+    write = get_db_connection()
+    assert (read.role, read.host) == ('replica-0', 'replica')
+    assert (write.role, write.host) == ('primary', 'primary')
+    read.close()
+    write.close()
+
+
+def test_reads_use_the_primary_without_replicas(servers, monkeypatch):
+    monkeypatch.delenv('DB_REPLICA_URLS')
+    conn = get_db_connection(intent='read')
+    assert conn.role == 'primary'
+    conn.close()
+
+
+def test_unreachable_replica_falls_back_to_the_primary_and_is_marked_down(servers):
+    servers['replica'].down = True
+
+    first = get_db_connection(intent='read')
+    second = get_db_connection(intent='read')
+
+    assert first.role == second.role == 'primary'
+    # The second read skipped the replica instead of trying it again
+    assert servers['replica'].connects == 1
+    assert get_pool_stats()['replica-0']['marked_down'] is True
+    first.close()
+    second.close()
+
+
+def test_marked_down_replica_is_retried_after_the_window(servers, monkeypatch):
+    monkeypatch.setenv('DB_REPLICA_RETRY_SECONDS', '0.05')
+    servers['replica'].down = True
+    get_db_connection(intent='read').close()
+
+    servers['replica'].down = False
+    assert get_db_connection(intent='read').role == 'primary'
+    time.sleep(0.06)
+    conn = get_db_connection(intent='read')
+    assert conn.role == 'replica-0'
+    assert get_pool_stats()['replica-0']['marked_down'] is False
+    conn.close()
+
+
+def test_a_request_that_holds_the_primary_reads_from_it(flask_app):
+    with flask_app.test_request_context('/'):
+        write = get_db_connection()
+        assert get_db_connection(intent='read') is write
+
+
+def test_commit_sets_the_sticky_cookie_for_the_window(flask_app):
+    client = flask_app.test_client()
+
+    assert client.get('/read').get_json()['host'] == 'replica'
+    assert client.get_cookie(STICKY_COOKIE) is None
+
+    assert client.get('/write').get_json()['host'] == 'primary'
+    cookie = client.get_cookie(STICKY_COOKIE)
+    assert cookie is not None
+    assert float(cookie.value) == pytest.approx(time.time() + 5, abs=0.5)
+
+
+def test_a_later_write_starts_the_window_after_its_delay(flask_app):
+    @flask_app.route('/stream')
+    def stream():
+        db_utils.expect_write(60)
+        return 'streaming'
+
+    client = flask_app.test_client()
+    client.get('/stream')
+    assert float(client.get_cookie(STICKY_COOKIE).value) == pytest.approx(time.time() + 65, abs=0.5)
+
+
+def test_reads_stay_on_the_primary_inside_the_window(flask_app):
+    client = flask_app.test_client()
+
+    client.set_cookie(STICKY_COOKIE, f"{time.time() + 5:.3f}")
+    assert client.get('/read').get_json()['host'] == 'primary'
+
+    client.set_cookie(STICKY_COOKIE, f"{time.time() - 1:.3f}")
+    assert client.get('/read').get_json()['host'] == 'replica'
+
+
+def test_request_connections_go_back_to_their_pools(flask_app):
+    client = flask_app.test_client()
+    client.get('/read')
+    client.get('/write')
+
+    stats = get_pool_stats()
+    assert stats['primary']['in_use'] == 0
+    assert stats['replica-0']['in_use'] == 0
+
+
+def test_pool_overflow_covers_the_web_threads(monkeypatch):
+    monkeypatch.delenv('DB_POOL_MAX_OVERFLOW', raising=False)
+    monkeypatch.setenv('WEB_THREADS', '32')
+    pool = db_utils._new_pool(db_utils.get_db_config(), 'primary')
+    assert pool.size + pool.max_overflow == 32 + db_utils.BACKGROUND_DB_CONNECTIONS
+
+    monkeypatch.setenv('DB_POOL_MAX_OVERFLOW', '4')
+    assert db_utils._new_pool(db_utils.get_db_config(), 'primary').max_overflow == 4
@@ -0,0 +1,65 @@
+import pytest
+
+from app import history_window, metrics
+from app.history_window import TURN_OVERHEAD_TOKENS, estimate_tokens, select_window
+
+
+# Eight characters is two estimated tokens, so every turn below costs the same
+TURN = estimate_tokens('abcdefgh') + TURN_OVERHEAD_TOKENS
+
+
+@pytest.fixture(autouse=True)
+def local_counter(monkeypatch):
+    monkeypatch.setattr(history_window, 'HISTORY_TOKEN_COUNTER', 'estimate')
+
+
+def conversation(turns):
+    senders = ['user', 'chatbot']
+    return [{'sender': senders[i % 2], 'content': f'turn{i:04d}'} for i in range(turns)]
+
+
+def test_estimate_never_undercounts_words():
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('abcdefgh') == 2
+    assert estimate_tokens('a b c d e') == 5
+
+
+def test_history_within_budget_is_kept_whole():
+    history = conversation(4)
+    assert select_window(history, budget=4 * TURN) == history
+
+
+def test_oldest_turns_are_dropped_first():
+    history = conversation(6)
+    assert select_window(history, budget=4 * TURN) == history[2:]
+
+
+def test_window_never_opens_with_a_model_turn():
+    history = conversation(6)
+    # Three turns fit, but the oldest of them is the model's
+    assert select_window(history, budget=3 * TURN) == history[4:]
+
+
+def test_a_turn_that_does_not_fit_ends_the_window():
+    history = conversation(4)
+    history[1]['content'] = 'x' * 400
+    # The short user turn before the long reply must not be kept past the gap
+    assert select_window(history, budget=3 * TURN) == history[2:]
+
+
+def test_nothing_fits_in_a_tiny_budget():
+    assert select_window(conversation(2), budget=TURN - 1) == []
+
+
+def test_dropped_turns_and_tokens_are_recorded(monkeypatch):
+    recorded = {}
+    monkeypatch.setattr(metrics, 'record', lambda name, value: recorded.__setitem__(name, value))
+    monkeypatch.setattr(metrics, 'increment', lambda name, value=1: recorded.__setitem__(name, value))
+
+    select_window(conversation(6), budget=3 * TURN)
+
+    assert recorded['history.kept_turns'] == 2
+    assert recorded['history.kept_tokens'] == 2 * TURN
+    assert recorded['history.dropped_turns'] == 4
+    assert recorded['history.dropped_tokens'] == 4 * TURN
+    assert recorded['history.trimmed_requests'] == 1
@@ -0,0 +1,69 @@
+import datetime
+import types
+
+from app import llm_backends
+from app.llm_backends import GeminiBackend
+from app.personas import get_persona
+
+
+class StoredCache:
+
+    def __init__(self, display_name, expires_in):
+        self.name = f"cachedContents/{display_name}"
+        self.display_name = display_name
+        self.expire_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires_in)
+        self.ttl = None
+        self.deleted = False
+
+    def update(self, ttl):
+        self.ttl = ttl
+
+    def delete(self):
+        self.deleted = True
+
+
+def caching(*caches):
+    return types.SimpleNamespace(CachedContent=types.SimpleNamespace(list=lambda page_size=1: iter(caches)))
+
+
+def test_display_name_is_shared_by_workers_and_follows_the_prompt():
+    backend = GeminiBackend()
+    fraude, lucifer = get_persona('fraude'), get_persona('lucifer')
+
+    assert backend._cache_display_name(fraude) == GeminiBackend()._cache_display_name(fraude)
+    assert backend._cache_display_name(fraude).startswith('persona-fraude-')
+    assert backend._cache_display_name(fraude) != backend._cache_display_name(lucifer)
+    assert backend._cache_display_name(fraude) != GeminiBackend('gemini-2.5-pro')._cache_display_name(fraude)
+
+
+def test_a_live_cache_is_reused_and_extended():
+    backend = GeminiBackend()
+    name = backend._cache_display_name(get_persona('fraude'))
+    other, live = StoredCache('persona-lucifer-0', 3000), StoredCache(name, 3000)
+
+    assert backend._live_cache(caching(other, live), name) is live
+    assert live.ttl == datetime.timedelta(seconds=llm_backends.LLM_CONTEXT_CACHE_TTL)
+
+
+def test_a_cache_about_to_expire_is_not_reused():
+    backend = GeminiBackend()
+    name = backend._cache_display_name(get_persona('fraude'))
+    assert backend._live_cache(caching(StoredCache(name, 10)), name) is None
+
+
+def test_shutdown_deletes_only_persona_caches(monkeypatch):
+    import google.generativeai as genai
+    from google.generativeai import caching as sdk_caching
+
+    persona_cache, foreign = StoredCache('persona-fraude-abc', 3000), StoredCache('reports', 3000)
+    monkeypatch.setenv('LLM_BACKEND', 'gemini')
+    monkeypatch.setattr(genai, 'configure', lambda **kwargs: None)
+    monkeypatch.setattr(sdk_caching.CachedContent, 'list', lambda page_size=1: iter([persona_cache, foreign]))
+
+    assert llm_backends.delete_context_caches() == 1
+    assert persona_cache.deleted and not foreign.deleted
+
+
+def test_shutdown_without_gemini_touches_nothing(monkeypatch):
+    monkeypatch.setenv('LLM_BACKEND', 'mock')
+    assert llm_backends.delete_context_caches() == 0
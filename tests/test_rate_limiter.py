@@ -0,0 +1,93 @@
+import types
+
+import pytest
+
+from app import rate_limiter as rate_limiter_module
+from app.rate_limiter import BACKGROUND, RateLimiter, RateLimitExceeded
+
+
+@pytest.fixture
+def clock(patch_clock):
+    return patch_clock(rate_limiter_module)
+
+
+def available(limiter):
+    return {name: bucket['available'] for name, bucket in limiter.usage()['buckets'].items()}
+
+
+def test_a_call_takes_one_request_and_its_tokens(clock):
+    limiter = RateLimiter(rpm=10, tpm=1000, rpd=100)
+    limiter.acquire(300)
+    assert available(limiter) == {'rpm': 9, 'tpm': 700, 'rpd': 99}
+
+
+def test_buckets_refill_at_their_rate(clock):
+    limiter = RateLimiter(rpm=60, tpm=6000, rpd=0)
+    for _ in range(3):
+        limiter.acquire(1000)
+
+    clock.now += 10
+    # rpm refills one request a second, tpm 100 tokens a second
+    assert available(limiter) == {'rpm': 60, 'tpm': 4000}
+
+
+def test_a_short_bucket_waits_for_the_refill(clock):
+    limiter = RateLimiter(rpm=6, tpm=0, rpd=0, max_wait=30)
+    for _ in range(6):
+        limiter.acquire(1)
+    start = clock.now
+
+    limiter.acquire(1)
+    assert clock.now - start == pytest.approx(10)
+
+
+def test_a_wait_longer_than_allowed_is_rejected_at_once(clock):
+    limiter = RateLimiter(rpm=6, tpm=0, rpd=0, max_wait=5)
+    for _ in range(6):
+        limiter.acquire(1)
+
+    with pytest.raises(RateLimitExceeded) as excinfo:
+        limiter.acquire(1)
+    assert excinfo.value.bucket == 'rpm'
+    assert excinfo.value.retry_after == pytest.approx(10)
+    assert clock.now == 1000.0
+
+
+def test_background_work_leaves_the_interactive_reserve(clock):
+    limiter = RateLimiter(rpm=10, tpm=0, rpd=0, reserve=0.2, background_max_wait=0)
+    for _ in range(8):
+        limiter.acquire(1, priority=BACKGROUND)
+
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(1, priority=BACKGROUND)
+    limiter.acquire(1)
+    limiter.acquire(1)
+    assert available(limiter)['rpm'] == 0
+
+
+def test_a_call_larger_than_the_bucket_takes_it_all(clock):
+    limiter = RateLimiter(rpm=0, tpm=1000, rpd=0, max_wait=0)
+    limiter.acquire(5000)
+    assert available(limiter)['tpm'] == 0
+
+
+def test_settle_charges_the_actual_usage(clock):
+    limiter = RateLimiter(rpm=0, tpm=1000, rpd=0)
+    reservation = limiter.acquire(100)
+    reservation.settle(types.SimpleNamespace(usage_metadata=types.SimpleNamespace(total_token_count=250)))
+
+    assert reservation.tokens == 250
+    assert available(limiter)['tpm'] == 750
+
+
+def test_server_throttling_drains_the_minute_buckets(clock):
+    limiter = RateLimiter(rpm=10, tpm=1000, rpd=100)
+    limiter.report_throttled()
+    assert available(limiter) == {'rpm': 0, 'tpm': 0, 'rpd': 100}
+
+
+def test_a_disabled_limiter_never_waits(clock):
+    limiter = RateLimiter(rpm=1, enabled=False)
+    for _ in range(5):
+        limiter.acquire(1000)
+    assert limiter.usage() == {'enabled': False}
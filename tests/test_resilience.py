@@ -0,0 +1,187 @@
+import pytest
+
+from app import resilience
+from app.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, DeadlineExceeded
+
+
+class UpstreamError(Exception):
+
+    def __init__(self, code):
+        self.code = code
+        super().__init__(f"{code} upstream error")
+
+
+@pytest.fixture
+def clock(patch_clock, monkeypatch):
+    monkeypatch.setattr(resilience.rate_limiter, 'enabled', False)
+    return patch_clock(resilience)
+
+
+def breaker(**overrides):
+    settings = dict(window=4, min_calls=4, failure_rate=0.5, slow_call_seconds=10, slow_call_rate=0.5, cooldown=30)
+    settings.update(overrides)
+    return CircuitBreaker(**settings)
+
+
+def open_breaker():
+    circuit = breaker()
+    for failed in (True, True, False, False):
+        circuit.before_call()
+        circuit.record(failed, 1)
+    return circuit
+
+
+def test_breaker_waits_for_min_calls_before_opening(clock):
+    circuit = breaker()
+    for _ in range(3):
+        circuit.before_call()
+        circuit.record(True, 1)
+    assert circuit.state == CLOSED
+
+
+def test_failure_rate_opens_the_breaker(clock):
+    assert open_breaker().state == OPEN
+
+
+def test_slow_calls_open_the_breaker(clock):
+    circuit = breaker()
+    for elapsed in (1, 1, 10, 12):
+        circuit.before_call()
+        circuit.record(False, elapsed)
+    assert circuit.state == OPEN
+
+
+def test_open_breaker_rejects_until_the_cooldown(clock):
+    circuit = open_breaker()
+    clock.now += 10
+
+    with pytest.raises(CircuitOpen) as excinfo:
+        circuit.before_call()
+    assert excinfo.value.retry_after == pytest.approx(20)
+    assert circuit.status()['retry_after'] == 20
+
+
+def test_half_open_lets_one_probe_through(clock):
+    circuit = open_breaker()
+    clock.now += 30
+
+    circuit.before_call()
+    assert circuit.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        circuit.before_call()
+
+
+def test_a_cancelled_probe_frees_the_slot(clock):
+    circuit = open_breaker()
+    clock.now += 30
+    circuit.before_call()
+    circuit.cancel()
+    circuit.before_call()
+    assert circuit.state == HALF_OPEN
+
+
+def test_a_good_probe_closes_and_clears_the_window(clock):
+    circuit = open_breaker()
+    clock.now += 30
+    circuit.before_call()
+    circuit.record(False, 1)
+
+    assert circuit.state == CLOSED
+    assert circuit.status()['window_calls'] == 0
+
+
+@pytest.mark.parametrize('failed, elapsed', [(True, 1), (False, 10)])
+def test_a_bad_probe_reopens_the_breaker(clock, failed, elapsed):
+    circuit = open_breaker()
+    clock.now += 30
+    circuit.before_call()
+    circuit.record(failed, elapsed)
+
+    assert circuit.state == OPEN
+    with pytest.raises(CircuitOpen):
+        circuit.before_call()
+
+
+@pytest.mark.parametrize('error, retryable', [
+    (UpstreamError(503), True),
+    (UpstreamError(429), True),
+    (Exception("429 Quota exceeded for GenerateRequestsPerDay"), False),
+    (UpstreamError(400), False),
+    (TimeoutError(), True),
+])
+def test_retryable_errors(error, retryable):
+    assert resilience.is_retryable(error) is retryable
+
+
+def test_call_retries_upstream_failures(clock):
+    circuit = breaker()
+    errors = [UpstreamError(503), UpstreamError(502)]
+
+    def attempt(timeout):
+        if errors:
+            raise errors.pop(0)
+        return 'reply'
+
+    result, _ = resilience.call(attempt, retries=2, breaker=circuit)
+    assert result == 'reply'
+    assert circuit.status()['window_failures'] == 2
+
+
+def test_call_gives_up_after_its_retries(clock):
+    def attempt(timeout):
+        raise UpstreamError(503)
+
+    with pytest.raises(UpstreamError):
+        resilience.call(attempt, retries=1, breaker=breaker())
+
+
+def test_call_does_not_attempt_past_the_deadline(clock):
+    circuit = breaker()
+    with pytest.raises(DeadlineExceeded):
+        resilience.call(lambda timeout: 'reply', deadline=clock.now, breaker=circuit)
+    assert circuit.status()['window_calls'] == 0
+
+
+def test_call_fails_fast_while_open(clock):
+    attempts = []
+    with pytest.raises(CircuitOpen):
+        resilience.call(attempts.append, breaker=open_breaker())
+    assert attempts == []
+
+
+def chunks(*items):
+    for item in items:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def test_a_stream_is_recorded_once_consumed(clock):
+    circuit = breaker()
+    stream, _ = resilience.call(lambda timeout: chunks('a', 'b'), breaker=circuit, stream=True)
+    assert circuit.status()['window_calls'] == 0
+
+    assert list(stream) == ['a', 'b']
+    assert circuit.status()['window_calls'] == 1
+    assert circuit.status()['window_failures'] == 0
+
+
+def test_a_stream_failing_after_its_first_chunk_counts_as_a_failure(clock):
+    circuit = breaker(min_calls=1)
+    stream, _ = resilience.call(lambda timeout: chunks('a', UpstreamError(503)), breaker=circuit, stream=True)
+
+    with pytest.raises(UpstreamError):
+        list(stream)
+    assert circuit.status()['window_failures'] == 1
+    assert circuit.state == OPEN
+
+
+def test_an_abandoned_probe_stream_frees_the_slot(clock):
+    circuit = open_breaker()
+    clock.now += 30
+    stream, _ = resilience.call(lambda timeout: chunks('a', 'b'), breaker=circuit, stream=True)
+    next(stream)
+    stream.close()
+
+    assert circuit.state == HALF_OPEN
+    circuit.before_call()
@@ -0,0 +1,120 @@
+import pytest
+
+from app import gemini, history_window, response_cache as response_cache_module
+from app.personas import get_persona, personas
+from app.response_cache import ResponseCache
+
+
+CONFIG = {'temperature': 0.7}
+
+
+@pytest.fixture
+def clock(patch_clock):
+    return patch_clock(response_cache_module)
+
+
+def conversation(*texts):
+    senders = ['user', 'chatbot']
+    return [{'sender': senders[i % 2], 'content': text, 'mode': 'fraude'} for i, text in enumerate(texts)]
+
+
+def test_hit_returns_the_stored_reply(clock):
+    cache = ResponseCache()
+    cache.set('k', 'reply')
+    assert cache.get('k') == 'reply'
+    assert cache.get('other') is None
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ResponseCache(ttl=60)
+    cache.set('k', 'reply')
+
+    clock.now += 59
+    assert cache.get('k') == 'reply'
+    clock.now += 2
+    assert cache.get('k') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = ResponseCache(max_entries=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    cache.get('a')
+    cache.set('c', '3')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == '1'
+    assert cache.get('c') == '3'
+
+
+def test_key_ignores_case_and_whitespace_of_the_message():
+    cache = ResponseCache()
+    persona = get_persona('fraude')
+    assert (cache.make_key(persona, [], 'Hello   World', CONFIG)
+            == cache.make_key(persona, [], ' hello world ', CONFIG))
+
+
+def test_key_covers_the_whole_window():
+    cache = ResponseCache()
+    persona = get_persona('fraude')
+    base = cache.make_key(persona, conversation('old', 'x', 'y'), 'now', CONFIG, user_id=1)
+
+    assert cache.make_key(persona, conversation('older', 'x', 'y'), 'now', CONFIG, user_id=1) != base
+    assert cache.make_key(persona, conversation('x', 'y'), 'now', CONFIG, user_id=1) != base
+
+
+@pytest.mark.parametrize('context', [
+    {'window': conversation('hi', 'hello')},
+    {'summary': 'They like tea.'},
+    {'memories': [{'user': 'hi', 'reply': 'hello'}]},
+])
+def test_turns_with_prior_context_are_keyed_per_user(context):
+    cache = ResponseCache()
+    persona = get_persona('fraude')
+    window = context.pop('window', [])
+
+    def key(user_id):
+        return cache.make_key(persona, window, 'now', CONFIG, user_id=user_id, **context)
+    assert key(1) != key(2)
+
+
+def test_opening_messages_are_shared_between_users():
+    cache = ResponseCache()
+    persona = get_persona('fraude')
+    assert cache.make_key(persona, [], 'hi', CONFIG, user_id=1) == cache.make_key(persona, [], 'hi', CONFIG, user_id=2)
+
+
+@pytest.mark.parametrize('change', ['persona', 'config', 'summary'])
+def test_key_changes_with_what_shapes_the_reply(change):
+    cache = ResponseCache()
+    persona = get_persona('fraude')
+    base = cache.make_key(persona, [], 'hi', CONFIG)
+
+    if change == 'persona':
+        other = next(key for key in personas.keys() if key != persona.key)
+        key = cache.make_key(get_persona(other), [], 'hi', CONFIG)
+    elif change == 'config':
+        key = cache.make_key(persona, [], 'hi', {'temperature': 0.2})
+    else:
+        key = cache.make_key(persona, [], 'hi', CONFIG, summary='They like tea.')
+    assert key != base
+
+
+def test_chat_call_keys_on_the_window_sent_to_the_model(clock, monkeypatch):
+    cache = ResponseCache()
+    monkeypatch.setattr(gemini, 'response_cache', cache)
+    # Room for one short turn: only the last user message before 'now' is replayed
+    monkeypatch.setattr(history_window, 'HISTORY_TOKEN_BUDGET', 5)
+    history = conversation('old', 'x', 'y', 'now')
+    cache.set(cache.make_key(get_persona('fraude'), history[2:3], 'now', gemini.CHAT_GENERATION_CONFIG, user_id=7),
+              'cached')
+
+    assert gemini.ChatCall(history, 'fraude', 'now', user_id=7).canned == 'cached'
+
+
+def test_disabled_modes_and_switch():
+    cache = ResponseCache(disabled_modes=['Lumina', ' '])
+    assert cache.allows('fraude')
+    assert not cache.allows('lumina')
+    assert not ResponseCache(enabled=False).allows('fraude')
@@ -0,0 +1,365 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from app import turn_guard
+from app.turn_guard import IdempotencyConflict, request_hash, run_once, valid_key
+
+
+class Table:
+    """chat_idempotency rows keyed by (user_id, idempotency_key)"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, user_id, key, fingerprint, status='pending', response=None, age=0, idle=0):
+        self.rows[(user_id, key)] = {'request_hash': fingerprint, 'status': status,
+                                     'response': response, 'age': age, 'idle': idle}
+
+
+class TableCursor:
+
+    def __init__(self, table):
+        self.table = table
+        self.rowcount = 0
+        self.row = None
+
+    def execute(self, sql, params):
+        sql = ' '.join(sql.split())
+        rows = self.table.rows
+        if sql.startswith('INSERT IGNORE'):
+            user_id, key, fingerprint = params
+            self.rowcount = 0 if (user_id, key) in rows else 1
+            if self.rowcount:
+                self.table.add(user_id, key, fingerprint)
+        elif sql.startswith('SELECT request_hash'):
+            self.row = rows.get(params)
+        elif sql.startswith("UPDATE chat_idempotency SET status = 'done'"):
+            response, user_id, key = params
+            rows[(user_id, key)].update(status='done', response=response)
+        elif sql.startswith('UPDATE'):
+            fingerprint, user_id, key, status, previous = params
+            row = rows.get((user_id, key))
+            self.rowcount = int(row is not None and row['status'] == status and row['request_hash'] == previous)
+            if self.rowcount:
+                self.table.add(user_id, key, fingerprint)
+        elif sql.startswith('DELETE'):
+            row = rows.get(params)
+            if row is not None and row['status'] == 'pending':
+                del rows[params]
+        else:
+            raise AssertionError(sql)
+
+    def fetchone(self):
+        return dict(self.row) if self.row else None
+
+    def close(self):
+        pass
+
+
+class TableConnection:
+
+    def __init__(self, table):
+        self.table = table
+
+    def cursor(self, dictionary=False):
+        return TableCursor(self.table)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = Table()
+    monkeypatch.setattr(turn_guard, 'get_db_connection', lambda: TableConnection(table))
+    return table
+
+
+class Turn:
+
+    def __init__(self, result=None, error=None):
+        self.result = result or {'response': 'reply'}
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return self.result
+
+
+FINGERPRINT = request_hash('hello', 7, 'fraude')
+
+
+def deadline(seconds=5):
+    return time.monotonic() + seconds
+
+
+def test_key_format():
+    assert valid_key('3f2b-01:retry_1.a')
+    assert not valid_key('')
+    assert not valid_key('has space')
+    assert not valid_key('x' * 65)
+
+
+def test_request_hash_covers_message_session_and_mode():
+    assert request_hash('hello', 7, None) == request_hash('hello', 7, 'Fraude')
+    assert request_hash('hello', 7, 'fraude') != request_hash('hello', 8, 'fraude')
+    assert request_hash('hello', 7, 'fraude') != request_hash('hello!', 7, 'fraude')
+
+
+def test_a_repeat_replays_the_stored_result(table):
+    turn = Turn()
+    assert run_once(1, 'k', FINGERPRINT, deadline(), turn) == turn.result
+    assert run_once(1, 'k', FINGERPRINT, deadline(), turn) == turn.result
+
+    assert turn.calls == 1
+    assert table.rows[(1, 'k')]['status'] == 'done'
+    assert json.loads(table.rows[(1, 'k')]['response']) == turn.result
+
+
+def test_keys_are_per_user(table):
+    turn = Turn()
+    run_once(1, 'k', FINGERPRINT, deadline(), turn)
+    run_once(2, 'k', FINGERPRINT, deadline(), turn)
+    assert turn.calls == 2
+
+
+def test_a_key_reused_for_another_message_conflicts(table):
+    run_once(1, 'k', FINGERPRINT, deadline(), Turn())
+
+    with pytest.raises(IdempotencyConflict) as excinfo:
+        run_once(1, 'k', request_hash('other', 7, 'fraude'), deadline(), Turn())
+    assert excinfo.value.status == 422
+
+
+def test_a_failed_turn_frees_the_key(table):
+    with pytest.raises(RuntimeError):
+        run_once(1, 'k', FINGERPRINT, deadline(), Turn(error=RuntimeError('model down')))
+    assert (1, 'k') not in table.rows
+
+    turn = Turn()
+    assert run_once(1, 'k', FINGERPRINT, deadline(), turn) == turn.result
+    assert turn.calls == 1
+
+
+def test_a_pending_owner_elsewhere_times_out(table, monkeypatch):
+    table.add(1, 'k', FINGERPRINT, idle=5)
+    sleeps = []
+    monkeypatch.setattr(turn_guard.time, 'sleep', sleeps.append)
+    turn = Turn()
+
+    with pytest.raises(IdempotencyConflict) as excinfo:
+        run_once(1, 'k', FINGERPRINT, deadline(1), turn)
+    assert excinfo.value.status == 409
+    assert turn.calls == 0
+    assert sleeps
+
+
+def test_a_pending_owner_elsewhere_is_waited_for(table, monkeypatch):
+    table.add(1, 'k', FINGERPRINT)
+
+    def owner_finishes(seconds):
+        table.add(1, 'k', FINGERPRINT, status='done', response=json.dumps({'response': 'theirs'}))
+
+    monkeypatch.setattr(turn_guard.time, 'sleep', owner_finishes)
+    turn = Turn()
+    assert run_once(1, 'k', FINGERPRINT, deadline(), turn) == {'response': 'theirs'}
+    assert turn.calls == 0
+
+
+@pytest.mark.parametrize('row', [
+    {'status': 'pending', 'idle': turn_guard.IDEMPOTENCY_PENDING_TIMEOUT + 1},
+    {'status': 'done', 'response': '{}', 'age': turn_guard.IDEMPOTENCY_TTL + 1},
+])
+def test_abandoned_and_expired_rows_are_taken_over(table, row):
+    table.add(1, 'k', request_hash('old', 7, 'fraude'), **row)
+    turn = Turn()
+
+    assert run_once(1, 'k', FINGERPRINT, deadline(), turn) == turn.result
+    assert turn.calls == 1
+    assert table.rows[(1, 'k')]['request_hash'] == FINGERPRINT
+
+
+def test_a_concurrent_repeat_in_this_process_attaches_to_the_owner(table, monkeypatch):
+    started = threading.Event()
+    attached = threading.Event()
+    release = threading.Event()
+    calls = []
+    monkeypatch.setattr(turn_guard.metrics, 'increment',
+                        lambda name, value=1: name == 'idempotency.attached' and attached.set())
+
+    def slow_turn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {'response': 'reply'}
+
+    results = []
+    owner = threading.Thread(target=lambda: results.append(run_once(1, 'k', FINGERPRINT, deadline(), slow_turn)))
+    owner.start()
+    started.wait(5)
+    repeat = threading.Thread(target=lambda: results.append(run_once(1, 'k', FINGERPRINT, deadline(), slow_turn)))
+    repeat.start()
+    assert attached.wait(5)
+    release.set()
+    owner.join(5)
+    repeat.join(5)
+
+    assert results == [{'response': 'reply'}] * 2
+    assert len(calls) == 1
+    assert turn_guard._flights == {}
+
+
+class LockConnection:
+    """The turn's lock connection over a session table {session_id: user_id}; records what it did"""
+
+    def __init__(self, sessions, free=True):
+        self.sessions = dict(sessions)
+        self.free = free
+        self.held = []
+        self.events = []
+
+    def cursor(self, buffered=False):
+        return LockCursor(self)
+
+    def commit(self):
+        self.events.append('commit')
+
+
+class LockCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.lastrowid = None
+
+    def execute(self, sql, params):
+        conn = self.conn
+        if sql.startswith('SELECT GET_LOCK'):
+            if conn.free:
+                conn.held.append(params[0])
+                conn.events.append(('lock', params[0]))
+            self.rows = [(int(conn.free),)]
+        elif sql.startswith('SELECT RELEASE_LOCK'):
+            conn.held.remove(params[0])
+            conn.events.append(('release', params[0]))
+            self.rows = [(1,)]
+        elif sql == turn_guard.OWNED_SESSION_SQL:
+            session_id, user_id = params
+            self.rows = [(session_id,)] if conn.sessions.get(session_id) == user_id else []
+        elif sql == turn_guard.LATEST_SESSION_ID_SQL:
+            owned = [session_id for session_id, owner in conn.sessions.items() if owner == params[0]]
+            self.rows = [(max(owned),)] if owned else []
+        else:
+            raise AssertionError(sql)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+def no_new_session(cursor):
+    raise AssertionError("the user already has a session")
+
+
+def locked_session(conn, user_id, session_id, create_session=no_new_session):
+    with turn_guard.session_turn_lock(conn, user_id, session_id, create_session) as resolved:
+        return resolved, list(conn.held)
+
+
+def test_turn_locks_the_requested_session():
+    conn = LockConnection({3: 1, 5: 1})
+    assert locked_session(conn, 1, 3) == (3, ['chat_session_3'])
+    assert conn.held == []
+
+
+def test_a_turn_without_an_id_locks_the_same_session_as_one_naming_it():
+    conn = LockConnection({3: 1, 5: 1})
+    assert locked_session(conn, 1, None) == locked_session(conn, 1, 5)
+
+
+def test_someone_elses_session_id_is_never_locked():
+    conn = LockConnection({3: 1, 9: 2})
+    assert locked_session(conn, 1, 9) == (3, ['chat_session_3'])
+
+
+def test_the_read_snapshot_ends_before_the_lock_is_taken():
+    conn = LockConnection({3: 1})
+    locked_session(conn, 1, 3)
+    assert conn.events[:2] == ['commit', ('lock', 'chat_session_3')]
+
+
+def test_a_first_session_is_created_under_the_user_lock():
+    conn = LockConnection({9: 2})
+
+    def create_session(cursor):
+        assert conn.held == ['chat_user_1']
+        conn.sessions[10] = 1
+        return 10
+
+    assert locked_session(conn, 1, None, create_session) == (10, ['chat_session_10'])
+    assert conn.events == ['commit', ('lock', 'chat_user_1'), 'commit', ('release', 'chat_user_1'),
+                           ('lock', 'chat_session_10'), ('release', 'chat_session_10')]
+
+
+def test_a_busy_session_raises():
+    with pytest.raises(turn_guard.SessionBusy):
+        locked_session(LockConnection({3: 1}, free=False), 1, 3)
+
+
+class AsyncLockCursor:
+
+    def __init__(self, conn):
+        self.cursor = LockCursor(conn)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params):
+        self.cursor.execute(sql, params)
+
+    async def fetchone(self):
+        return self.cursor.fetchone()
+
+    async def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class AsyncLockConnection(LockConnection):
+
+    def cursor(self):
+        return AsyncLockCursor(self)
+
+    async def commit(self):
+        LockConnection.commit(self)
+
+
+def test_async_turn_never_locks_someone_elses_session():
+    conn = AsyncLockConnection({3: 1, 9: 2})
+
+    async def turn():
+        async with turn_guard.session_turn_lock_async(conn, 1, 9, no_new_session) as resolved:
+            return resolved, list(conn.held)
+
+    assert asyncio.run(turn()) == (3, ['chat_session_3'])
+    assert conn.held == []
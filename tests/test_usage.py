@@ -0,0 +1,42 @@
+import datetime
+import types
+
+from app import usage
+
+
+class ReportCursor:
+
+    def execute(self, sql, params):
+        self.params = params
+
+    def fetchall(self):
+        return []
+
+
+class LateEvening(datetime.datetime):
+    """23:30 local time in UTC-5, which is already the next day in UTC"""
+
+    @classmethod
+    def utcnow(cls):
+        return cls(2026, 3, 2, 4, 30)
+
+
+class LocalDate(datetime.date):
+
+    @classmethod
+    def today(cls):
+        return cls(2026, 3, 1)
+
+
+def test_report_window_is_counted_in_utc_days_like_the_rollup(monkeypatch):
+    monkeypatch.setattr(usage, 'datetime', types.SimpleNamespace(
+        datetime=LateEvening, date=LocalDate, timedelta=datetime.timedelta
+    ))
+    cursor = ReportCursor()
+
+    report = usage.usage_report(cursor, 'day', days=7)
+
+    assert report['since'] == '2026-02-24'
+    assert datetime.date(2026, 2, 24) in cursor.params
+    # A reply stored now lands on the last day of the window
+    assert usage.usage_rollup_params(1, 'fraude', None, LateEvening.utcnow())[0] == datetime.date(2026, 3, 2)
@@ -0,0 +1,7 @@
+"""
+WSGI entry point for production servers: `gunicorn --config gunicorn.conf.py wsgi:app`.
+`python run.py` starts Flask's development server instead.
+"""
+from app import create_app
+
+app = create_app()